@@ -1,8 +1,8 @@
-from typing import Any
+from typing import Any, Optional
 from loguru import logger
 
 from core.agents.base import ToolAgent
-from core.tools import InfoDatabase, InteractionRetriever
+from core.tools import InfoDatabase, InteractionRetriever, ExpertiseIndex, expertise_path
 from core.utils import read_json, get_rm
 
 class Analyst(ToolAgent):
@@ -13,6 +13,8 @@ class Analyst(ToolAgent):
         self.get_tools(tool_config)
         self.analyst = self.get_LLM(config=config)
         self.json_mode = self.analyst.json_mode
+        suffix = '_json' if self.json_mode else ''
+        self.register_prompt_prefix(self.analyst, f'analyst_prompt{suffix}', fewshot=f'analyst_fewshot{suffix}')
         self.reset()
 
     @staticmethod
@@ -30,6 +32,11 @@ class Analyst(ToolAgent):
     def interaction_retriever(self) -> InteractionRetriever:
         return self.tools['interaction_retriever']
 
+    @property
+    def expertise_index(self) -> Optional[ExpertiseIndex]:
+        # Optional, configured as `expertise_index` in the tool config
+        return self.tools.get('expertise_index', None)
+
     @property
     def analyst_prompt(self) -> str:
         if self.json_mode:
@@ -51,12 +58,16 @@ class Analyst(ToolAgent):
             **kwargs
         )
 
+    async def _aprompt_analyst(self, **kwargs) -> str:
+        analyst_prompt = self._build_analyst_prompt(**kwargs)
+        return await self.analyst.acall(analyst_prompt)
+
     def _prompt_analyst(self, **kwargs) -> str:
         analyst_prompt = self._build_analyst_prompt(**kwargs)
         analysis = self.analyst(analyst_prompt)
         return analysis
 
-    def command(self, action_type: str, id: int, k: int = 5) -> None:
+    def command(self, action_type: str, id: int, k: int = 5, results: Optional[str] = None, path: Optional[str] = None) -> None:
         log_head = ''
         head = "ERROR"
         if action_type.lower() == 'info':
@@ -70,14 +81,25 @@ class Analyst(ToolAgent):
         elif action_type.lower() == 'history':
             if isinstance(id, int) and isinstance(k, int):
                 logger.debug(f'Action: Pull Request interaction history')
-                observation = self.interaction_retriever.pr_retrieve(PR_id=id, k=k)
+                observation = self.interaction_retriever.pr_retrieve(PR_id=id, k=k, submit_time=self.submit_time)
                 log_head = f'Look up PRHistory of PR {id} with at most {k} reviewers ...\n- '
                 head = "History"
             else:
                 observation = f"Invalid PR id and retrieval number: {id}"
+        elif action_type.lower() == 'expertise':
+            if self.expertise_index is None:
+                observation = 'Expertise index not available.'
+            elif isinstance(path, str) and isinstance(k, int):
+                logger.debug(f'Action: Path expertise')
+                observation = self.expertise_index.expertise(path=path, k=k, submit_time=self.submit_time)
+                log_head = f'Look up Expertise of path {path} with at most {k} reviewers ...\n- '
+                head = "Expertise"
+            else:
+                observation = f"Invalid path and retrieval number: {path}"
         elif action_type.lower() == 'finish':
             logger.debug(f'Action: Finish Analysis')
-            results = self._prompt_analyst(id=id)
+            if results is None:
+                results = self._prompt_analyst(id=id)
             observation = self.finish(results=results)
             log_head = 'Finish with results:\n- '
             head = "Analysis"
@@ -92,43 +114,73 @@ class Analyst(ToolAgent):
         }
         self._history.append(turn)
 
+    def _expertise_path(self, id: int) -> Optional[str]:
+        # The files are only known for the PR of the data sample
+        if self.expertise_index is None or self.system.data_sample.get('PR_id', None) != id:
+            return None
+        return expertise_path(self.system.data_sample)
+
     def forward(self, id: int, *args: Any, **kwargs: Any) -> str:
         assert self.system.data_sample is not None, "Data sample is not provided."
         assert 'submit_time' in self.system.data_sample, "Submit date is not provided."
-        self.interaction_retriever.reset(submit_time=self.system.data_sample['submit_time'])
+        self.submit_time = self.system.data_sample['submit_time']
 
         self.command('info', id)
+        path = self._expertise_path(id)
+        if path is not None:
+            self.command('expertise', id, path=path)
         self.command('finish', id)
         if not self.finished:
             return "Analyst did not return any result."
         return self.results
 
-    def invoke(self, argument: Any, json_mode: bool) -> str:
+    async def aforward(self, id: int, *args: Any, **kwargs: Any) -> str:
+        assert self.system.data_sample is not None, "Data sample is not provided."
+        assert 'submit_time' in self.system.data_sample, "Submit date is not provided."
+        self.submit_time = self.system.data_sample['submit_time']
+
+        self.command('info', id)
+        path = self._expertise_path(id)
+        if path is not None:
+            self.command('expertise', id, path=path)
+        results = await self._aprompt_analyst(id=id)
+        self.command('finish', id, results=results)
+        if not self.finished:
+            return "Analyst did not return any result."
+        return self.results
+
+    def _parse_argument(self, argument: Any, json_mode: bool) -> tuple[Optional[int], Optional[str]]:
         if json_mode:
             if not isinstance(argument, list) or len(argument) != 2:
-                observation = "The argument of the action 'Analyse' should be a list with two elements: type (pullrequest) and id."
-                return observation
+                return None, "The argument of the action 'Analyse' should be a list with two elements: type (pullrequest) and id."
             else:
                 type, id = argument
                 if type.lower() != 'pullrequest':
-                    observation = f"Invalid type: {type}. It should be 'pullrequest'."
-                    return observation
+                    return None, f"Invalid type: {type}. It should be 'pullrequest'."
                 elif not isinstance(id, int):
-                    observation = f"Invalid id: {id}. It should be an integer."
-                    return observation
+                    return None, f"Invalid id: {id}. It should be an integer."
         else:
             if len(argument.split(',')) != 2:
-                observation = "The argument of the action 'Analyse' should be a string with two elements separated by a comma: type (pullrequest) and id."
-                return observation
+                return None, "The argument of the action 'Analyse' should be a string with two elements separated by a comma: type (pullrequest) and id."
             else:
                 type, id = argument.split(',')
                 if type.lower() != 'pullrequest':
-                    observation = f"Invalid type: {type}. It should be 'pullrequest'."
-                    return observation
+                    return None, f"Invalid type: {type}. It should be 'pullrequest'."
                 else:
                     try:
                         id = int(id)
                     except ValueError or TypeError:
-                        observation = f"Invalid id: {id}. The id should be an integer."
-                        return observation
+                        return None, f"Invalid id: {id}. The id should be an integer."
+        return id, None
+
+    def invoke(self, argument: Any, json_mode: bool) -> str:
+        id, observation = self._parse_argument(argument, json_mode)
+        if observation is not None:
+            return observation
         return self(id=id)
+
+    async def ainvoke(self, argument: Any, json_mode: bool) -> str:
+        id, observation = self._parse_argument(argument, json_mode)
+        if observation is not None:
+            return observation
+        return await self.acall(id=id)
@@ -1,12 +1,14 @@
+import copy
 import json
+import asyncio
 from abc import ABC, abstractmethod
 from loguru import logger
 from typing import Any, Optional, TYPE_CHECKING
 from langchain.prompts import PromptTemplate
 
 from core.llms import BaseLLM, AnyOpenAILLM, OpenSourceLLM
-from core.tools import TOOL_MAP, Tool
-from core.utils import run_once, format_history, read_prompts
+from core.tools import TOOL_MAP, TOOL_REGISTRY, Tool
+from core.utils import run_once, format_history, read_prompts, get_rm, static_prefix
 
 if TYPE_CHECKING:
     from core.systems import System
@@ -54,6 +56,9 @@ class Agent(ABC):
     def __call__(self, *args: Any, **kwargs: Any) -> Any:
         return self.forward(*args, **kwargs)
     
+    async def acall(self, *args: Any, **kwargs: Any) -> Any:
+        return await self.aforward(*args, **kwargs)
+    
     @abstractmethod
     def forward(self, *args: Any, **kwargs: Any) -> Any:
         """Forward pass of the agent.
@@ -65,12 +70,39 @@ class Agent(ABC):
         """
         raise NotImplementedError("Agent.forward() not implemented")
     
+    async def aforward(self, *args: Any, **kwargs: Any) -> Any:
+        """Asynchronous forward pass of the agent. Runs `forward` in a worker thread by default. Subclasses should override it to await their LLMs natively.
+        
+        Returns:
+            `Any`: The agent output.
+        """
+        return await asyncio.to_thread(self.forward, *args, **kwargs)
+    
+    def close(self) -> None:
+        """Give back the shared resources of the agent, i.e. the models of its LLMs. Called by `System.close`; closing twice is a no-op."""
+        for value in vars(self).values():
+            if isinstance(value, BaseLLM):
+                value.close()
+
+    def register_prompt_prefix(self, llm: BaseLLM, prompt_name: str, **static: str) -> None:
+        """Declare the static prefix of a prompt to the LLM, so local models can cache its encoding. See `BaseLLM.register_prefix`.
+
+        Args:
+            `llm` (`BaseLLM`): The LLM the prompt is sent to.
+            `prompt_name` (`str`): The name of the prompt template. Nothing is registered if it is not configured.
+            `static` (`str`): The variables that are the same in every call, e.g. `fewshot`, and the names of the prompts holding their values. Missing prompts are read as `''`.
+        """
+        if prompt_name not in self.prompts:
+            return
+        values = {variable: self.prompts.get(name, '') for variable, name in static.items()}
+        llm.register_prefix(static_prefix(self.prompts[prompt_name], **values))
+
     def get_LLM(self, config_path: Optional[str] = None, config: Optional[dict] = None) -> BaseLLM:
         """Get the base large language model for the agent.
         
         Args:
             `config_path` (`Optional[str]`): The path to the config file of the LLM. If `config` is not `None`, this argument will be ignored. Defaults to `None`.
-            `config` (`Optional[dict]`): The config of the LLM. Defaults to `None`.
+            `config` (`Optional[dict]`): The config of the LLM. An optional `cache` entry holds the arguments of the on-disk response cache (see `LLMCache`). Defaults to `None`.
         Returns:
             `BaseLLM`: The LLM.
         """
@@ -80,10 +112,13 @@ class Agent(ABC):
                 config = json.load(f)
         model_type = config['model_type']
         del config['model_type']
+        cache_config = get_rm(config, 'cache', None)
         if model_type != 'api':
-            return OpenSourceLLM(**config)
+            llm = OpenSourceLLM(**config)
         else:
-            return AnyOpenAILLM(**config)
+            llm = AnyOpenAILLM(**config)
+        llm.set_cache(cache_config)
+        return llm
 
 class ToolAgent(Agent):
     """
@@ -94,6 +129,7 @@ class ToolAgent(Agent):
         self.tools: dict[str, Tool] = {}
         self._history = []
         self.max_turns: int = 6
+        self.submit_time: Optional[int] = None
 
     @run_once
     def validate_tools(self) -> None:
@@ -120,6 +156,11 @@ class ToolAgent(Agent):
         raise NotImplementedError("Agent.required_tools() not implemented")
     
     def get_tools(self, tool_config: dict[str, dict]):
+        """Get the tools of the agent from the shared `TOOL_REGISTRY`. Agents declaring the same tool type and config file share one read-only instance, so per-query state such as the `submit_time` cutoff is kept in the agent instead of the tool.
+        
+        Args:
+            `tool_config` (`dict[str, dict]`): The tool names and their configs. Each config must contain `type` and `config_path`.
+        """
         assert isinstance(tool_config, dict), 'Tool config must be a dictionary.'
         for tool_name, tool in tool_config.items():
             assert isinstance(tool, dict), 'Config of each tool must be a dictionary.'
@@ -128,16 +169,59 @@ class ToolAgent(Agent):
             tool_type = tool['type']
             if tool_type not in TOOL_MAP:
                 raise NotImplementedError(f'Docstore {tool_type} not implemented.')
-            config_path = tool['config_path']
-            if self.dataset is not None:
-                config_path = config_path.format(dataset=self.dataset)
-            self.tools[tool_name] = TOOL_MAP[tool_type](config_path=config_path)
+            self.tools[tool_name] = TOOL_REGISTRY.acquire(tool_type, self.tool_config_path(tool))
+
+    def tool_config_path(self, tool: dict) -> str:
+        """Get the config path of a tool, with the `{dataset}` of the agent filled in.
+
+        Args:
+            `tool` (`dict`): The config of the tool.
+        Returns:
+            `str`: The config path.
+        """
+        config_path = tool['config_path']
+        if self.dataset is not None:
+            config_path = config_path.format(dataset=self.dataset)
+        return config_path
+
+    def release_tools(self) -> None:
+        """Give the tools of the agent back to the shared `TOOL_REGISTRY`. Called by `System.close`; releasing twice is a no-op."""
+        tools, self.tools = self.tools, {}
+        for tool in tools.values():
+            TOOL_REGISTRY.release(tool)
+
+    def close(self) -> None:
+        self.release_tools()
+        super().close()
+
+    def fork(self) -> 'ToolAgent':
+        """Create a copy of the agent that shares its LLMs, prompts and tools but has its own state, so that several copies can run at the same time.
+        
+        Returns:
+            `ToolAgent`: The copy of the agent.
+        """
+        agent = copy.copy(self)
+        agent.tools = dict(self.tools)
+        for tool in agent.tools.values():
+            TOOL_REGISTRY.retain(tool)
+        agent.reset()
+        return agent
+
+    def __del__(self) -> None:
+        # Fallback for agents that are not released explicitly
+        if getattr(self, 'tools', None):
+            self.release_tools()
     
     def __call__(self, *args: Any, **kwargs: Any) -> Any:
         self.validate_tools()
         self.reset()
         return self.forward(*args, **kwargs)
     
+    async def acall(self, *args: Any, **kwargs: Any) -> Any:
+        self.validate_tools()
+        self.reset()
+        return await self.aforward(*args, **kwargs)
+    
     @abstractmethod
     def invoke(self, argument: Any, json_mode: bool) -> str:
         """Invoke the agent with the argument.
@@ -152,10 +236,22 @@ class ToolAgent(Agent):
         """
         raise NotImplementedError("ToolAgent.invoke() not implemented")
     
+    async def ainvoke(self, argument: Any, json_mode: bool) -> str:
+        """Asynchronously invoke the agent with the argument. Runs `invoke` in a worker thread by default.
+        
+        Args:
+            `argument` (`Any`): The argument for the agent.
+            `json_mode` (`bool`): Whether the argument is in JSON mode.
+        Returns:
+            `str`: The observation of the invoking process.
+        """
+        return await asyncio.to_thread(self.invoke, argument, json_mode)
+    
     def reset(self) -> None:
         self._history = []
         self.finished = False
         self.results = None
+        self.submit_time = None
         for tool in self.tools.values():
             tool.reset()
     
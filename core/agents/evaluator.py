@@ -1,18 +1,30 @@
-from typing import Any
+import json
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
 from loguru import logger
 
 from core.agents.base import ToolAgent
-from core.tools import InfoDatabase, InteractionRetriever
-from core.utils import read_json, get_rm
+from core.tools import InfoDatabase, InteractionRetriever, ExpertiseIndex, expertise_path
+from core.utils import read_json, get_rm, LRUMemo
 
 class Evaluator(ToolAgent):
     def __init__(self, config_path: str, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         config = read_json(config_path)
         tool_config: dict[str, dict] = get_rm(config, 'tool_config', {})
+        memo_config: Optional[dict] = get_rm(config, 'memo', None)
         self.get_tools(tool_config)
         self.evaluator = self.get_LLM(config=config)
         self.json_mode = self.evaluator.json_mode
+        suffix = '_json' if self.json_mode else ''
+        self.register_prompt_prefix(self.evaluator, f'evaluator_prompt{suffix}', fewshot=f'evaluator_fewshot{suffix}')
+        # Evaluations only depend on the reviewer and their history before the cutoff, so they are shared across samples.
+        # Positions in the history are only comparable within the same data, so the memo is shared per resolved tool config
+        tool_paths = ', '.join(f'{tool_name}={self.tool_config_path(tool)}' for tool_name, tool in sorted(tool_config.items()))
+        self.memo = LRUMemo.get(f'Evaluator {config_path} ({tool_paths})', **memo_config) if memo_config is not None else None
+        self._memo_version: Optional[str] = None
         self.reset()
 
     @staticmethod
@@ -30,6 +42,11 @@ class Evaluator(ToolAgent):
     def interaction_retriever(self) -> InteractionRetriever:
         return self.tools['interaction_retriever']
 
+    @property
+    def expertise_index(self) -> Optional[ExpertiseIndex]:
+        # Optional, configured as `expertise_index` in the tool config
+        return self.tools.get('expertise_index', None)
+
     @property
     def evaluator_prompt(self) -> str:
         if self.json_mode:
@@ -51,12 +68,58 @@ class Evaluator(ToolAgent):
             **kwargs
         )
 
+    async def _aprompt_evaluator(self, **kwargs) -> str:
+        evaluator_prompt = self._build_evaluator_prompt(**kwargs)
+        return await self.evaluator.acall(evaluator_prompt)
+
     def _prompt_evaluator(self, **kwargs) -> str:
         evaluator_prompt = self._build_evaluator_prompt(**kwargs)
         evaluation = self.evaluator(evaluator_prompt)
         return evaluation
 
-    def command(self, action_type: str, id: int, k: int = 5) -> None:
+    @property
+    def memo_version(self) -> str:
+        """The hash of the prompts and the LLM settings. Memo entries from other versions are never reused."""
+        if self._memo_version is None:
+            content = json.dumps([str(self.evaluator_prompt), str(self.evaluator_fewshot), self.evaluator.model_name, self.evaluator.generation_params, self.json_mode], default=str)
+            self._memo_version = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        return self._memo_version
+
+    @property
+    def expertise_path(self) -> Optional[str]:
+        if self.expertise_index is None:
+            return None
+        return expertise_path(self.system.data_sample)
+
+    def _memo_key(self, id: int) -> tuple[int, int, Optional[str], str]:
+        # The expertise is looked up under the directory of the current PR, so it is part of the key
+        return id, self.interaction_retriever.last_reviewer_interaction(reviewer_id=id, submit_time=self.submit_time), self.expertise_path, self.memo_version
+
+    def _recall(self, id: int) -> bool:
+        """Restore the evaluation of a reviewer from the memo.
+
+        Args:
+            `id` (`int`): The reviewer id.
+        Returns:
+            `bool`: Whether the evaluation was found in the memo.
+        """
+        if self.memo is None:
+            return False
+        entry = self.memo.lookup(self._memo_key(id))
+        if entry is None:
+            return False
+        history, results = entry
+        self._history = list(history)
+        self.finish(results=results)
+        logger.debug(f'Reuse the evaluation of reviewer {id}')
+        self.observation(results, f'Reuse the evaluation of reviewer {id}:\n- ')
+        return True
+
+    def _memorize(self, id: int) -> None:
+        if self.memo is not None and self.finished:
+            self.memo.store(self._memo_key(id), (list(self._history), self.results))
+
+    def command(self, action_type: str, id: int, k: int = 5, results: Optional[str] = None, path: Optional[str] = None) -> None:
         log_head = ''
         head = "ERROR"
         if action_type.lower() == 'info':
@@ -70,14 +133,25 @@ class Evaluator(ToolAgent):
         elif action_type.lower() == 'history':
             if isinstance(id, int) and isinstance(k, int):
                 logger.debug(f'Action: Reviewer interaction history')
-                observation = self.interaction_retriever.reviewer_retrieve(reviewer_id=id, k=k)
+                observation = self.interaction_retriever.reviewer_retrieve(reviewer_id=id, k=k, submit_time=self.submit_time)
                 log_head = f'Look up ReviewerHistory of reviewer {id} with at most {k} PRs ...\n- '
                 head = "History"
             else:
                 observation = f"Invalid reviewer id and retrieval number: {id}"
+        elif action_type.lower() == 'expertise':
+            if self.expertise_index is None:
+                observation = 'Expertise index not available.'
+            elif isinstance(id, int) and isinstance(path, str):
+                logger.debug(f'Action: Reviewer expertise')
+                observation = self.expertise_index.reviewer_expertise(reviewer_id=id, path=path, submit_time=self.submit_time)
+                log_head = f'Look up Expertise of reviewer {id} on path {path} ...\n- '
+                head = "Expertise"
+            else:
+                observation = f"Invalid reviewer id and path: {id}, {path}"
         elif action_type.lower() == 'finish':
             logger.debug(f'Finish Evaluation')
-            results = self._prompt_evaluator(id=id)
+            if results is None:
+                results = self._prompt_evaluator(id=id)
             observation = self.finish(results=results)
             log_head = 'Finish with results:\n- '
             head = "Evaluation"
@@ -95,41 +169,110 @@ class Evaluator(ToolAgent):
     def forward(self, id: int, *args: Any, **kwargs: Any) -> str:
         assert self.system.data_sample is not None, "Data sample is not provided."
         assert 'submit_time' in self.system.data_sample, "Submit date is not provided."
-        self.interaction_retriever.reset(submit_time=self.system.data_sample['submit_time'])
+        self.submit_time = self.system.data_sample['submit_time']
 
-        self.command('info', id)
-        self.command('history', id, 5)
-        self.command('finish', id)
+        if not self._recall(id):
+            self.command('info', id)
+            self.command('history', id, 5)
+            if self.expertise_path is not None:
+                self.command('expertise', id, path=self.expertise_path)
+            self.command('finish', id)
+            self._memorize(id)
         if not self.finished:
             return "Evaluator did not return any result."
         return self.results
 
-    def invoke(self, argument: Any, json_mode: bool) -> str:
+    async def aforward(self, id: int, *args: Any, **kwargs: Any) -> str:
+        assert self.system.data_sample is not None, "Data sample is not provided."
+        assert 'submit_time' in self.system.data_sample, "Submit date is not provided."
+        self.submit_time = self.system.data_sample['submit_time']
+
+        if not self._recall(id):
+            self.command('info', id)
+            self.command('history', id, 5)
+            if self.expertise_path is not None:
+                self.command('expertise', id, path=self.expertise_path)
+            results = await self._aprompt_evaluator(id=id)
+            self.command('finish', id, results=results)
+            self._memorize(id)
+        if not self.finished:
+            return "Evaluator did not return any result."
+        return self.results
+
+    def _parse_argument(self, argument: Any, json_mode: bool) -> tuple[Optional[list[int]], Optional[str]]:
         if json_mode:
             if not isinstance(argument, list) or len(argument) != 2:
-                observation = "The argument of the action 'Evaluate' should be a list with two elements: type (reviewer) and id."
-                return observation
+                return None, "The argument of the action 'Evaluate' should be a list with two elements: type (reviewer) and id, or type (reviewer) and a list of ids."
             else:
-                type, id = argument
+                type, ids = argument
                 if type.lower() != 'reviewer':
-                    observation = f"Invalid type: {type}. It should be 'reviewer'."
-                    return observation
-                elif not isinstance(id, int):
-                    observation = f"Invalid id: {id}. It should be an integer."
-                    return observation
+                    return None, f"Invalid type: {type}. It should be 'reviewer'."
+                if not isinstance(ids, list):
+                    ids = [ids]
+                if len(ids) == 0:
+                    return None, "No id given. It should be an integer or a list of integers."
+                for id in ids:
+                    if not isinstance(id, int):
+                        return None, f"Invalid id: {id}. It should be an integer."
         else:
-            if len(argument.split(',')) != 2:
-                observation = "The argument of the action 'Evaluate' should be a string with two elements separated by a comma: type (reviewer) and id."
-                return observation
+            if len(argument.split(',')) < 2:
+                return None, "The argument of the action 'Evaluate' should be a string with at least two elements separated by commas: type (reviewer) and one or more ids."
             else:
-                type, id = argument.split(',')
+                type, *ids = argument.split(',')
                 if type.lower() != 'reviewer':
-                    observation = f"Invalid type: {type}. It should be 'reviewer'."
-                    return observation
+                    return None, f"Invalid type: {type}. It should be 'reviewer'."
                 else:
                     try:
-                        id = int(id)
+                        ids = [int(id) for id in ids]
                     except ValueError or TypeError:
-                        observation = f"Invalid id: {id}. The id should be an integer."
-                        return observation
-        return self(id=id)
+                        return None, f"Invalid id: {','.join(ids)}. The ids should be integers."
+        return list(dict.fromkeys(ids)), None
+
+    def _merge(self, ids: list[int], evaluators: list['Evaluator'], results: list[str]) -> str:
+        """Merge the evaluations of several reviewers into the state of this evaluator, so that `history` holds the turns of all reviewers.
+
+        Args:
+            `ids` (`list[int]`): The reviewer ids.
+            `evaluators` (`list[Evaluator]`): The forked evaluators that evaluated each reviewer.
+            `results` (`list[str]`): The evaluation of each reviewer.
+        Returns:
+            `str`: The merged observation.
+        """
+        self.reset()
+        for id, evaluator in zip(ids, evaluators):
+            self._history.extend({**turn, 'head': f"{turn['head']} of reviewer {id}"} for turn in evaluator._history)
+        self.submit_time = evaluators[0].submit_time
+        return self.finish('\n'.join(f'[Reviewer {id}] {result}' for id, result in zip(ids, results)))
+
+    def invoke(self, argument: Any, json_mode: bool) -> str:
+        ids, observation = self._parse_argument(argument, json_mode)
+        if observation is not None:
+            return observation
+        if len(ids) == 1:
+            return self(id=ids[0])
+        evaluators = [self.fork() for _ in ids]
+        try:
+            if self.web_demo:
+                # Streamlit calls must stay on the script thread
+                results = [evaluator(id=id) for evaluator, id in zip(evaluators, ids)]
+            else:
+                with ThreadPoolExecutor(max_workers=len(ids)) as executor:
+                    results = list(executor.map(lambda evaluator, id: evaluator(id=id), evaluators, ids))
+            return self._merge(ids, evaluators, results)
+        finally:
+            for evaluator in evaluators:
+                evaluator.release_tools()
+
+    async def ainvoke(self, argument: Any, json_mode: bool) -> str:
+        ids, observation = self._parse_argument(argument, json_mode)
+        if observation is not None:
+            return observation
+        if len(ids) == 1:
+            return await self.acall(id=ids[0])
+        evaluators = [self.fork() for _ in ids]
+        try:
+            results = await asyncio.gather(*[evaluator.acall(id=id) for evaluator, id in zip(evaluators, ids)])
+            return self._merge(ids, evaluators, list(results))
+        finally:
+            for evaluator in evaluators:
+                evaluator.release_tools()
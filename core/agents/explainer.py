@@ -39,6 +39,11 @@ class Explainer(Agent):
         explainer_response = self.explainer(explainer_prompt)
         return format_step(explainer_response)
 
+    async def _aprompt_explainer(self, **kwargs) -> str:
+        explainer_prompt = self._build_explainer_prompt(**kwargs)
+        explainer_response = await self.explainer.acall(explainer_prompt)
+        return format_step(explainer_response)
+
     def forward(self, input: str, scratchpad: str, *args, **kwargs) -> str:
         logger.trace('Running Reason Explainer...')
 
@@ -46,3 +51,11 @@ class Explainer(Agent):
 
         logger.trace(self.explainer_result)
         return self.explainer_result
+
+    async def aforward(self, input: str, scratchpad: str, *args, **kwargs) -> str:
+        logger.trace('Running Reason Explainer...')
+
+        self.explainer_result = await self._aprompt_explainer(input=input, scratchpad=scratchpad)
+
+        logger.trace(self.explainer_result)
+        return self.explainer_result
@@ -12,6 +12,9 @@ class Hallucination(Agent):
         config = read_json(config_path)
         self.hallucination = self.get_LLM(config=config)
         self.json_mode = self.hallucination.json_mode
+        examples = 'hallucination_examples_json' if self.json_mode else 'hallucination_examples'
+        for prompt_name in ['hallucination_prompt_json' if self.json_mode else 'hallucination_prompt', 'hallucination_analyse_prompt_json', 'hallucination_evaluate_prompt_json', 'hallucination_retrieve_prompt_json']:
+            self.register_prompt_prefix(self.hallucination, prompt_name, examples=examples)
 
     @property
     def hallucination_prompt(self) -> PromptTemplate:
@@ -62,6 +65,11 @@ class Hallucination(Agent):
         hallucination_response = self.hallucination(hallucination_prompt)
         return format_step(hallucination_response)
 
+    async def _aprompt_hallucination(self, prompt: str, **kwargs) -> str:
+        hallucination_prompt = self._build_hallucination_prompt(prompt, **kwargs)
+        hallucination_response = await self.hallucination.acall(hallucination_prompt)
+        return format_step(hallucination_response)
+
     def forward(self, prompt: str, *args, **kwargs) -> str:
         logger.trace('Running Hallucination...')
 
@@ -69,3 +77,11 @@ class Hallucination(Agent):
 
         logger.trace(self.hallucination_result)
         return self.hallucination_result
+
+    async def aforward(self, prompt: str, *args, **kwargs) -> str:
+        logger.trace('Running Hallucination...')
+
+        self.hallucination_result = await self._aprompt_hallucination(prompt, **kwargs)
+
+        logger.trace(self.hallucination_result)
+        return self.hallucination_result
@@ -1,11 +1,12 @@
 import tiktoken
+from typing import Callable, Optional
 from loguru import logger
 from transformers import AutoTokenizer
 from langchain.prompts import PromptTemplate
 
 from core.agents.base import Agent
 from core.llms import AnyOpenAILLM
-from core.utils import format_step, run_once
+from core.utils import format_step, run_once, Scratchpad
 
 class Manager(Agent):
     """
@@ -30,11 +31,45 @@ class Manager(Agent):
             self.action_enc = tiktoken.encoding_for_model(self.action_llm.model_name)
         else:
             self.action_enc = AutoTokenizer.from_pretrained(self.action_llm.model_name)
-    
-    def over_limit(self, **kwargs) -> bool:
-        prompt = self._build_manager_prompt("action", **kwargs)
-        return len(self.action_enc.encode(prompt)) > self.action_llm.tokens_limit or len(self.thought_enc.encode(prompt)) > self.thought_llm.tokens_limit
-        
+        self._count_thought = self._token_counter(self.thought_enc)
+        self._count_action = self._token_counter(self.action_enc)
+        # The prompt without the scratchpad and its token counts, the same for every step of a trial
+        self._base_prompt: Optional[tuple[str, int, int]] = None
+
+    @staticmethod
+    def _token_counter(enc) -> Callable[[str], int]:
+        if isinstance(enc, tiktoken.Encoding):
+            return lambda text: len(enc.encode(text))
+        return lambda text: len(enc.encode(text, add_special_tokens=False))
+
+    def token_usage(self, scratchpad: Scratchpad | str, **kwargs) -> float:
+        """Get the length of the action prompt with the scratchpad, as a fraction of the token limit of the thought or the action LLM, whichever is closer to its limit. The prompt without the scratchpad is only counted again when it changes, and the scratchpad only counts its new segments, so the check does not grow with the trajectory.
+
+        Args:
+            `scratchpad` (`Scratchpad | str`): The scratchpad.
+        Returns:
+            `float`: The fraction of the limit used. Over `1` if the prompt does not fit.
+        """
+        if isinstance(scratchpad, str):
+            scratchpad = Scratchpad(scratchpad)
+        prompt = self._build_manager_prompt("action", scratchpad='', **kwargs)
+        base = self._base_prompt
+        if base is None or base[0] != prompt:
+            base = self._base_prompt = (prompt, len(self.action_enc.encode(prompt)), len(self.thought_enc.encode(prompt)))
+        action_tokens = base[1] + scratchpad.tokens('action', self._count_action)
+        thought_tokens = base[2] + scratchpad.tokens('thought', self._count_thought)
+        return max(action_tokens / self.action_llm.tokens_limit, thought_tokens / self.thought_llm.tokens_limit)
+
+    def over_limit(self, scratchpad: Scratchpad | str, **kwargs) -> bool:
+        """Check whether the action prompt with the scratchpad exceeds the token limit of the thought or the action LLM. See `token_usage`.
+
+        Args:
+            `scratchpad` (`Scratchpad | str`): The scratchpad.
+        Returns:
+            `bool`: Whether the prompt is over the limit.
+        """
+        return self.token_usage(scratchpad, **kwargs) > 1
+
     @property
     def manager_action_prompt(self) -> PromptTemplate:
         if self.json_mode:
@@ -87,6 +122,17 @@ class Manager(Agent):
         action_response = self.action_llm(action_prompt)
         return format_step(action_response)
     
+    async def _aprompt_thought(self, **kwargs) -> str:
+        thought_prompt = self._build_manager_prompt("thought", **kwargs)
+        self._log_prompt(thought_prompt)
+        thought_response = await self.thought_llm.acall(thought_prompt)
+        return format_step(thought_response)
+    
+    async def _aprompt_action(self, **kwargs) -> str:
+        action_prompt = self._build_manager_prompt("action", **kwargs)
+        action_response = await self.action_llm.acall(action_prompt)
+        return format_step(action_response)
+    
     def forward(self, stage: str, *args, **kwargs) -> str:
         if stage == 'thought':
             return self._prompt_thought(**kwargs)
@@ -94,3 +140,11 @@ class Manager(Agent):
             return self._prompt_action(**kwargs)
         else:
             raise ValueError(f"Unsupported stage: {stage}")
+    
+    async def aforward(self, stage: str, *args, **kwargs) -> str:
+        if stage == 'thought':
+            return await self._aprompt_thought(**kwargs)
+        elif stage == 'action':
+            return await self._aprompt_action(**kwargs)
+        else:
+            raise ValueError(f"Unsupported stage: {stage}")
@@ -1,18 +1,40 @@
-import json
 import re
-from typing import Any
+import json
+from typing import Any, Optional
 from loguru import logger
 from langchain.prompts import PromptTemplate
 
-from core.agents.base import Agent
-from core.utils import read_json, parse_action, get_rm
+from core.agents.base import ToolAgent
+from core.tools import SearchEngine
+from core.utils import read_json, get_rm
 
-class Retriever(Agent):
+class Retriever(ToolAgent):
+    """
+    The retriever agent. With a `search_engine` in the tool config, requirements are answered from the local `SearchEngine` and the LLM, if configured, only re-ranks the results when `rerank` is set. Without it, the LLM generates the answer from the requirement alone.
+    """
     def __init__(self, config_path: str, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         config = read_json(config_path)
-        self.retriever = self.get_LLM(config=config)
-        self.json_mode = self.retriever.json_mode
+        tool_config: dict[str, dict] = get_rm(config, 'tool_config', {})
+        self.k: int = get_rm(config, 'k', 5)
+        self.rerank: bool = get_rm(config, 'rerank', False)
+        self.get_tools(tool_config)
+        self.retriever = self.get_LLM(config=config) if 'model_type' in config else None
+        assert self.search_engine is not None or self.retriever is not None, 'Retriever needs a search engine or an LLM.'
+        assert not self.rerank or self.retriever is not None, 'Re-ranking needs an LLM.'
+        assert not self.rerank or 'retriever_rerank_prompt' in self.prompts, 'Re-ranking needs the retriever_rerank_prompt prompt in the prompt config.'
+        assert not self.rerank or isinstance(self.retriever_rerank_prompt, PromptTemplate) and set(self.retriever_rerank_prompt.input_variables) <= {'requirement', 'results'}, 'retriever_rerank_prompt must be a template with the {requirement} and {results} variables.'
+        self.json_mode = self.retriever.json_mode if self.retriever is not None else False
+        self.reset()
+
+    @staticmethod
+    def required_tools() -> dict[str, type]:
+        return {}
+
+    @property
+    def search_engine(self) -> Optional[SearchEngine]:
+        # Optional, configured as `search_engine` in the tool config
+        return self.tools.get('search_engine', None)
 
     @property
     def retriever_prompt(self) -> PromptTemplate:
@@ -28,6 +50,10 @@ class Retriever(Agent):
         else:
             return self.prompts['retriever_examples']
 
+    @property
+    def retriever_rerank_prompt(self) -> PromptTemplate:
+        return self.prompts['retriever_rerank_prompt']
+
     def parse(self, response: str, json_mode: bool = False) -> str:
         if json_mode:
             try:
@@ -38,20 +64,85 @@ class Retriever(Agent):
         else:
             return response
 
+    @staticmethod
+    def parse_rerank(response: str, n: int) -> list[int]:
+        """Parse the order given by the re-ranker. The results are numbered from 1. Invalid or repeated numbers are skipped, and the results left out keep their search order at the end.
+
+        Args:
+            `response` (`str`): The response of the re-ranker, e.g. `[3, 1, 2]`.
+            `n` (`int`): The number of results.
+        Returns:
+            `list[int]`: The positions of the results in the new order.
+        """
+        order = []
+        for number in re.findall(r'\d+', response):
+            i = int(number) - 1
+            if 0 <= i < n and i not in order:
+                order.append(i)
+        return order + [i for i in range(n) if i not in order]
+
     def _build_retriever_prompt(self, **kwargs) -> str:
         return self.retriever_prompt.format(
             examples=self.retriever_examples,
             **kwargs
         )
 
+    def _build_rerank_prompt(self, requirement: str, results: list[str]) -> str:
+        return self.retriever_rerank_prompt.format(
+            requirement=requirement,
+            results='\n'.join(f'{i}. {result}' for i, result in enumerate(results, start=1)),
+        )
+
     def _prompt_retriever(self, **kwargs) -> str:
         retriever_prompt = self._build_retriever_prompt(**kwargs)
         response = self.retriever(retriever_prompt)
         return response
 
+    async def _aprompt_retriever(self, **kwargs) -> str:
+        retriever_prompt = self._build_retriever_prompt(**kwargs)
+        response = await self.retriever.acall(retriever_prompt)
+        return response
+
+    def _search(self, requirement: str) -> list[str]:
+        # PRs submitted after the current one are not visible
+        data_sample = getattr(self.system, 'data_sample', None)
+        if data_sample is not None:
+            self.submit_time = data_sample.get('submit_time', None)
+        results = self.search_engine.search(requirement, k=self.k, submit_time=self.submit_time)
+        logger.debug(f'Search: {len(results)} results for [{requirement}]')
+        return results
+
+    @staticmethod
+    def _format_results(requirement: str, results: list[str]) -> str:
+        if len(results) == 0:
+            return f'No result found for [{requirement}].'
+        return f'Retrieved {len(results)} results for [{requirement}]:\n' + '\n'.join(f'{i}. {result}' for i, result in enumerate(results, start=1))
+
     def forward(self, requirement: str, *args, **kwargs) -> str:
-        response = self._prompt_retriever(requirement=requirement)
-        response = self.parse(response, self.json_mode)
+        if self.search_engine is None:
+            response = self._prompt_retriever(requirement=requirement)
+            response = self.parse(response, self.json_mode)
+        else:
+            results = self._search(requirement)
+            if self.rerank and len(results) > 1:
+                order = self.parse_rerank(self.retriever(self._build_rerank_prompt(requirement, results)), len(results))
+                results = [results[i] for i in order]
+            response = self._format_results(requirement, results)
+
+        self.observation(response, f"Retrieving [{requirement}] ...\n- ")
+
+        return response
+
+    async def aforward(self, requirement: str, *args, **kwargs) -> str:
+        if self.search_engine is None:
+            response = await self._aprompt_retriever(requirement=requirement)
+            response = self.parse(response, self.json_mode)
+        else:
+            results = self._search(requirement)
+            if self.rerank and len(results) > 1:
+                order = self.parse_rerank(await self.retriever.acall(self._build_rerank_prompt(requirement, results)), len(results))
+                results = [results[i] for i in order]
+            response = self._format_results(requirement, results)
 
         self.observation(response, f"Retrieving [{requirement}] ...\n- ")
 
@@ -61,3 +152,8 @@ class Retriever(Agent):
         if not isinstance(argument, str):
             return f'Invalid argument type: {type(argument)}. Must be a string.'
         return self(requirement=argument)
+
+    async def ainvoke(self, argument: Any, json_mode: bool) -> str:
+        if not isinstance(argument, str):
+            return f'Invalid argument type: {type(argument)}. Must be a string.'
+        return await self.acall(requirement=argument)
@@ -2,6 +2,7 @@ import json
 
 import tiktoken
 from enum import Enum
+from typing import Optional
 from loguru import logger
 from transformers import AutoTokenizer
 from langchain.prompts import PromptTemplate
@@ -83,9 +84,7 @@ class Supervisor(Agent):
             scratchpad=scratchpad
         )
     
-    def _prompt_supervision(self, input: str, scratchpad: str) -> str:
-        supervisor_prompt = self._build_supervisor_prompt(input, scratchpad)
-        supervisor_response = self.llm(supervisor_prompt)
+    def _handle_supervision(self, supervisor_prompt: str, supervisor_response: str) -> str:
         supervisor_response_json = format_step(supervisor_response)
         supervisor_response_json = self.parse(supervisor_response_json, self.json_mode)
         if self.keep_supervise:
@@ -101,20 +100,33 @@ class Supervisor(Agent):
             logger.debug(f"Supervisor output: {self.supervisor_output}")
         return format_step(supervisor_response)
 
-    def forward(self, input: str, scratchpad: str, *args, **kwargs) -> str:
-        logger.trace('Running Supervise strategy...')
+    def _prompt_supervision(self, input: str, scratchpad: str) -> str:
+        supervisor_prompt = self._build_supervisor_prompt(input, scratchpad)
+        supervisor_response = self.llm(supervisor_prompt)
+        return self._handle_supervision(supervisor_prompt, supervisor_response)
 
+    async def _aprompt_supervision(self, input: str, scratchpad: str) -> str:
+        supervisor_prompt = self._build_supervisor_prompt(input, scratchpad)
+        supervisor_response = await self.llm.acall(supervisor_prompt)
+        return self._handle_supervision(supervisor_prompt, supervisor_response)
+
+    @property
+    def prompts_llm(self) -> bool:
+        """Whether the supervision strategy prompts the supervisor LLM."""
+        return self.supervision_strategy in [Strategy.SUPERVISE, Strategy.LAST_ATTEMPT_AND_SUPERVISE]
+
+    def _update_supervisions(self, input: str, scratchpad: str, supervision: Optional[str]) -> str:
         if self.supervision_strategy == Strategy.LAST_ATTEMPT:
             self.supervisions = [scratchpad]
             self.supervisions_str = format_last_attempt(input, scratchpad, self.prompts['last_trial_header'])
 
         elif self.supervision_strategy == Strategy.SUPERVISE:
-            self.supervisions.append(self._prompt_supervision(input=input, scratchpad=scratchpad))
+            self.supervisions.append(supervision)
             self.supervisions_str = format_supervisions(self.supervisions, header=self.prompts['supervise_header'])
 
         elif self.supervision_strategy == Strategy.LAST_ATTEMPT_AND_SUPERVISE:
             self.supervisions_str = format_last_attempt(input, scratchpad, self.prompts['last_trial_header'])
-            self.supervisions = self._prompt_supervision(input=input, scratchpad=scratchpad)
+            self.supervisions = supervision
             self.supervisions_str += format_supervisions(self.supervisions, header=self.prompts['supervise_last_trial_header'])
 
         elif self.supervision_strategy == Strategy.NONE:
@@ -126,3 +138,13 @@ class Supervisor(Agent):
 
         logger.trace(self.supervisions_str)
         return self.supervisions_str
+
+    def forward(self, input: str, scratchpad: str, *args, **kwargs) -> str:
+        logger.trace('Running Supervise strategy...')
+        supervision = self._prompt_supervision(input=input, scratchpad=scratchpad) if self.prompts_llm else None
+        return self._update_supervisions(input, scratchpad, supervision)
+
+    async def aforward(self, input: str, scratchpad: str, *args, **kwargs) -> str:
+        logger.trace('Running Supervise strategy...')
+        supervision = await self._aprompt_supervision(input=input, scratchpad=scratchpad) if self.prompts_llm else None
+        return self._update_supervisions(input, scratchpad, supervision)
@@ -0,0 +1,115 @@
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from loguru import logger
+from langchain.prompts import PromptTemplate
+
+from core.dataset.recommend_rev import lookup, process_pr_data, add_candidates
+
+# Size of the revfinder dataset, scaled by --scale
+N_INTERACTIONS = 20000
+N_PRS = 8000
+N_USERS = 1500
+N_NEG = 9
+
+
+def make_data(scale: int, seed: int = 0) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Make a synthetic interaction table and user profile table.
+
+    Args:
+        `scale` (`int`): The size of the data relative to the revfinder dataset.
+        `seed` (`int`, optional): The random seed. Defaults to `0`.
+    Returns:
+        `tuple[pd.DataFrame, pd.DataFrame]`: The interactions and the user profiles indexed by `id`.
+    """
+    rng = np.random.default_rng(seed)
+    n, n_prs, n_users = N_INTERACTIONS * scale, N_PRS * scale, N_USERS * scale
+    user_profile_df = pd.DataFrame({
+        'id': np.arange(1, n_users + 1),
+        'profile': [f'Reviewer with {k} reviews in project p{k % 13}' for k in rng.integers(1, 500, n_users)],
+    }).set_index('id')
+    pr_ids = rng.integers(1, n_prs + 1, n)
+    # Like in the real data, the files, project, subject and owner only depend on the PR
+    pr_files = np.array([str([f'src/m{a}/f{b}.cpp']) for a, b in zip(rng.integers(0, 50, n_prs + 1), rng.integers(0, 20, n_prs + 1))], dtype=object)
+    out_df = pd.DataFrame({
+        'PR_id': pr_ids,
+        'reviewer_id': rng.integers(1, n_users + 1, n),
+        'owner_id': (pr_ids * 7919) % n_users + 1,
+        'files': pr_files[pr_ids],
+        'project': (pr_ids % 17).astype(str),
+        'subject': [f'Fix issue {k}' if k % 10 else '' for k in pr_ids],
+    })
+    out_df['project'] = 'project/' + out_df['project']
+    out_df['n_reviewer_id'] = rng.integers(1, n_users + 1, (n, N_NEG)).tolist()
+    return out_df, user_profile_df
+
+
+def rowwise(out_df: pd.DataFrame, user_profile_df: pd.DataFrame) -> pd.DataFrame:
+    # The per-row implementation replaced by `recommend_rev`
+    out_df = out_df.copy()
+    out_df['owner_profile'] = out_df['owner_id'].apply(lambda x: user_profile_df.loc[x]['profile'])
+    pr_df = out_df[['PR_id', 'files', 'project', 'subject', 'owner_id']].drop_duplicates('PR_id').set_index('PR_id')
+    pr_df['owner_profile'] = pr_df['owner_id'].apply(lambda x: user_profile_df.loc[x]['profile'])
+    for col in pr_df.columns.to_list():
+        try:
+            pr_df[col] = pr_df[col].apply(lambda x: 'None' if pd.isna(x) else x)
+        except:
+            continue
+    input_variables = pr_df.columns.to_list()
+    template = PromptTemplate(
+        template='PR Subject: {subject}, Project: {project}, Files: {files}, PR Contributor Info: [{owner_profile}]',
+        input_variables=input_variables,
+    )
+    pr_df['PR_info'] = pr_df[input_variables].apply(lambda x: template.format(**x), axis=1)
+    out_df['PR_info'] = out_df['PR_id'].apply(lambda x: pr_df.loc[x]['PR_info'])
+    out_df['candidate_reviewer_id'] = out_df.apply(lambda x: [x['reviewer_id']] + x['n_reviewer_id'], axis=1)
+    def shuffle_list(x):
+        np.random.default_rng(seed=41).shuffle(x)
+        return x
+    out_df['candidate_reviewer_id'] = out_df['candidate_reviewer_id'].apply(lambda x: shuffle_list(x))
+    for col in out_df.columns.to_list():
+        try:
+            out_df[col] = out_df[col].apply(lambda x: 'None' if x == '' else x)
+        except:
+            continue
+    return out_df
+
+
+def vectorized(out_df: pd.DataFrame, user_profile_df: pd.DataFrame) -> pd.DataFrame:
+    # The steps of `recommend_rev.process_interaction_data` and `process_data`, calling the shipped functions
+    out_df = out_df.copy()
+    out_df['owner_profile'] = lookup(out_df['owner_id'], user_profile_df['profile'])
+    pr_df = process_pr_data(out_df, user_profile_df)
+    add_candidates(out_df, pr_df)
+    return out_df
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the profile attachment and rendering steps of the revfinder preprocessing.')
+    parser.add_argument('--scale', type=int, default=10, help='Size of the synthetic data relative to the revfinder dataset')
+    parser.add_argument('--skip_rowwise', action='store_true', help='Only time the vectorized implementation')
+    args = parser.parse_args()
+
+    out_df, user_profile_df = make_data(args.scale)
+    logger.info(f'Synthetic data: {len(out_df)} interactions, {out_df["PR_id"].nunique()} PRs, {len(user_profile_df)} users')
+
+    start = time.perf_counter()
+    fast = vectorized(out_df, user_profile_df)
+    fast_time = time.perf_counter() - start
+    logger.success(f'Vectorized: {fast_time:.2f}s')
+    if args.skip_rowwise:
+        return
+
+    start = time.perf_counter()
+    slow = rowwise(out_df, user_profile_df)
+    slow_time = time.perf_counter() - start
+    logger.success(f'Row-wise: {slow_time:.2f}s, speedup {slow_time / fast_time:.1f}x')
+    for col in ['owner_profile', 'PR_info', 'subject']:
+        assert fast[col].tolist() == slow[col].tolist(), f'Column {col} differs.'
+    assert fast['candidate_reviewer_id'].map(lambda x: list(map(int, x))).tolist() == slow['candidate_reviewer_id'].map(lambda x: list(map(int, x))).tolist(), 'Column candidate_reviewer_id differs.'
+    logger.success('Outputs are identical.')
+
+
+if __name__ == "__main__":
+    main()
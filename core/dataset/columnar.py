@@ -0,0 +1,90 @@
+import io
+import os
+import pandas as pd
+from typing import Optional
+from loguru import logger
+
+from core.tools.interaction import HistoryIndex
+from core.utils import ColumnarTable, write_table, append_table
+
+# The info tables with their id column and the column of ready-made profiles
+INFO_TABLES = [('pullrequest', 'PR_id', 'PR_info'), ('reviewer', 'reviewer_id', 'reviewer_profile')]
+
+def convert_to_columnar(dir: str, out_dir: Optional[str] = None) -> None:
+    """Convert `all.csv`, `pullrequest.csv` and `reviewer.csv` in `dir` to the memory-mapped columnar layout read by the tools. The interactions are sorted by `grant_time` and saved with their history indexes, and the info tables are sorted by id, with their ready-made profiles stored as rendered by `InfoDatabase`. The file lists are stored as offsets and values.
+
+    Args:
+        `dir` (`str`): The directory of the processed dataset, e.g. `'data/revfinder'`.
+        `out_dir` (`Optional[str]`, optional): The output directory. Defaults to `'{dir}/columnar'`.
+    """
+    if out_dir is None:
+        out_dir = os.path.join(dir, 'columnar')
+    all_df = pd.read_csv(os.path.join(dir, 'all.csv'))
+    all_df = all_df.sort_values(by=['grant_time'], kind='mergesort').reset_index(drop=True)
+    all_path = os.path.join(out_dir, 'all')
+    write_table(all_df, all_path, list_columns=['files'])
+    grant_time = all_df['grant_time'].to_numpy()
+    for key in ['PR_id', 'reviewer_id']:
+        HistoryIndex(all_df[key].to_numpy(), grant_time).save(all_path, key)
+    logger.info(f'Wrote {len(all_df)} interactions to {all_path}')
+
+    for name, id_column, text_column in INFO_TABLES:
+        info_df = pd.read_csv(os.path.join(dir, f'{name}.csv'))
+        info_df = _rendered(info_df.sort_values(by=[id_column], kind='mergesort').reset_index(drop=True), text_column)
+        write_table(info_df, os.path.join(out_dir, name), list_columns=['files'] if 'files' in info_df.columns else [])
+        logger.info(f'Wrote {len(info_df)} rows of {name} info to {os.path.join(out_dir, name)}')
+
+
+def _rendered(info_df: pd.DataFrame, text_column: str) -> pd.DataFrame:
+    # Store the profiles as `render_profiles` returns them, so that lookups return them as is
+    if text_column in info_df.columns:
+        info_df[text_column] = info_df[text_column].str.replace('\n', '; ', regex=False)
+    return info_df
+
+def _as_read(data: pd.DataFrame, index: bool) -> pd.DataFrame:
+    # Round trip through CSV, so new values are stored exactly like the ones converted from the CSV files
+    return pd.read_csv(io.StringIO(data.to_csv(index=index)))
+
+def append_to_columnar(dir: str, all_df: pd.DataFrame, pr_df: pd.DataFrame, reviewer_df: pd.DataFrame, out_dir: Optional[str] = None) -> None:
+    """Append the rows added to `all.csv`, `pullrequest.csv` and `reviewer.csv` by `core.dataset.recommend_rev.update_data` to the columnar layout, and add the new interactions to the history indexes. New interactions are appended after the old ones instead of sorted in, which the indexes allow. An info table is rewritten from its CSV file if the new ids do not all come after the old ones.
+
+    Args:
+        `dir` (`str`): The directory of the processed dataset, e.g. `'data/revfinder'`.
+        `all_df` (`pd.DataFrame`): The new interactions.
+        `pr_df` (`pd.DataFrame`): The new rows of `pullrequest.csv`, indexed by `PR_id`.
+        `reviewer_df` (`pd.DataFrame`): The new rows of `reviewer.csv`, indexed by `reviewer_id`.
+        `out_dir` (`Optional[str]`, optional): The columnar directory. Defaults to `'{dir}/columnar'`.
+    """
+    if out_dir is None:
+        out_dir = os.path.join(dir, 'columnar')
+    all_df = _as_read(all_df, index=False).sort_values(by=['grant_time'], kind='mergesort').reset_index(drop=True)
+    all_path = os.path.join(out_dir, 'all')
+    start = append_table(all_df, all_path)
+    positions = start + all_df.index.to_numpy()
+    grant_time = all_df['grant_time'].to_numpy()
+    for key in ['PR_id', 'reviewer_id']:
+        index = HistoryIndex.load(all_path, key)
+        index.extend(all_df[key].to_numpy(), grant_time, positions)
+        index.save(all_path, key)
+    logger.info(f'Appended {len(all_df)} interactions to {all_path}')
+
+    for (name, id_column, text_column), info_df in zip(INFO_TABLES, [pr_df, reviewer_df]):
+        if len(info_df) == 0:
+            continue
+        info_df = _rendered(_as_read(info_df, index=True).sort_values(by=[id_column], kind='mergesort').reset_index(drop=True), text_column)
+        path = os.path.join(out_dir, name)
+        ids = ColumnarTable(path)[id_column]
+        last_id = ids[-1] if len(ids) > 0 else None
+        del ids
+        if last_id is None or info_df[id_column].iloc[0] > last_id:
+            append_table(info_df, path)
+            logger.info(f'Appended {len(info_df)} rows of {name} info to {path}')
+        else:
+            info_df = pd.read_csv(os.path.join(dir, f'{name}.csv'))
+            info_df = _rendered(info_df.sort_values(by=[id_column], kind='mergesort').reset_index(drop=True), text_column)
+            write_table(info_df, path, list_columns=['files'] if 'files' in info_df.columns else [])
+            logger.info(f'Rewrote {len(info_df)} rows of {name} info to {path}')
+
+
+if __name__ == "__main__":
+    convert_to_columnar(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'data', 'revfinder'))
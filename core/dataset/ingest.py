@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import heapq
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from itertools import islice
+from pathlib import Path
+from typing import Iterator, Optional
+from concurrent.futures import ProcessPoolExecutor
+from loguru import logger
+
+
+def _local_offset(hour: int) -> int:
+    # `hour` is a local wall-clock hour counted as if it were UTC. Offsets valid a day before and after it are the
+    # only candidates, as time zones change at most once a day
+    before, after = time.localtime(hour - 86400).tm_gmtoff, time.localtime(hour + 86400).tm_gmtoff
+    valid = [offset for offset in (before, after) if time.localtime(hour - offset).tm_gmtoff == offset]
+    if len(valid) == 0:
+        # Skipped hour: read with the offset before the change, as `time.mktime` does
+        return before
+    # Repeated hour: take its first occurrence
+    return max(valid)
+
+
+def to_timestamps(dates: pd.Series) -> np.ndarray:
+    """Convert local `%Y-%m-%d %H:%M:%S` dates to Unix timestamps at once, like `time.mktime(time.strptime(date, ...))` per date. The local UTC offset is looked up once per distinct hour. Dates in a repeated hour at the end of daylight saving time, which `time.mktime` reads either way, are read as their first occurrence.
+
+    Args:
+        `dates` (`pd.Series`): The dates.
+    Returns:
+        `np.ndarray`: The timestamps in seconds.
+    """
+    naive = pd.to_datetime(dates, format='%Y-%m-%d %H:%M:%S').to_numpy().astype('datetime64[s]').astype(np.int64)
+    hours, inverse = np.unique(naive // 3600 * 3600, return_inverse=True)
+    offsets = np.array([_local_offset(hour) for hour in hours.tolist()], dtype=np.int64)
+    return naive - offsets[inverse.reshape(-1)]
+
+
+def _write_chunk(records: list[dict], path: str) -> None:
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def parse_file(file_index: int, file_path: str, chunk_dir: str, chunk_rows: int) -> list[str]:
+    """Parse one raw `*.jsonl` file into chunks of at most `chunk_rows` records sorted by `submit_time`. Runs in a worker process.
+
+    Args:
+        `file_index` (`int`): The index of the file, used to break ties like the original concatenation order.
+        `file_path` (`str`): The path to the raw file. Its name starts with the project parent, e.g. `qt_all.jsonl`.
+        `chunk_dir` (`str`): The directory to write the chunks to.
+        `chunk_rows` (`int`): The maximum number of records per chunk.
+    Returns:
+        `list[str]`: The paths to the chunks.
+    """
+    project_parent = os.path.basename(file_path).split('_')[0]
+    paths = []
+    line_no = 0
+    with open(file_path, 'r', encoding='utf-8') as file:
+        while True:
+            records = [json.loads(line) for line in islice(file, chunk_rows)]
+            if len(records) == 0:
+                break
+            dates = pd.Series([record['submit_date'] for record in records]).str.split('.').str[0]
+            times = to_timestamps(dates)
+            for i, (record, date, submit_time) in enumerate(zip(records, dates.tolist(), times.tolist())):
+                record['submit_date'] = date
+                record['submit_time'] = submit_time
+                record['project_parent'] = project_parent
+                record['_order'] = [file_index, line_no + i]
+            line_no += len(records)
+            path = os.path.join(chunk_dir, f'{file_index}_{len(paths)}.jsonl')
+            _write_chunk([records[i] for i in np.argsort(times, kind='stable')], path)
+            paths.append(path)
+    return paths
+
+
+def _read_chunk(path: str) -> Iterator[tuple[tuple[int, int, int], dict]]:
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            yield (record['submit_time'], *record['_order']), record
+
+
+def _merge(paths: list[str], output_path: str, final: bool) -> None:
+    streams = [_read_chunk(path) for path in paths]
+    with open(output_path, 'w', encoding='utf-8') as out:
+        for PR_id, (_, record) in enumerate(heapq.merge(*streams, key=lambda item: item[0]), start=1):
+            if final:
+                del record['_order']
+                record = {'PR_id': PR_id, **record}
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def merge_chunks(paths: list[str], output_path: str, fan_in: int = 128) -> None:
+    """Merge sorted chunks into one file sorted by `submit_time` and assign `PR_id` from 1 in that order. Only one record per open chunk is held in memory. More than `fan_in` chunks are merged in several passes to bound the number of open files.
+
+    Args:
+        `paths` (`list[str]`): The paths to the chunks.
+        `output_path` (`str`): The path to the merged file.
+        `fan_in` (`int`, optional): Maximum number of chunks merged at once. Defaults to `128`.
+    """
+    level = 0
+    while len(paths) > fan_in:
+        merged = []
+        for i in range(0, len(paths), fan_in):
+            path = f'{paths[i]}.merged{level}'
+            _merge(paths[i:i + fan_in], path, final=False)
+            merged.append(path)
+        paths = merged
+        level += 1
+    _merge(paths, output_path, final=True)
+
+
+def ingest(dir: str, output_path: str, workers: Optional[int] = None, chunk_rows: int = 100000) -> str:
+    """Parse the raw `*.jsonl` files under `dir` in parallel and merge them into one jsonl file sorted by `submit_time`, with `submit_time`, `project_parent` and `PR_id` added. Memory use is bounded by the chunk size, not by the size of the data.
+
+    Args:
+        `dir` (`str`): The directory of the raw files.
+        `output_path` (`str`): The path to the merged file.
+        `workers` (`Optional[int]`, optional): Number of worker processes. Defaults to `None` (the number of CPUs).
+        `chunk_rows` (`int`, optional): Maximum number of records per sorted chunk. Defaults to `100000`.
+    Returns:
+        `str`: `output_path`.
+    """
+    files = sorted(str(path) for path in Path(dir).glob('*.jsonl'))
+    chunk_dir = tempfile.mkdtemp(prefix='chunks_', dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(parse_file, i, path, chunk_dir, chunk_rows) for i, path in enumerate(files)]
+            paths = [path for future in futures for path in future.result()]
+        logger.info(f'Parsed {len(files)} files into {len(paths)} sorted chunks')
+        merge_chunks(paths, output_path)
+    finally:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+    return output_path
+
+
+def iter_records(path: str) -> Iterator[dict]:
+    """Stream the records of a file written by `ingest`.
+
+    Args:
+        `path` (`str`): The path to the merged file.
+    Returns:
+        `Iterator[dict]`: The records in `submit_time` order.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
@@ -1,5 +1,8 @@
 import os
+import shutil
 import random
+import tempfile
+import argparse
 import subprocess
 import pandas as pd
 import numpy as np
@@ -7,8 +10,13 @@ import json
 import time
 import re
 from loguru import logger
+from itertools import islice
 from pathlib import Path
-from langchain.prompts import PromptTemplate
+from typing import Iterator, Optional
+
+from core.dataset.columnar import convert_to_columnar, append_to_columnar
+from core.dataset.ingest import ingest, iter_records, to_timestamps
+from core.utils import format_columns
 
 
 def to_timestamp(s: str) -> int:
@@ -17,31 +25,141 @@ def to_timestamp(s: str) -> int:
     return timestamp
 
 
-def read_data(dir: str) -> tuple[pd.DataFrame, pd.DataFrame]:
-    user_profile = pd.read_csv(os.path.join(dir, 'user_info', 'user_profile_no_nationality.csv')).set_index('id')
-    folder = Path(os.path.join(dir, 'all'))
-    dfs = []
+PR_COLUMNS = ['PR_id', 'changeId', 'approve_history', 'submit_date', 'submit_time', 'files', 'project_parent', 'project', 'subject', 'owner']
+
+
+def read_user_profile(dir: str) -> pd.DataFrame:
+    return pd.read_csv(os.path.join(dir, 'user_info', 'user_profile_no_nationality.csv')).set_index('id')
+
+
+def iter_data(dir: str, workers: Optional[int] = None, chunk_rows: int = 100000) -> Iterator[pd.DataFrame]:
+    """Stream the PRs of the raw `*.jsonl` files under `{dir}/all` in chunks, in `submit_time` order. The files are merged by `ingest` into a temporary file under `dir`, which is deleted once the stream is exhausted or closed, so only one chunk is held in memory.
+
+    Args:
+        `dir` (`str`): The directory of the raw data, e.g. `'data/revfinder/raw_data_fused'`.
+        `workers` (`Optional[int]`, optional): Number of worker processes of `ingest`. Defaults to `None` (the number of CPUs).
+        `chunk_rows` (`int`, optional): Maximum number of PRs per chunk. Defaults to `100000`.
+    Returns:
+        `Iterator[pd.DataFrame]`: The chunks of PRs.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='ingest_', dir=dir)
+    try:
+        # 并行解析 jsonl 文件, 按 submit_time 外部归并排序
+        sorted_path = ingest(os.path.join(dir, 'all'), os.path.join(tmp_dir, 'all_sorted.jsonl'), workers=workers, chunk_rows=chunk_rows)
+        records = iter_records(sorted_path)
+        while True:
+            chunk = list(islice(records, chunk_rows))
+            if len(chunk) == 0:
+                break
+            yield pd.DataFrame(chunk).reindex(columns=PR_COLUMNS)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def read_prs(dir: str, workers: Optional[int] = None, chunk_rows: int = 100000) -> pd.DataFrame:
+    """Read all PRs of the raw data at once. Only for small data, e.g. the new data of `update_data`. Use `write_interactions` for a full export.
+
+    Args:
+        `dir` (`str`): The directory of the raw data.
+        `workers` (`Optional[int]`, optional): Number of worker processes of `ingest`. Defaults to `None` (the number of CPUs).
+        `chunk_rows` (`int`, optional): Maximum number of records per sorted chunk. Defaults to `100000`.
+    Returns:
+        `pd.DataFrame`: The PRs, in `submit_time` order.
+    """
+    chunks = list(iter_data(dir, workers=workers, chunk_rows=chunk_rows))
+    return pd.concat(chunks, ignore_index=True) if len(chunks) > 0 else pd.DataFrame(columns=PR_COLUMNS)
+
+
+def lookup(keys: pd.Series, values: pd.Series) -> pd.Series:
+    """Look up the value of each key with one hash join instead of a `.loc` call per row.
+
+    Args:
+        `keys` (`pd.Series`): The keys to look up.
+        `values` (`pd.Series`): The values, indexed by key.
+    Raises:
+        `KeyError`: If a key is not in the index of `values`, like `.loc` does.
+    Returns:
+        `pd.Series`: The value of each key, aligned with `keys`.
+    """
+    missing = ~keys.isin(values.index)
+    if missing.any():
+        raise KeyError(f'{int(missing.sum())} keys not found, e.g. {keys[missing].iloc[0]}')
+    return keys.map(values)
+
+
+def fill_na(df: pd.DataFrame, value: str = 'None') -> pd.DataFrame:
+    """Replace the missing values of every column with `value`."""
+    for col in df.columns.to_list():
+        missing = df[col].isna()
+        if missing.any():
+            df[col] = df[col].astype(object).where(~missing, value)
+    return df
 
-    for file_path in folder.glob("*.jsonl"):
-        lines = []
-        # 读取JSON文件
-        with file_path.open('r', encoding='utf-8') as file:
-            for line in file:
-                line_dic = json.loads(line)
-                line_dic['submit_date'] = line_dic['submit_date'].split('.')[0]
-                line_dic['submit_time'] = to_timestamp(line_dic['submit_date'])
-                line_dic['project_parent'] = file_path.name.split('_')[0]
-                lines.append(line_dic)
 
-        df = pd.DataFrame(lines)
-        dfs.append(df)
+def _is_name(name) -> bool:
+    return isinstance(name, str) and not name.isspace()
 
-    data_df = pd.concat(dfs)
-    data_df = data_df.sort_values(by=['submit_time'], kind='mergesort').reset_index(drop=True)
-    data_df['PR_id'] = pd.Series(range(1, len(data_df) + 1))
-    data_df = data_df[['PR_id', 'changeId', 'approve_history', 'submit_date', 'submit_time', 'files', 'project_parent', 'project', 'subject', 'owner']]
 
-    return data_df, user_profile
+def expand_interactions(data_df: pd.DataFrame) -> pd.DataFrame:
+    """Expand the PRs read by `iter_data` or `read_prs` into one interaction per approval in `approve_history`, with the columns of `temp/out.csv`. Approvals dated 1900 and approvals with a blank reviewer or owner name are skipped.
+
+    Args:
+        `data_df` (`pd.DataFrame`): The PRs.
+    Returns:
+        `pd.DataFrame`: The interactions, in the order of the PRs.
+    """
+    rows = data_df.explode('approve_history', ignore_index=True)
+    rows = rows[rows['approve_history'].map(lambda x: isinstance(x, dict))]
+    approvals = pd.DataFrame(rows['approve_history'].tolist(), index=rows.index).reindex(columns=['grant_date', 'userId', 'name'])
+    owners = pd.DataFrame(rows['owner'].map(lambda x: x if isinstance(x, dict) else {}).tolist(), index=rows.index).reindex(columns=['accountId', 'name'])
+    grant_date = approvals['grant_date'].astype(str).str.split('.').str[0]
+    keep = ~grant_date.str.startswith('1900-') & approvals['name'].map(_is_name) & owners['name'].map(_is_name)
+    rows, approvals, owners, grant_date = rows[keep], approvals[keep], owners[keep], grant_date[keep]
+    grant_time = to_timestamps(grant_date) if len(rows) > 0 else np.zeros(0, dtype=np.int64)
+    out_df = pd.DataFrame({
+        'PR_id': rows['PR_id'],
+        'changeId': rows['changeId'],
+        'submit_date': rows['submit_date'],
+        'submit_time': rows['submit_time'],
+        'grant_date': grant_date,
+        'grant_time': grant_time,
+        'reviewer_id': approvals['userId'],
+        'reviewer_name': approvals['name'],
+        'duration': grant_time - rows['submit_time'].to_numpy(dtype=np.int64),
+        # As read back from `temp/out.csv`
+        'files': rows['files'].map(str),
+        'project_parent': rows['project_parent'],
+        'project': rows['project'],
+        'subject': rows['subject'],
+        'owner_id': owners['accountId'],
+        'owner_name': owners['name'],
+    })
+    return out_df.reset_index(drop=True)
+
+
+def write_interactions(dir: str, out_path: str, workers: Optional[int] = None, chunk_rows: int = 100000) -> int:
+    """Expand the raw data into interactions chunk by chunk with `expand_interactions` and write them to `out_path`, e.g. `temp/out.csv`. Memory use is bounded by the chunk size, not by the size of the export.
+
+    Args:
+        `dir` (`str`): The directory of the raw data.
+        `out_path` (`str`): The path to the interaction CSV file. Overwritten.
+        `workers` (`Optional[int]`, optional): Number of worker processes of `ingest`. Defaults to `None` (the number of CPUs).
+        `chunk_rows` (`int`, optional): Maximum number of PRs per chunk. Defaults to `100000`.
+    Returns:
+        `int`: The number of interactions.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    n_rows = 0
+    first = True
+    for chunk in iter_data(dir, workers=workers, chunk_rows=chunk_rows):
+        out_df = expand_interactions(chunk)
+        out_df.to_csv(out_path, mode='w' if first else 'a', header=first, index=False)
+        n_rows += len(out_df)
+        first = False
+    if first:
+        expand_interactions(pd.DataFrame(columns=PR_COLUMNS)).to_csv(out_path, index=False)
+    logger.info(f'Wrote {n_rows} interactions to {out_path}')
+    return n_rows
 
 
 def reindex(out_df: pd.DataFrame = None) -> dict:
@@ -53,7 +171,98 @@ def reindex(out_df: pd.DataFrame = None) -> dict:
     return r2name
 
 
-def process_interaction_data(data_df: pd.DataFrame, n_neg_reviewer: int, user_profile_df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+def extend_reindex(r2name: dict, out_df: pd.DataFrame) -> dict:
+    """Give the names that are not in `r2name` new ids after the largest one, in sorted order like `reindex`. Existing ids are kept.
+
+    Args:
+        `r2name` (`dict`): The id of each known name.
+        `out_df` (`pd.DataFrame`): The new interactions, with `reviewer_name` and `owner_name`.
+    Returns:
+        `dict`: The id of each known and new name.
+    """
+    all_name = pd.concat([out_df['reviewer_name'], out_df['owner_name']]).drop_duplicates()
+    names = sorted(set(all_name.tolist()) - r2name.keys())
+    start = max(r2name.values(), default=0) + 1
+    return {**r2name, **dict(zip(names, range(start, start + len(names))))}
+
+
+def _has_duplicates(samples: np.ndarray) -> np.ndarray:
+    # Mark every repeat of a value in its row, keeping the first occurrence
+    order = np.argsort(samples, axis=1, kind='stable')
+    sorted_samples = np.take_along_axis(samples, order, axis=1)
+    repeated = np.zeros(samples.shape, dtype=bool)
+    repeated[:, 1:] = sorted_samples[:, 1:] == sorted_samples[:, :-1]
+    duplicates = np.zeros(samples.shape, dtype=bool)
+    np.put_along_axis(duplicates, order, repeated, axis=1)
+    return duplicates
+
+
+def sample_negatives(pr_ids: np.ndarray, positive_codes: np.ndarray, base: int, pool: np.ndarray, n_neg: int, rng: np.random.Generator) -> np.ndarray:
+    """Draw `n_neg` distinct negative reviewers from `pool` for each row. All slots are drawn at once, and the slots holding a reviewer of the PR or a repeat are redrawn together until none is left.
+
+    Args:
+        `pr_ids` (`np.ndarray`): The PR of each row.
+        `positive_codes` (`np.ndarray`): The sorted codes `PR_id * base + reviewer_id` of the reviewers of each PR.
+        `base` (`int`): The code base, greater than any reviewer id.
+        `pool` (`np.ndarray`): The reviewers to draw from.
+        `n_neg` (`int`): The number of negative reviewers per row.
+        `rng` (`np.random.Generator`): The random generator.
+    Returns:
+        `np.ndarray`: The negative reviewers, of shape `(len(pr_ids), n_neg)`.
+    """
+    samples = pool[rng.integers(0, len(pool), size=(len(pr_ids), n_neg))]
+    rows = np.arange(len(pr_ids))
+    while len(rows) > 0:
+        codes = pr_ids[rows, None] * base + samples[rows]
+        invalid = np.isin(codes, positive_codes) | _has_duplicates(samples[rows])
+        rows = rows[invalid.any(axis=1)]
+        invalid = invalid[invalid.any(axis=1)]
+        redraw = samples[rows]
+        redraw[invalid] = pool[rng.integers(0, len(pool), size=int(invalid.sum()))]
+        samples[rows] = redraw
+    return samples
+
+
+def negative_sample(df: pd.DataFrame, n_neg: int, pool_by: Optional[str] = None, seed: int = 41, known: Optional[pd.DataFrame] = None) -> list[list[int]]:
+    """Sample the negative reviewers of each interaction. A negative reviewer never reviewed the PR, and the negatives of one interaction are distinct.
+
+    Args:
+        `df` (`pd.DataFrame`): The interactions, with `PR_id` and `reviewer_id`.
+        `n_neg` (`int`): The number of negative reviewers per interaction.
+        `pool_by` (`Optional[str]`, optional): A column such as `project_parent`. If given, negatives are drawn from the reviewers of the same group, or from all reviewers if the group has too few of them. Defaults to `None`.
+        `seed` (`int`, optional): The seed of the random generator. Defaults to `41`.
+        `known` (`Optional[pd.DataFrame]`, optional): Earlier interactions, with `reviewer_id` and the `pool_by` column. Their reviewers join the pools, but their PRs must not occur in `df`. Defaults to `None`.
+    Returns:
+        `list[list[int]]`: The negative reviewers of each interaction.
+    """
+    rng = np.random.default_rng(seed=seed)
+    pr_ids = df['PR_id'].to_numpy(dtype=np.int64)
+    reviewer_ids = df['reviewer_id'].to_numpy(dtype=np.int64)
+    pool_columns = ['reviewer_id'] + ([pool_by] if pool_by is not None else [])
+    pool_df = df[pool_columns] if known is None else pd.concat([df[pool_columns], known[pool_columns]], ignore_index=True)
+    pool_reviewers = pool_df['reviewer_id'].to_numpy(dtype=np.int64)
+    base = int(pool_reviewers.max()) + 1
+    positive_codes = np.unique(pr_ids * base + reviewer_ids)
+    max_positives = int(df.groupby('PR_id')['reviewer_id'].nunique().max())
+    all_reviewers = np.unique(pool_reviewers)
+    if len(all_reviewers) - max_positives < n_neg:
+        raise ValueError(f'Not enough reviewers to sample {n_neg} negatives: {len(all_reviewers)} reviewers, up to {max_positives} per PR.')
+    if pool_by is None:
+        return sample_negatives(pr_ids, positive_codes, base, all_reviewers, n_neg, rng).tolist()
+    samples = np.zeros((len(df), n_neg), dtype=np.int64)
+    groups = df[pool_by].to_numpy()
+    pool_groups = pool_df[pool_by].to_numpy()
+    for group in sorted(pd.unique(groups)):
+        rows = np.flatnonzero(groups == group)
+        pool = np.unique(pool_reviewers[pool_groups == group])
+        if len(pool) - max_positives < n_neg:
+            logger.warning(f'{pool_by} {group} has only {len(pool)} reviewers, sampling its negatives from all reviewers.')
+            pool = all_reviewers
+        samples[rows] = sample_negatives(pr_ids[rows], positive_codes, base, pool, n_neg, rng)
+    return samples.tolist()
+
+
+def process_interaction_data(out_path: str, n_neg_reviewer: int, user_profile_df: pd.DataFrame, neg_pool_by: Optional[str] = None) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
     # out_df = pd.DataFrame(data=None, columns=['PR_id', 'changeId', 'submit_date', 'submit_time', 'grant_date', 'grant_time', 'reviewer_id', 'reviewer_name', 'duration', 'files', 'project_parent', 'project', 'subject', 'owner_name', 'owner_id'])
     # index_out = 0
     # for _, row in data_df.iterrows():
@@ -69,36 +278,17 @@ def process_interaction_data(data_df: pd.DataFrame, n_neg_reviewer: int, user_pr
     # # 临时存储out_df
     # out_df.to_csv(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'data', 'revfinder', 'temp', 'out.csv'))
 
-    out_df = pd.read_csv(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'data', 'revfinder', 'temp', 'out.csv'))[['PR_id', 'changeId', 'submit_date', 'submit_time', 'grant_date', 'grant_time', 'reviewer_id', 'reviewer_name', 'duration', 'files', 'project_parent', 'project', 'subject', 'owner_id', 'owner_name']]
+    out_df = pd.read_csv(out_path)[['PR_id', 'changeId', 'submit_date', 'submit_time', 'grant_date', 'grant_time', 'reviewer_id', 'reviewer_name', 'duration', 'files', 'project_parent', 'project', 'subject', 'owner_id', 'owner_name']]
     # out_df = out_df.groupby('reviewer_name').tail(20).copy()
 
     # reindex (start from 1)
     r2name = reindex(out_df)     # 从1开始的连续索引
 
-    out_df['reviewer_id'] = out_df['reviewer_name'].apply(lambda x: r2name[x])
-    out_df['owner_id'] = out_df['owner_name'].apply(lambda x: r2name[x])
-
-    out_df['reviewer_profile'] = out_df['reviewer_id'].apply(lambda x: user_profile_df.loc[x]['profile'])
-    out_df['owner_profile'] = out_df['owner_id'].apply(lambda x: user_profile_df.loc[x]['profile'])
+    out_df['reviewer_id'] = out_df['reviewer_name'].map(r2name)
+    out_df['owner_id'] = out_df['owner_name'].map(r2name)
 
-    pr_reviewer_set = dict()   # pr被哪个评审员评审过
-    for pr_id, seq_df in out_df.groupby('PR_id'):
-        pr_reviewer_set[pr_id] = set(seq_df['reviewer_id'].values.tolist())
-
-
-    def negative_sample(df):
-        reviewer_id_list = list(set(out_df['reviewer_id'].tolist()))
-        random_rng = np.random.default_rng(seed=41)
-        neg_reviewer = random_rng.choice(reviewer_id_list, (len(df), n_neg_reviewer), replace=True)   # pr可选reviewer
-        for i, pr_row in df.iterrows():
-            reviewer = pr_reviewer_set[pr_row['PR_id']]
-            for j in range(len(neg_reviewer[i])):
-                # while user_profile_df.loc[neg_reviewer[i][j]]["project"] != pr_row['project_parent'] or neg_reviewer[i][j] in reviewer or neg_reviewer[i][j] in neg_reviewer[i][:j]:
-                while neg_reviewer[i][j] in reviewer or neg_reviewer[i][j] in neg_reviewer[i][:j]:
-                    neg_reviewer[i][j] = random_rng.choice(reviewer_id_list)
-            assert len(set(neg_reviewer[i])) == len(neg_reviewer[i])  # 检查是否有重复
-        df['n_reviewer_id'] = neg_reviewer.tolist()
-        return df
+    out_df['reviewer_profile'] = lookup(out_df['reviewer_id'], user_profile_df['profile'])
+    out_df['owner_profile'] = lookup(out_df['owner_id'], user_profile_df['profile'])
 
     def generate_dev_test(data_df):
         result_dfs = []
@@ -108,7 +298,7 @@ def process_interaction_data(data_df: pd.DataFrame, n_neg_reviewer: int, user_pr
             result_dfs.append(result_df)
         return result_dfs, data_df
 
-    out_df = negative_sample(out_df)
+    out_df['n_reviewer_id'] = negative_sample(out_df, n_neg_reviewer, pool_by=neg_pool_by)
 
     # 为了让 test_df dev_df 的历史记录都不为空,所以先去除leave_df
     # leave_df test_df dev_df都是从out_df中分离出的每一个评审者的一个评审
@@ -129,7 +319,7 @@ def process_reviewer_data(out_df: pd.DataFrame, user_profile_df: pd.DataFrame) -
     all_user_df = pd.concat([df1, df2]).drop_duplicates()
     all_user_df = all_user_df.set_index('id').sort_index()
 
-    reviewer_df['reviewer_profile'] = reviewer_df['reviewer_id'].apply(lambda x: user_profile_df.loc[x]['profile'])
+    reviewer_df['reviewer_profile'] = lookup(reviewer_df['reviewer_id'], user_profile_df['profile'])
     reviewer_df = reviewer_df.set_index('reviewer_id').sort_index()
 
     return reviewer_df, all_user_df
@@ -137,36 +327,46 @@ def process_reviewer_data(out_df: pd.DataFrame, user_profile_df: pd.DataFrame) -
 def process_pr_data(out_df: pd.DataFrame, user_profile_df: pd.DataFrame) -> pd.DataFrame:
     pr_df = out_df[['PR_id', 'files', 'project', 'subject', 'owner_id']].drop_duplicates().set_index('PR_id')
 
-    pr_df['owner_profile'] = pr_df['owner_id'].apply(lambda x: user_profile_df.loc[x]['profile'])
+    pr_df['owner_profile'] = lookup(pr_df['owner_id'], user_profile_df['profile'])
 
-    for col in pr_df.columns.to_list():
-        try:
-            pr_df[col] = pr_df[col].apply(lambda x: 'None' if pd.isna(x) else x)
-        except:
-            continue
+    pr_df = fill_na(pr_df)
 
-    input_variables = pr_df.columns.to_list()
-    template = PromptTemplate(
-        template='PR Subject: {subject}, Project: {project}, Files: {files}, PR Contributor Info: [{owner_profile}]',
-        input_variables=input_variables,
-    )
-    pr_df['PR_info'] = pr_df[input_variables].apply(lambda x: template.format(**x), axis=1)
+    template = 'PR Subject: {subject}, Project: {project}, Files: {files}, PR Contributor Info: [{owner_profile}]'
+    pr_df['PR_info'] = format_columns(template, pr_df)
 
     return pr_df
 
 
+def add_candidates(df: pd.DataFrame, pr_df: pd.DataFrame) -> None:
+    # 添加PR信息
+    df['PR_info'] = lookup(df['PR_id'], pr_df['PR_info'])
+    # candidates id     由当前评审人与负采样评审人组成
+    candidates = np.column_stack([df['reviewer_id'].to_numpy(), np.array(df['n_reviewer_id'].tolist(), dtype=np.int64).reshape(len(df), -1)])
+    # shuffle candidates id. Every list is shuffled by a generator seeded with 41, so they all get the same permutation
+    perm = np.random.default_rng(seed=41).permutation(candidates.shape[1])
+    df['candidate_reviewer_id'] = candidates[:, perm].tolist()
+    # replace empty string with 'None'
+    for col in df.columns.to_list():
+        if df[col].dtype == object or pd.api.types.is_string_dtype(df[col]):
+            df[col] = df[col].mask(df[col].eq(''), 'None')
+
 
-def process_data(dir: str, n_neg_pr: int = 9):
+def process_data(dir: str, n_neg_pr: int = 9, neg_pool_by: Optional[str] = None):
     """Process the amazon raw data and output the processed data to `dir`.
 
     Args:
         `dir (str)`: the directory of the dataset, e.g. `'data/Beauty'`. The raw dataset will be downloaded into `'{dir}/raw_data'` if not exists. We supppose the base name of dir is the category name.
+        `n_neg_pr (int)`: the number of negative reviewers of each interaction.
+        `neg_pool_by (Optional[str])`: draw the negative reviewers from the reviewers of the same group of this column, e.g. `'project_parent'`. Draw from all reviewers if `None`.
     """
     raw_dir = os.path.join(dir, 'raw_data_fused')
-    data_df, user_profile_df = read_data(raw_dir)
+    user_profile_df = read_user_profile(raw_dir)
+    # 逐块展开交互数据, 临时存储到 temp/out.csv
+    out_path = os.path.join(dir, 'temp', 'out.csv')
+    write_interactions(raw_dir, out_path)
 
     # train_df + test_df + dev_df = out_df
-    train_df, dev_df, test_df, out_df = process_interaction_data(data_df, n_neg_pr, user_profile_df)  # 处理交互数据
+    train_df, dev_df, test_df, out_df = process_interaction_data(out_path, n_neg_pr, user_profile_df, neg_pool_by)  # 处理交互数据
     logger.info(f'Number of interactions: {out_df.shape[0]}')
 
     pr_df = process_pr_data(out_df, user_profile_df)
@@ -180,20 +380,7 @@ def process_data(dir: str, n_neg_pr: int = 9):
 
     # 添加 history历史购买商品信息 + candidate可买商品信息 + 当前商品信息 + 用户信息(无)
     for df in dfs:
-        # 添加PR信息
-        df['PR_info'] = df['PR_id'].apply(lambda x: pr_df.loc[x]['PR_info'])
-        # candidates id     由当前评审人与负采样评审人组成
-        df['candidate_reviewer_id'] = df.apply(lambda x: [x['reviewer_id']]+x['n_reviewer_id'], axis = 1)
-        def shuffle_list(x):
-            np.random.default_rng(seed=41).shuffle(x)
-            return x
-        df['candidate_reviewer_id'] = df['candidate_reviewer_id'].apply(lambda x: shuffle_list(x))  # shuffle candidates id
-        # replace empty string with 'None'
-        for col in df.columns.to_list():
-            try:
-                df[col] = df[col].apply(lambda x: 'None' if x == '' else x)
-            except:
-                continue
+        add_candidates(df, pr_df)
 
     train_df = dfs[0]
     dev_df = dfs[1]
@@ -206,12 +393,96 @@ def process_data(dir: str, n_neg_pr: int = 9):
     dev_df = dev_df.sample(frac=1, random_state=41)   # 打乱顺序 不按时间顺序
     pr_df.to_csv(os.path.join(dir, 'pullrequest.csv'))
     reviewer_df.to_csv(os.path.join(dir, 'reviewer.csv'))
-    # all_user_df.to_csv(os.path.join(dir, 'all_user.csv'))
+    all_user_df.to_csv(os.path.join(dir, 'all_user.csv'))
     train_df.to_csv(os.path.join(dir, 'train.csv'), index=False)
     dev_df.to_csv(os.path.join(dir, 'dev.csv'), index=False)
     test_df.to_csv(os.path.join(dir, 'test.csv'), index=False)
     all_df.to_csv(os.path.join(dir, 'all.csv'), index=False)
+    convert_to_columnar(dir)
+
+
+def append_csv(df: pd.DataFrame, path: str, index: bool = False) -> None:
+    """Append rows to a CSV file written by `to_csv`, in the column order of its header."""
+    columns = pd.read_csv(path, nrows=0, index_col=0 if index else None).columns.to_list()
+    assert set(columns) == set(df.columns), f'Columns {sorted(df.columns)} do not match the columns of {path}.'
+    df[columns].to_csv(path, mode='a', header=False, index=index)
+
+
+def load_user_ids(dir: str) -> dict:
+    """Load the id of each user name assigned by `process_data` from `all_user.csv`, or from `all.csv` for datasets processed without it."""
+    user_path = os.path.join(dir, 'all_user.csv')
+    if os.path.exists(user_path):
+        users = pd.read_csv(user_path)
+        return dict(zip(users['name'], users['id']))
+    all_df = pd.read_csv(os.path.join(dir, 'all.csv'), usecols=['reviewer_id', 'reviewer_name', 'owner_id', 'owner_name'])
+    return {**dict(zip(all_df['owner_name'], all_df['owner_id'])), **dict(zip(all_df['reviewer_name'], all_df['reviewer_id']))}
+
+
+def update_data(dir: str, delta_dir: str, n_neg_pr: int = 9, neg_pool_by: Optional[str] = None) -> pd.DataFrame:
+    """Add newly arrived raw data to a dataset processed by `process_data`, without processing the old data again. PRs whose `changeId` is already in `all.csv` are skipped. New PRs and new users get ids after the largest existing ones, so existing ids stay the same. Negative reviewers are only sampled for the new interactions, drawing from the old and new reviewers. The new rows are appended to `all.csv`, `train.csv`, `pullrequest.csv`, `reviewer.csv` and `all_user.csv` and to the columnar tables. `dev.csv` and `test.csv` are left as they are.
+
+    Args:
+        `dir` (`str`): The directory of the processed dataset, e.g. `'data/revfinder'`.
+        `delta_dir` (`str`): The directory of the new raw data, laid out like `'{dir}/raw_data_fused'`. Its user profile table is keyed by user `name` instead of `id`, as the ids of new users are only assigned here, and must cover every user of the new data.
+        `n_neg_pr` (`int`): The number of negative reviewers of each interaction.
+        `neg_pool_by` (`Optional[str]`): draw the negative reviewers from the reviewers of the same group of this column, e.g. `'project_parent'`. Draw from all reviewers if `None`.
+    Returns:
+        `pd.DataFrame`: The new interactions, e.g. for `InteractionRetriever.extend`.
+    """
+    data_df = read_prs(delta_dir)
+    profiles = pd.read_csv(os.path.join(delta_dir, 'user_info', 'user_profile_no_nationality.csv'))
+    assert 'name' in profiles.columns, 'The user profile table of the new data must have a name column.'
+    profiles = profiles.drop_duplicates(subset=['name'], keep='last').set_index('name')['profile']
+    known = pd.read_csv(os.path.join(dir, 'all.csv'), usecols=['PR_id', 'changeId', 'reviewer_id'] + ([neg_pool_by] if neg_pool_by is not None else []))
+    data_df = data_df[~data_df['changeId'].isin(known['changeId'])].reset_index(drop=True)
+    data_df['PR_id'] = int(known['PR_id'].max()) + 1 + np.arange(len(data_df))
+    out_df = expand_interactions(data_df)
+    logger.info(f'Number of new interactions: {out_df.shape[0]}')
+    if len(out_df) == 0:
+        return out_df
+
+    known_ids = load_user_ids(dir)
+    r2name = extend_reindex(known_ids, out_df)
+    out_df['reviewer_id'] = out_df['reviewer_name'].map(r2name)
+    out_df['owner_id'] = out_df['owner_name'].map(r2name)
+    # Profiles by the ids just assigned
+    names = pd.concat([out_df['reviewer_name'], out_df['owner_name']]).drop_duplicates()
+    user_profile_df = pd.DataFrame({'profile': lookup(names, profiles).to_numpy()}, index=pd.Index(names.map(r2name).to_numpy(), name='id'))
+    out_df['reviewer_profile'] = lookup(out_df['reviewer_id'], user_profile_df['profile'])
+    out_df['owner_profile'] = lookup(out_df['owner_id'], user_profile_df['profile'])
+    out_df['n_reviewer_id'] = negative_sample(out_df, n_neg_pr, pool_by=neg_pool_by, known=known.drop(columns=['PR_id', 'changeId']).drop_duplicates())
+
+    pr_df = process_pr_data(out_df, user_profile_df)
+    logger.info(f"Number of new pullrequest: {out_df['PR_id'].nunique()}")
+    reviewer_df, all_user_df = process_reviewer_data(out_df, user_profile_df)
+    old_reviewer_df = pd.read_csv(os.path.join(dir, 'reviewer.csv'), usecols=['reviewer_id', 'reviewer_name', 'project_parent'])
+    is_new = ~pd.MultiIndex.from_frame(reviewer_df.reset_index()[old_reviewer_df.columns]).isin(pd.MultiIndex.from_frame(old_reviewer_df))
+    reviewer_df = reviewer_df[is_new]
+    all_user_df = all_user_df[~all_user_df.index.isin(list(known_ids.values()))]
+    logger.info(f'Number of new reviewers: {len(reviewer_df)}, new users: {len(all_user_df)}')
+
+    add_candidates(out_df, pr_df)
+    out_df = out_df.sort_values(by=['submit_time'], kind='mergesort').reset_index(drop=True)
+    logger.info('Output data')
+    append_csv(pr_df, os.path.join(dir, 'pullrequest.csv'), index=True)
+    append_csv(reviewer_df, os.path.join(dir, 'reviewer.csv'), index=True)
+    if os.path.exists(os.path.join(dir, 'all_user.csv')):
+        append_csv(all_user_df, os.path.join(dir, 'all_user.csv'), index=True)
+    else:
+        pd.DataFrame({'id': list(r2name.values()), 'name': list(r2name.keys())}).set_index('id').sort_index().to_csv(os.path.join(dir, 'all_user.csv'))
+    append_csv(out_df, os.path.join(dir, 'train.csv'))
+    append_csv(out_df, os.path.join(dir, 'all.csv'))
+    if os.path.exists(os.path.join(dir, 'columnar')):
+        append_to_columnar(dir, out_df, pr_df, reviewer_df)
+    return out_df
 
 
 if __name__ == "__main__":
-    process_data(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'data', 'revfinder'), 6)
+    parser = argparse.ArgumentParser(description='Process the revfinder raw data.')
+    parser.add_argument('--update', type=str, default=None, help='Directory of newly arrived raw data, laid out like raw_data_fused. Appends it to the processed dataset instead of processing all data again')
+    args = parser.parse_args()
+    dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'data', 'revfinder')
+    if args.update is None:
+        process_data(dir, 6)
+    else:
+        update_data(dir, args.update, 6)
@@ -1,4 +1,8 @@
 # Description: Package for large language models
+from core.llms.cache import LLMCache, CacheMode
+from core.llms.limiter import RateLimiter
 from core.llms.basellm import BaseLLM
+from core.llms.json_decoder import JsonGrammar, JsonDecoder
+from core.llms.pool import ModelPool, PooledModel, BatchScheduler, MODEL_POOL
 from core.llms.openai import AnyOpenAILLM
 from core.llms.opensource import OpenSourceLLM
\ No newline at end of file
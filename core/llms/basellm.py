@@ -1,6 +1,12 @@
+import asyncio
 from abc import ABC, abstractmethod
+from typing import Any, Optional
+
+from core.llms.cache import LLMCache
 
 class BaseLLM(ABC):
+    cache: Optional[LLMCache] = None
+
     def __init__(self) -> None:
         self.model_name: str
         self.max_tokens: int
@@ -16,10 +22,84 @@ class BaseLLM(ABC):
         """
         return self.max_context_length - 2 * self.max_tokens - 50 # single round need 2 agent prompt steps: thought and action
     
-    @abstractmethod
+    @property
+    def generation_params(self) -> dict[str, Any]:
+        """The generation parameters that affect the output of the LLM. Used as part of the cache key.
+
+        Returns:
+            `dict[str, Any]`: The generation parameters.
+        """
+        return {}
+
+    def register_prefix(self, prefix: str) -> None:
+        """Declare a static prefix shared by many prompts, e.g. the few-shot examples of an agent, so that LLMs able to reuse its encoding can cache it. Does nothing by default.
+
+        Args:
+            `prefix` (`str`): The prefix.
+        """
+        pass
+
+    def close(self) -> None:
+        """Give back the shared resources of the LLM, e.g. its model in the `MODEL_POOL`. The LLM must not be used afterwards. Does nothing by default.
+        """
+        pass
+
+    def set_cache(self, cache_config: Optional[dict]) -> None:
+        """Enable the on-disk response cache of the LLM. LLMs with the same cache path and mode share one cache.
+
+        Args:
+            `cache_config` (`Optional[dict]`): The keyword arguments of `LLMCache.get`. The cache is disabled if `None`.
+        """
+        self.cache = LLMCache.get(**cache_config) if cache_config is not None else None
+
     def __call__(self, prompt: str, *args, **kwargs) -> str:
-        """Forward pass of the LLM.
-        
+        """Forward pass of the LLM. Responses are served from and stored to the cache if it is enabled.
+
+        Args:
+            `prompt` (`str`): The prompt to feed into the LLM.
+        Returns:
+            `str`: The LLM output.
+        """
+        if self.cache is None:
+            return self.generate(prompt, *args, **kwargs)
+        key = LLMCache.make_key(self.model_name, self.generation_params, self.json_mode, prompt)
+        output = self.cache.lookup(key)
+        if output is None:
+            output = self.generate(prompt, *args, **kwargs)
+            self.cache.store(key, self.model_name, output)
+        return output
+
+    async def acall(self, prompt: str, *args, **kwargs) -> str:
+        """Asynchronous forward pass of the LLM. Responses are served from and stored to the cache if it is enabled.
+
+        Args:
+            `prompt` (`str`): The prompt to feed into the LLM.
+        Returns:
+            `str`: The LLM output.
+        """
+        if self.cache is None:
+            return await self.agenerate(prompt, *args, **kwargs)
+        key = LLMCache.make_key(self.model_name, self.generation_params, self.json_mode, prompt)
+        output = self.cache.lookup(key)
+        if output is None:
+            output = await self.agenerate(prompt, *args, **kwargs)
+            self.cache.store(key, self.model_name, output)
+        return output
+
+    async def agenerate(self, prompt: str, *args, **kwargs) -> str:
+        """Generate the output of the LLM asynchronously without the cache. Runs `generate` in a worker thread by default. Subclasses with a native asynchronous client should override it.
+
+        Args:
+            `prompt` (`str`): The prompt to feed into the LLM.
+        Returns:
+            `str`: The LLM output.
+        """
+        return await asyncio.to_thread(self.generate, prompt, *args, **kwargs)
+
+    @abstractmethod
+    def generate(self, prompt: str, *args, **kwargs) -> str:
+        """Generate the output of the LLM without the cache.
+
         Args:
             `prompt` (`str`): The prompt to feed into the LLM.
         Raises:
@@ -27,4 +107,4 @@ class BaseLLM(ABC):
         Returns:
             `str`: The LLM output.
         """
-        raise NotImplementedError("BaseLLM.__call__() not implemented")
\ No newline at end of file
+        raise NotImplementedError("BaseLLM.generate() not implemented")
\ No newline at end of file
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from enum import Enum
+from typing import Any, Optional
+from loguru import logger
+
+class CacheMode(Enum):
+    """
+    Modes of the `LLMCache`. `RECORD` looks up stored responses and stores new ones. `READ_ONLY` looks up stored responses but never writes. `REFRESH` ignores stored responses and overwrites them with new ones.
+    """
+    RECORD = 'record'
+    READ_ONLY = 'read_only'
+    REFRESH = 'refresh'
+
+class LLMCache:
+    """
+    A persistent, content-addressed cache of LLM responses backed by SQLite. Entries are keyed by the model name, the generation parameters, the JSON mode and the hash of the prompt. Caches are shared by path and mode in the process, use `LLMCache.get` to obtain one. Use `lookup` and `store` to access the cache, and `report` to log the hit/miss counters.
+    """
+    _instances: dict[tuple[str, CacheMode], 'LLMCache'] = {}
+    _pruned: set[str] = set()
+    _instances_lock = threading.Lock()
+
+    def __init__(self, path: str = 'cache/llm.sqlite', mode: str = CacheMode.RECORD.value, max_entries: Optional[int] = None, max_age: Optional[float] = None, prune_every: int = 1000) -> None:
+        """Initialize the cache.
+
+        Args:
+            `path` (`str`, optional): The path to the SQLite database. Defaults to `'cache/llm.sqlite'`.
+            `mode` (`str`, optional): The cache mode, one of `record`, `read_only` and `refresh`. Defaults to `record`.
+            `max_entries` (`Optional[int]`, optional): Maximum number of entries in the database. Least recently used entries are evicted first. Defaults to `None` (unbounded).
+            `max_age` (`Optional[float]`, optional): Maximum age of an entry in seconds. Older entries are treated as misses and evicted. Defaults to `None` (never expire).
+            `prune_every` (`int`, optional): Run the eviction every `prune_every` writes. Defaults to `1000`.
+        """
+        self.path = path
+        self.mode = CacheMode(mode)
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.prune_every = prune_every
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, response TEXT, created REAL, accessed REAL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+            self._conn.commit()
+        logger.info(f'LLM cache enabled at {path} in {self.mode.value} mode.')
+
+    @classmethod
+    def get(cls, path: str = 'cache/llm.sqlite', mode: str = CacheMode.RECORD.value, **kwargs) -> 'LLMCache':
+        """Get the shared cache of a database and mode, creating it on first use. The database is pruned once per process, by the first cache that may write to it.
+
+        Args:
+            `path` (`str`, optional): The path to the SQLite database. Defaults to `'cache/llm.sqlite'`.
+            `mode` (`str`, optional): The cache mode. Defaults to `record`.
+        Returns:
+            `LLMCache`: The shared cache. The other arguments of `LLMCache` are only used when it is created.
+        """
+        key = os.path.abspath(path), CacheMode(mode)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cache = cls(path, mode, **kwargs)
+                if cache.mode != CacheMode.READ_ONLY and key[0] not in cls._pruned:
+                    cache.prune()
+                    cls._pruned.add(key[0])
+                cls._instances[key] = cache
+            else:
+                cache = cls._instances[key]
+                settings = {name: getattr(cache, name) for name in kwargs}
+                if settings != kwargs:
+                    logger.warning(f'LLM cache {path} ({cache.mode.value}) already opened with {settings}, ignoring {kwargs}.')
+            return cache
+
+    @staticmethod
+    def make_key(model_name: str, params: dict[str, Any], json_mode: bool, prompt: str) -> str:
+        """Make the cache key of an LLM call.
+
+        Args:
+            `model_name` (`str`): The name of the model.
+            `params` (`dict[str, Any]`): The generation parameters.
+            `json_mode` (`bool`): Whether the JSON mode is enabled.
+            `prompt` (`str`): The prompt.
+        Returns:
+            `str`: The hex digest of the key.
+        """
+        content = json.dumps({
+            'model': model_name,
+            'params': params,
+            'json_mode': json_mode,
+            'prompt': hashlib.sha256(prompt.encode('utf-8')).hexdigest(),
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def lookup(self, key: str) -> Optional[str]:
+        """Look up a stored response. Always misses in `refresh` mode.
+
+        Args:
+            `key` (`str`): The cache key from `make_key`.
+        Returns:
+            `Optional[str]`: The stored response, or `None` on a miss.
+        """
+        if self.mode == CacheMode.REFRESH:
+            with self._lock:
+                self.misses += 1
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT response, created FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None and self.max_age is not None and now - row[1] > self.max_age:
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self.mode != CacheMode.READ_ONLY:
+                self._conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+                self._conn.commit()
+        return row[0]
+
+    def store(self, key: str, model_name: str, response: str) -> None:
+        """Store a response. Does nothing in `read_only` mode.
+
+        Args:
+            `key` (`str`): The cache key from `make_key`.
+            `model_name` (`str`): The name of the model, kept for inspection.
+            `response` (`str`): The response to store.
+        """
+        if self.mode == CacheMode.READ_ONLY:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO responses (key, model, response, created, accessed) VALUES (?, ?, ?, ?, ?)', (key, model_name, response, now, now))
+            self._conn.commit()
+            self.writes += 1
+            prune = self.writes % self.prune_every == 0
+        if prune:
+            self.prune()
+
+    def prune(self) -> None:
+        """Evict expired entries and, if the database holds more than `max_entries` entries, the least recently used ones."""
+        with self._lock:
+            if self.max_age is not None:
+                self._conn.execute('DELETE FROM responses WHERE created < ?', (time.time() - self.max_age,))
+            if self.max_entries is not None:
+                self._conn.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+            self._conn.commit()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def report(self) -> None:
+        """Log the hit/miss counters of the cache."""
+        logger.success(f'LLM cache {self.path} ({self.mode.value}): {self.hits} hits, {self.misses} misses, hit rate {self.hit_rate:.4f}')
+
+    @classmethod
+    def report_all(cls) -> None:
+        """Log the hit/miss counters of all shared caches."""
+        with cls._instances_lock:
+            caches = list(cls._instances.values())
+        for cache in caches:
+            cache.report()
@@ -0,0 +1,303 @@
+import json
+import numpy as np
+import torch
+from typing import Optional
+from loguru import logger
+from transformers import LogitsProcessor, PreTrainedTokenizerBase
+
+class TokenTrie:
+    """
+    A character trie over the text of every token of a tokenizer. Walking it along a character automaton finds all tokens the automaton accepts from a state at once, and a branch is dropped at the first character the automaton rejects. Special tokens and tokens that do not decode to whole characters are left out.
+    """
+    def __init__(self, tokenizer: PreTrainedTokenizerBase) -> None:
+        """Build the trie.
+
+        Args:
+            `tokenizer` (`PreTrainedTokenizerBase`): The tokenizer.
+        """
+        self.eos_token_id: Optional[int] = tokenizer.eos_token_id
+        # A node is [children, token ids ending here]
+        self.root: list = [{}, []]
+        special = set(tokenizer.all_special_ids)
+        # Decoding a token after a fixed one keeps its leading space, which is dropped when it is decoded alone
+        base_id = tokenizer.encode('a', add_special_tokens=False)[-1]
+        base = tokenizer.decode([base_id], clean_up_tokenization_spaces=False)
+        n_tokens = 0
+        for token_id in range(len(tokenizer)):
+            if token_id in special:
+                continue
+            text = tokenizer.decode([base_id, token_id], clean_up_tokenization_spaces=False)
+            if not text.startswith(base) or len(text) == len(base) or '�' in text:
+                continue
+            node = self.root
+            for ch in text[len(base):]:
+                if ch not in node[0]:
+                    node[0][ch] = [{}, []]
+                node = node[0][ch]
+            node[1].append(token_id)
+            n_tokens += 1
+        logger.debug(f'Built the token trie with {n_tokens} tokens')
+
+class JsonGrammar:
+    """
+    A character automaton accepting the JSON values of a schema, written with `json.dumps` separators (`', '` and `': '`) and the object properties in schema order. Supports objects, arrays, strings, numbers, integers, booleans, null, `enum` and `const`. The automaton has no stack: nested values are compiled in place, each one continuing to the state after it.
+
+    A state has literal transitions, an optional default transition taken by any other printable character (inside strings), and an optional epsilon transition tried when neither applies (at the end of numbers, which end at the next character that is not part of them). State `0` is the final state.
+    """
+    FINAL = 0
+    DIGITS = '0123456789'
+
+    def __init__(self, json_schema: dict) -> None:
+        """Compile the schema.
+
+        Args:
+            `json_schema` (`dict`): The JSON schema.
+        Raises:
+            `NotImplementedError`: If the schema uses unsupported keywords, e.g. a list of types or `anyOf`.
+        """
+        self.literal: list[dict[str, int]] = []
+        self.default: list[Optional[int]] = []
+        self.epsilon: list[Optional[int]] = []
+        final = self._new()
+        assert final == self.FINAL
+        self.start = self._value(json_schema, final)
+        self.dist = self._distances()
+
+    def _new(self) -> int:
+        self.literal.append({})
+        self.default.append(None)
+        self.epsilon.append(None)
+        return len(self.literal) - 1
+
+    def _text(self, text: str, next: int) -> int:
+        for ch in reversed(text):
+            state = self._new()
+            self.literal[state][ch] = next
+            next = state
+        return next
+
+    def _choices(self, texts: list[str], next: int) -> int:
+        root = self._new()
+        for text in texts:
+            state = root
+            for ch in text:
+                if ch not in self.literal[state]:
+                    self.literal[state][ch] = self._new()
+                state = self.literal[state][ch]
+            self.epsilon[state] = next
+        return root
+
+    def _digits(self, state: int, next: int) -> None:
+        for ch in self.DIGITS:
+            self.literal[state][ch] = next
+
+    def _number(self, next: int, integer: bool) -> int:
+        end = next
+        if not integer:
+            exp_start, exp_sign, exp_digits = self._new(), self._new(), self._new()
+            self.literal[exp_start]['+'] = self.literal[exp_start]['-'] = exp_sign
+            self._digits(exp_start, exp_digits)
+            self._digits(exp_sign, exp_digits)
+            self._digits(exp_digits, exp_digits)
+            self.epsilon[exp_digits] = next
+            frac_start, frac_digits = self._new(), self._new()
+            self._digits(frac_start, frac_digits)
+            self._digits(frac_digits, frac_digits)
+            self.literal[frac_digits]['e'] = self.literal[frac_digits]['E'] = exp_start
+            self.epsilon[frac_digits] = next
+            end = self._new()
+            self.literal[end]['.'] = frac_start
+            self.literal[end]['e'] = self.literal[end]['E'] = exp_start
+            self.epsilon[end] = next
+        int_start, int_zero, int_digits = self._new(), self._new(), self._new()
+        self.literal[int_start]['0'] = int_zero
+        for ch in self.DIGITS[1:]:
+            self.literal[int_start][ch] = int_digits
+        self._digits(int_digits, int_digits)
+        self.epsilon[int_zero] = self.epsilon[int_digits] = end
+        sign = self._new()
+        self.literal[sign]['-'] = int_start
+        self.epsilon[sign] = int_start
+        return sign
+
+    def _string(self, next: int) -> int:
+        inside, escape = self._new(), self._new()
+        self.literal[inside]['"'] = next
+        self.literal[inside]['\\'] = escape
+        self.default[inside] = inside
+        for ch in '"\\/bfnrt':
+            self.literal[escape][ch] = inside
+        state = inside
+        for _ in range(4):
+            hex_state = self._new()
+            for ch in '0123456789abcdefABCDEF':
+                self.literal[hex_state][ch] = state
+            state = hex_state
+        self.literal[escape]['u'] = state
+        return self._text('"', inside)
+
+    def _value(self, schema: dict, next: int) -> int:
+        if 'enum' in schema or 'const' in schema:
+            values = schema['enum'] if 'enum' in schema else [schema['const']]
+            return self._choices([json.dumps(value, ensure_ascii=False) for value in values], next)
+        type = schema.get('type', None)
+        if type == 'object':
+            properties: dict[str, dict] = schema.get('properties', {})
+            state = self._text('}', next)
+            for i, (name, property) in reversed(list(enumerate(properties.items()))):
+                state = self._text(('{' if i == 0 else ', ') + json.dumps(name, ensure_ascii=False) + ': ', self._value(property, state))
+            return state if len(properties) > 0 else self._text('{', state)
+        if type == 'array':
+            if 'items' not in schema:
+                raise NotImplementedError('Arrays without items are not supported.')
+            after = self._new()
+            item = self._value(schema['items'], after)
+            self.literal[after][','] = self._text(' ', item)
+            self.literal[after][']'] = next
+            opened = self._new()
+            self.literal[opened][']'] = next
+            self.epsilon[opened] = item
+            return self._text('[', opened)
+        if type == 'string':
+            return self._string(next)
+        if type in ['number', 'integer']:
+            return self._number(next, integer=type == 'integer')
+        if type == 'boolean':
+            return self._choices(['true', 'false'], next)
+        if type == 'null':
+            return self._text('null', next)
+        raise NotImplementedError(f'Schema not supported: {json.dumps(schema)}')
+
+    def _distances(self) -> list[float]:
+        # The fewest characters from each state to the final state
+        dist = [float('inf')] * len(self.literal)
+        dist[self.FINAL] = 0
+        changed = True
+        while changed:
+            changed = False
+            for state in range(len(self.literal)):
+                targets = [dist[target] + 1 for target in self.literal[state].values()]
+                if self.default[state] is not None:
+                    targets.append(dist[self.default[state]] + 1)
+                if self.epsilon[state] is not None:
+                    targets.append(dist[self.epsilon[state]])
+                best = min(targets, default=float('inf'))
+                if best < dist[state]:
+                    dist[state] = best
+                    changed = True
+        return dist
+
+    def step(self, state: int, ch: str) -> Optional[int]:
+        """Get the state after a character.
+
+        Args:
+            `state` (`int`): The current state.
+            `ch` (`str`): The character.
+        Returns:
+            `Optional[int]`: The next state, or `None` if the character is rejected.
+        """
+        while state is not None:
+            next = self.literal[state].get(ch, None)
+            if next is not None:
+                return next
+            if self.default[state] is not None and ch >= ' ':
+                return self.default[state]
+            state = self.epsilon[state]
+        return None
+
+    def accepting(self, state: int) -> bool:
+        """Whether the text read so far is a complete value."""
+        while state is not None:
+            if state == self.FINAL:
+                return True
+            state = self.epsilon[state]
+        return False
+
+class JsonDecoder:
+    """
+    A JSON-schema constrained decoder. The schema is compiled once into a `JsonGrammar`, and the tokens allowed from each state of the grammar are found by walking a `TokenTrie` and cached, so the grammar becomes a token-level state machine built as it is used. Generation with `processor` masks the logits of the tokens that would break the schema, in a single `generate` pass. Values are closed in time: a token is only allowed if the shortest completion after it, one token per character, still fits in the remaining new tokens.
+    """
+    def __init__(self, json_schema: dict, trie: TokenTrie) -> None:
+        """Compile the schema.
+
+        Args:
+            `json_schema` (`dict`): The JSON schema.
+            `trie` (`TokenTrie`): The token trie of the tokenizer.
+        Raises:
+            `NotImplementedError`: If the schema is not supported by `JsonGrammar`.
+        """
+        self.grammar = JsonGrammar(json_schema)
+        self.trie = trie
+        self._transitions: dict[int, tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+
+    def transitions(self, state: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Get the tokens accepted from a state.
+
+        Args:
+            `state` (`int`): The grammar state.
+        Returns:
+            `tuple[np.ndarray, np.ndarray, np.ndarray]`: The sorted token ids, the state after each token and the distance of that state to the end of the value.
+        """
+        if state not in self._transitions:
+            allowed: dict[int, int] = {}
+            stack = [(self.trie.root, state)]
+            while len(stack) > 0:
+                node, node_state = stack.pop()
+                for ch, child in node[0].items():
+                    next = self.grammar.step(node_state, ch)
+                    if next is None:
+                        continue
+                    for token_id in child[1]:
+                        allowed[token_id] = next
+                    stack.append((child, next))
+            ids = np.array(sorted(allowed), dtype=np.int64)
+            states = np.array([allowed[token_id] for token_id in ids.tolist()], dtype=np.int64)
+            dists = np.array([self.grammar.dist[next] for next in states.tolist()], dtype=float)
+            self._transitions[state] = (ids, states, dists)
+        return self._transitions[state]
+
+    def processor(self, prompt_length: int, max_new_tokens: int) -> 'JsonLogitsProcessor':
+        """Get a logits processor for one generation.
+
+        Args:
+            `prompt_length` (`int`): The number of tokens of the prompt.
+            `max_new_tokens` (`int`): The maximum number of new tokens of the generation.
+        Returns:
+            `JsonLogitsProcessor`: The processor.
+        """
+        return JsonLogitsProcessor(self, prompt_length, max_new_tokens)
+
+class JsonLogitsProcessor(LogitsProcessor):
+    """
+    Masks the logits of the tokens not allowed by a `JsonDecoder` from the current state, which follows the generated tokens. Only supports a batch of one sequence. The end of sequence token is only allowed once the value is complete.
+    """
+    def __init__(self, decoder: JsonDecoder, prompt_length: int, max_new_tokens: int) -> None:
+        self.decoder = decoder
+        self.prompt_length = prompt_length
+        self.max_new_tokens = max_new_tokens
+        self.state: Optional[int] = decoder.grammar.start
+        self._allowed: tuple[np.ndarray, np.ndarray] = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+    def _advance(self, token_id: int) -> None:
+        ids, states = self._allowed
+        i = int(np.searchsorted(ids, token_id))
+        self.state = int(states[i]) if i < len(ids) and ids[i] == token_id else None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        assert input_ids.shape[0] == 1, 'JsonLogitsProcessor only supports a batch of one sequence.'
+        generated = input_ids.shape[1] - self.prompt_length
+        if generated > 0:
+            self._advance(int(input_ids[0, -1]))
+        mask = torch.full_like(scores, float('-inf'))
+        eos_token_id = self.decoder.trie.eos_token_id
+        if self.state is None:
+            self._allowed = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        else:
+            ids, states, dists = self.decoder.transitions(self.state)
+            keep = dists <= self.max_new_tokens - generated - 1
+            self._allowed = (ids[keep], states[keep])
+            mask[:, torch.from_numpy(self._allowed[0]).to(scores.device)] = 0
+        if eos_token_id is not None and (self.state is None or len(self._allowed[0]) == 0 or self.decoder.grammar.accepting(self.state)):
+            # Stop once the value is complete, or give up when it cannot be completed
+            mask[:, eos_token_id] = 0
+        return scores + mask
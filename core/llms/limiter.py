@@ -0,0 +1,226 @@
+import time
+import asyncio
+import threading
+import tiktoken
+from typing import Any, Callable, Optional
+from loguru import logger
+from openai import RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+from tenacity import Retrying, AsyncRetrying, RetryCallState, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+TRANSIENT_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+class TokenBucket:
+    """
+    A token bucket refilled at a constant rate. Reservations may take the bucket below zero, so callers are served in the order they reserve and each one only waits for its own share.
+    """
+    def __init__(self, capacity: float, rate: float) -> None:
+        """Initialize a full bucket.
+
+        Args:
+            `capacity` (`float`): The maximum number of tokens in the bucket.
+            `rate` (`float`): The number of tokens added per second.
+        """
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float) -> float:
+        """Take `amount` tokens from the bucket. Not thread-safe, the caller should hold a lock.
+
+        Args:
+            `amount` (`float`): The number of tokens to take. Capped at the capacity, so oversized requests still go through once the bucket is full.
+        Returns:
+            `float`: The seconds to wait before the tokens are available.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= min(amount, self.capacity)
+        return max(0.0, -self.tokens / self.rate)
+
+class RateLimiter:
+    """
+    A client-side limiter of the requests and tokens per minute sent to one model, with jittered exponential retry on transient API errors. Limiters are shared by all LLMs of the same model in the process, use `RateLimiter.get` to obtain one. Use `call` and `acall` to run a request under the limiter, and `report` to log its statistics.
+    """
+    _instances: dict[str, 'RateLimiter'] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, model_name: str, rpm: Optional[int] = None, tpm: Optional[int] = None, max_attempts: int = 6, min_wait: float = 1, max_wait: float = 60) -> None:
+        """Initialize the limiter.
+
+        Args:
+            `model_name` (`str`): The name of the model. Used to pick the tokenizer of the token estimates.
+            `rpm` (`Optional[int]`, optional): Maximum requests per minute. Defaults to `None` (unlimited).
+            `tpm` (`Optional[int]`, optional): Maximum tokens per minute, counting the prompt and the completion budget. Defaults to `None` (unlimited).
+            `max_attempts` (`int`, optional): Maximum attempts of a request, including the first one. Defaults to `6`.
+            `min_wait` (`float`, optional): Minimum backoff in seconds. Defaults to `1`.
+            `max_wait` (`float`, optional): Maximum backoff in seconds. Defaults to `60`.
+        """
+        self.model_name = model_name
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_attempts = max_attempts
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.request_bucket = TokenBucket(rpm, rpm / 60) if rpm is not None else None
+        self.token_bucket = TokenBucket(tpm, tpm / 60) if tpm is not None else None
+        self._encoding: Optional[tiktoken.Encoding] = None
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.wait_time = 0.0
+        self.backoff_time = 0.0
+
+    @classmethod
+    def get(cls, model_name: str, **kwargs) -> 'RateLimiter':
+        """Get the shared limiter of a model, creating it on first use. Later calls with different limits keep the first ones.
+
+        Args:
+            `model_name` (`str`): The name of the model.
+        Returns:
+            `RateLimiter`: The shared limiter.
+        """
+        with cls._instances_lock:
+            if model_name not in cls._instances:
+                cls._instances[model_name] = cls(model_name, **kwargs)
+            limiter = cls._instances[model_name]
+        if kwargs.get('rpm', limiter.rpm) != limiter.rpm or kwargs.get('tpm', limiter.tpm) != limiter.tpm:
+            logger.warning(f'Rate limits of {model_name} are already set to {limiter.rpm} rpm and {limiter.tpm} tpm. Ignoring the new limits.')
+        return limiter
+
+    @property
+    def encoding(self) -> tiktoken.Encoding:
+        if self._encoding is None:
+            try:
+                self._encoding = tiktoken.encoding_for_model(self.model_name)
+            except KeyError:
+                self._encoding = tiktoken.get_encoding('cl100k_base')
+        return self._encoding
+
+    def estimate_tokens(self, prompt: str, max_tokens: int = 0) -> int:
+        """Estimate the tokens a request counts against the tokens per minute. Returns `0` without tokenizing if there is no tokens per minute limit.
+
+        Args:
+            `prompt` (`str`): The prompt of the request.
+            `max_tokens` (`int`, optional): The completion budget of the request. Defaults to `0`.
+        Returns:
+            `int`: The estimated number of tokens.
+        """
+        if self.token_bucket is None:
+            return 0
+        return len(self.encoding.encode(prompt, disallowed_special=())) + max_tokens
+
+    def _reserve(self, tokens: int) -> float:
+        with self._lock:
+            wait = 0.0
+            if self.request_bucket is not None:
+                wait = max(wait, self.request_bucket.reserve(1))
+            if self.token_bucket is not None:
+                wait = max(wait, self.token_bucket.reserve(tokens))
+            self.requests += 1
+            self.wait_time += wait
+            if wait > 0:
+                self.queue_depth += 1
+                self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            return wait
+
+    def _leave_queue(self) -> None:
+        with self._lock:
+            self.queue_depth -= 1
+
+    def _before_sleep(self, retry_state: RetryCallState) -> None:
+        with self._lock:
+            self.retries += 1
+            self.backoff_time += retry_state.next_action.sleep
+        logger.warning(f'{self.model_name} request failed with {type(retry_state.outcome.exception()).__name__}. Retrying in {retry_state.next_action.sleep:.1f}s (attempt {retry_state.attempt_number}/{self.max_attempts}).')
+
+    def _retry_kwargs(self) -> dict[str, Any]:
+        return {
+            'retry': retry_if_exception_type(TRANSIENT_ERRORS),
+            'wait': wait_random_exponential(min=self.min_wait, max=self.max_wait),
+            'stop': stop_after_attempt(self.max_attempts),
+            'before_sleep': self._before_sleep,
+            'reraise': True,
+        }
+
+    def acquire(self, tokens: int) -> None:
+        """Block until a request of `tokens` tokens may be sent.
+
+        Args:
+            `tokens` (`int`): The estimated tokens of the request.
+        """
+        wait = self._reserve(tokens)
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            finally:
+                self._leave_queue()
+
+    async def aacquire(self, tokens: int) -> None:
+        """Asynchronous version of `acquire`.
+
+        Args:
+            `tokens` (`int`): The estimated tokens of the request.
+        """
+        wait = self._reserve(tokens)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self._leave_queue()
+
+    def call(self, fn: Callable[[], Any], tokens: int) -> Any:
+        """Run a request under the limiter, retrying on transient errors. Every attempt is counted against the limits.
+
+        Args:
+            `fn` (`Callable[[], Any]`): The request.
+            `tokens` (`int`): The estimated tokens of the request.
+        Returns:
+            `Any`: The result of the request.
+        """
+        try:
+            for attempt in Retrying(**self._retry_kwargs()):
+                with attempt:
+                    self.acquire(tokens)
+                    result = fn()
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            raise
+        return result
+
+    async def acall(self, fn: Callable[[], Any], tokens: int) -> Any:
+        """Asynchronous version of `call`.
+
+        Args:
+            `fn` (`Callable[[], Any]`): A function returning the awaitable of the request.
+            `tokens` (`int`): The estimated tokens of the request.
+        Returns:
+            `Any`: The result of the request.
+        """
+        try:
+            async for attempt in AsyncRetrying(**self._retry_kwargs()):
+                with attempt:
+                    await self.aacquire(tokens)
+                    result = await fn()
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            raise
+        return result
+
+    def report(self) -> None:
+        """Log the statistics of the limiter."""
+        logger.success(f'Rate limiter {self.model_name} (rpm={self.rpm}, tpm={self.tpm}): {self.requests} requests, {self.retries} retries, {self.failures} failures, max queue depth {self.max_queue_depth}, {self.wait_time:.1f}s waiting, {self.backoff_time:.1f}s backing off')
+
+    @classmethod
+    def report_all(cls) -> None:
+        """Log the statistics of all shared limiters."""
+        with cls._instances_lock:
+            limiters = list(cls._instances.values())
+        for limiter in limiters:
+            limiter.report()
@@ -1,16 +1,19 @@
+from typing import Any, Optional
 from loguru import logger
 from langchain_openai import ChatOpenAI, OpenAI
 from langchain.schema import HumanMessage
 
 from core.llms.basellm import BaseLLM
+from core.llms.limiter import RateLimiter
 
 class AnyOpenAILLM(BaseLLM):
-    def __init__(self, model_name: str = 'gpt-3.5-turbo', json_mode: bool = False, *args, **kwargs):
+    def __init__(self, model_name: str = 'gpt-3.5-turbo', json_mode: bool = False, rate_limit: Optional[dict] = None, *args, **kwargs):
         """Initialize the OpenAI LLM.
         
         Args:
             `model_name` (`str`, optional): The name of the OpenAI model. Defaults to `gpt-3.5-turbo`.
             `json_mode` (`bool`, optional): Whether to use the JSON mode of the OpenAI API. Defaults to `False`.
+            `rate_limit` (`Optional[dict]`, optional): The keyword arguments of the `RateLimiter` shared by all LLMs of this model, e.g. `rpm`, `tpm` and `max_attempts`. Requests are retried on transient errors even without it. Defaults to `None`.
         """
         self.model_name = model_name
         self.json_mode = json_mode
@@ -18,6 +21,10 @@ class AnyOpenAILLM(BaseLLM):
             raise ValueError("json_mode is only available for gpt-3.5-turbo-1106, gpt-4-1106-preview, gpt-4o-mini, gpt-4o-2024-08-06, o1-mini")
         self.max_tokens: int = kwargs.get('max_tokens', 256)
         self.max_context_length: int = 16384# if '16k' in model_name else 32768 if '32k' in model_name else 4096
+        self._generation_params = dict(kwargs)
+        self.limiter = RateLimiter.get(model_name, **(rate_limit or {}))
+        # Retries are handled by the limiter, so that backoff is shared and counted
+        kwargs.setdefault('max_retries', 0)
         if model_name.split('-')[0] == 'text' or model_name in ['gpt-3.5-turbo-instruct', "o1-mini"]:
             self.model = OpenAI(model_name=model_name, *args, **kwargs)
             self.model_type = 'completion'
@@ -39,7 +46,21 @@ class AnyOpenAILLM(BaseLLM):
             self.model = ChatOpenAI(model_name=model_name, *args, **kwargs)
             self.model_type = 'chat'
     
-    def __call__(self, prompt: str, *args, **kwargs) -> str:
+    @property
+    def generation_params(self) -> dict[str, Any]:
+        return self._generation_params
+
+    def _messages(self, prompt: str) -> str | list[HumanMessage]:
+        if self.model_type == 'completion':
+            return prompt
+        else:
+            return [
+                HumanMessage(
+                    content=prompt,
+                )
+            ]
+
+    def generate(self, prompt: str, *args, **kwargs) -> str:
         """Forward pass of the OpenAI LLM.
         
         Args:
@@ -47,13 +68,18 @@ class AnyOpenAILLM(BaseLLM):
         Returns:
             `str`: The OpenAI LLM output.
         """
-        if self.model_type == 'completion':
-            return self.model.invoke(prompt).content.replace('\n', ' ').strip()
-        else:
-            return self.model.invoke(
-                [
-                    HumanMessage(
-                        content=prompt,
-                    )
-                ]
-            ).content.replace('\n', ' ').strip()
\ No newline at end of file
+        tokens = self.limiter.estimate_tokens(prompt, self.max_tokens)
+        response = self.limiter.call(lambda: self.model.invoke(self._messages(prompt)), tokens)
+        return response.content.replace('\n', ' ').strip()
+
+    async def agenerate(self, prompt: str, *args, **kwargs) -> str:
+        """Asynchronous forward pass of the OpenAI LLM with the native asynchronous client.
+        
+        Args:
+            `prompt` (`str`): The prompt to feed into the LLM.
+        Returns:
+            `str`: The OpenAI LLM output.
+        """
+        tokens = self.limiter.estimate_tokens(prompt, self.max_tokens)
+        response = await self.limiter.acall(lambda: self.model.ainvoke(self._messages(prompt)), tokens)
+        return response.content.replace('\n', ' ').strip()
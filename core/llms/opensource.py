@@ -1,11 +1,14 @@
 import json
+import torch
 from jsonformer import Jsonformer
 from loguru import logger
-from typing import Any
-from transformers import pipeline
+from typing import Any, Optional
+from transformers import LogitsProcessorList
 from transformers.pipelines import Pipeline
 
 from core.llms.basellm import BaseLLM
+from core.llms.pool import MODEL_POOL
+from core.llms.json_decoder import JsonDecoder
 
 class MyJsonFormer:
     """
@@ -49,13 +52,19 @@ class MyJsonFormer:
         return json.dumps(text, ensure_ascii=False)
 
 class OpenSourceLLM(BaseLLM):
-    def __init__(self, model_path: str = 'lmsys/vicuna-7b-v1.5-16k', device: int = 0, json_mode: bool = False, prefix: str = 'react', max_new_tokens: int = 300, do_sample: bool = True, temperature: float = 0.9, top_p: float = 1.0, *args, **kwargs):
-        """Initialize the OpenSource LLM. The OpenSource LLM is a wrapper of the HuggingFace pipeline.
+    def __init__(self, model_path: str = 'lmsys/vicuna-7b-v1.5-16k', device: int = 0, dtype: Optional[str] = None, quantization: Optional[str] = None, num_threads: Optional[int] = None, batching: Optional[dict] = None, prefix_cache: bool = True, constrained_json: bool = True, json_mode: bool = False, prefix: str = 'react', max_new_tokens: int = 300, do_sample: bool = True, temperature: float = 0.9, top_p: float = 1.0, *args, **kwargs):
+        """Initialize the OpenSource LLM. The OpenSource LLM is a wrapper of the HuggingFace pipeline. The pipeline is shared through the `MODEL_POOL` by all LLMs of the same model, device and dtype, and the generation parameters are passed with each call.
         
         Args:
             `model_path` (`str`, optional): The path or name to the model. Defaults to `'lmsys/vicuna-7b-v1.5-16k'`.
             `device` (`int`, optional): The device to use. Set to `auto` to automatically select the device. Defaults to `0`.
-            `json_mode` (`bool`, optional): Whether to enable json mode. If enabled, the output of the LLM will be formatted into JSON by `MyJsonFormer`. Defaults to `False`.
+            `dtype` (`Optional[str]`, optional): The torch dtype of the weights, e.g. `float16` or `auto`. On CPU, `bfloat16` is only used if the CPU supports it. Defaults to `None` (the default of `transformers`).
+            `quantization` (`Optional[str]`, optional): Set to `int8` to load the model with dynamic int8 quantization of its linear layers. CPU only. Defaults to `None`.
+            `num_threads` (`Optional[int]`, optional): The number of threads of torch on CPU, shared by the whole process. Set to `0` to use all cores. Defaults to `None` (the default of torch).
+            `batching` (`Optional[dict]`, optional): The arguments of the `BatchScheduler` of the model, `max_batch_size` and `max_wait_ms`. If set, prompts sent at the same time by several threads are generated in batches. Not used in json mode. Defaults to `None`.
+            `prefix_cache` (`bool`, optional): Whether to resume prompts starting with a prefix declared by `register_prefix` from its cached encoding. Only used for prompts generated one at a time, and not by `MyJsonFormer`. Defaults to `True`.
+            `constrained_json` (`bool`, optional): Whether to generate in json mode with the `JsonDecoder`, in one pass constrained by the JSON schema. `MyJsonFormer` is used if the schema is not supported or the output is not valid. Defaults to `True`.
+            `json_mode` (`bool`, optional): Whether to enable json mode. If enabled, the output of the LLM will follow the JSON schema given as `{prefix}_json_schema`. Defaults to `False`.
             `prefix` (`str`, optional): The prefix of the some configuration arguments. Defaults to `'react'`.
             `max_new_tokens` (`int`, optional): Maximum number of new tokens to generate. Defaults to `300`.
             `do_sample` (`bool`, optional): Whether to use sampling. Defaults to `True`.
@@ -63,32 +72,91 @@ class OpenSourceLLM(BaseLLM):
             `top_p` (`float`, optional): The top-p of the generation. Defaults to `1.0`.
         """
         self.json_mode = json_mode
-        if device == 'auto':
-            self.pipe = pipeline("text-generation", model=model_path, device_map='auto')
-        else:
-            self.pipe = pipeline("text-generation", model=model_path, device=device)
-        self.pipe.model.generation_config.do_sample = do_sample
-        self.pipe.model.generation_config.top_p = top_p
-        self.pipe.model.generation_config.temperature = temperature
-        self.pipe.model.generation_config.max_new_tokens = max_new_tokens
+        self.model = MODEL_POOL.acquire(model_path, device=device, dtype=dtype, quantization=quantization, num_threads=num_threads)
+        self.pipe = self.model.pipe
+        self.generation_kwargs: dict[str, Any] = {'do_sample': do_sample, 'max_new_tokens': max_new_tokens}
+        if do_sample:
+            self.generation_kwargs.update(temperature=temperature, top_p=top_p)
         if self.json_mode:
             logger.info('Enabling json mode...')
             json_schema = kwargs.get(f'{prefix}_json_schema', None)
             assert json_schema is not None, "json_schema must be provided if json_mode is True"
-            self.pipe = MyJsonFormer(json_schema=json_schema, pipeline=self.pipe, max_new_tokens=max_new_tokens, temperature=temperature, debug=kwargs.get('debug', False))
+            self.json_former = MyJsonFormer(json_schema=json_schema, pipeline=self.pipe, max_new_tokens=max_new_tokens, temperature=temperature, debug=kwargs.get('debug', False))
+            self.json_decoder: Optional[JsonDecoder] = None
+            if constrained_json:
+                try:
+                    self.json_decoder = JsonDecoder(json_schema, self.model.token_trie())
+                except NotImplementedError as e:
+                    logger.warning(f'Falling back to JsonFormer: {e}')
+        self.scheduler = self.model.scheduler(**batching) if batching is not None and not self.json_mode else None
+        self.prefix_cache = self.model.prefix_cache if prefix_cache and self.scheduler is None else None
         self.model_name = model_path
+        self._generation_params = {
+            'do_sample': do_sample,
+            'temperature': temperature,
+            'top_p': top_p,
+            'max_new_tokens': max_new_tokens,
+            'json_schema': kwargs.get(f'{prefix}_json_schema', None) if self.json_mode else None,
+        }
         self.max_tokens = max_new_tokens
         self.max_context_length: int = 16384 if '16k' in model_path else 32768 if '32k' in model_path else 4096
+
+    def close(self) -> None:
+        if getattr(self, 'model', None) is not None:
+            model, self.model = self.model, None
+            MODEL_POOL.release(model)
+
+    def __del__(self) -> None:
+        # Fallback for LLMs that are not closed
+        self.close()
     
-    def __call__(self, prompt: str, *args, **kwargs) -> str:
-        """Forward pass of the OpenSource LLM. If json_mode is enabled, the output of the LLM will be formatted into JSON by `MyJsonFormer`.
+    @property
+    def generation_params(self) -> dict[str, Any]:
+        return self._generation_params
+
+    def register_prefix(self, prefix: str) -> None:
+        if self.prefix_cache is not None:
+            self.prefix_cache.register(prefix)
+
+    def _generate(self, prompt: str, constrained: bool) -> str:
+        # Must hold the model lock. Resumes from the cached prefix of the prompt, if any
+        tokenizer = self.pipe.tokenizer
+        input_ids = tokenizer(prompt, return_tensors='pt').input_ids.to(self.pipe.model.device)
+        n_cached, cache = self.prefix_cache.lookup(prompt, input_ids) if self.prefix_cache is not None else (0, None)
+        if n_cached > 0:
+            logger.debug(f'Resuming from {n_cached} cached prefix tokens of {input_ids.shape[1]}')
+        kwargs = {}
+        if constrained:
+            kwargs['logits_processor'] = LogitsProcessorList([self.json_decoder.processor(input_ids.shape[1], self.generation_kwargs['max_new_tokens'])])
+        pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        output = self.pipe.model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), past_key_values=cache, pad_token_id=pad_token_id, **self.generation_kwargs, **kwargs)
+        return tokenizer.decode(output[0, input_ids.shape[1]:], skip_special_tokens=True, clean_up_tokenization_spaces=False)
+
+    def _generate_json(self, prompt: str) -> Optional[str]:
+        # Must hold the model lock
+        output = self._generate(prompt, constrained=True)
+        try:
+            # Already written like `json.dumps`, and kept as is so that numbers are not rounded
+            json.loads(output)
+            return output
+        except json.JSONDecodeError:
+            logger.warning(f'Constrained JSON output is not valid, falling back to JsonFormer: {output}')
+            return None
+
+    def generate(self, prompt: str, *args, **kwargs) -> str:
+        """Forward pass of the OpenSource LLM. If json_mode is enabled, the output of the LLM is constrained to the JSON schema by the `JsonDecoder`, or formatted into JSON by `MyJsonFormer`.
         
         Args:
             `prompt` (`str`): The prompt to feed into the LLM.
         Returns:
             `str`: The OpenSource LLM output.
         """
-        if self.json_mode:
-            return self.pipe.invoke(prompt)
-        else:
-            return self.pipe.invoke(prompt, return_full_text=False)[0]['generated_text']
\ No newline at end of file
+        if self.scheduler is not None:
+            return self.scheduler.generate(prompt, **self.generation_kwargs)
+        with self.model.lock:
+            if self.json_mode:
+                output = self._generate_json(prompt) if self.json_decoder is not None else None
+                return output if output is not None else self.json_former.invoke(prompt)
+            if self.prefix_cache is not None:
+                return self._generate(prompt, constrained=False)
+            return self.pipe(prompt, return_full_text=False, **self.generation_kwargs)[0]['generated_text']
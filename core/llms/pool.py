@@ -0,0 +1,381 @@
+import os
+import copy
+import time
+import torch
+import threading
+from collections import deque
+from concurrent.futures import Future
+from loguru import logger
+from typing import Any, Optional
+from transformers import pipeline, DynamicCache
+from transformers.pipelines import Pipeline
+
+from core.llms.json_decoder import TokenTrie
+
+class _Request:
+    __slots__ = ['prompt', 'kwargs', 'key', 'future']
+
+    def __init__(self, prompt: str, kwargs: dict[str, Any]) -> None:
+        self.prompt = prompt
+        self.kwargs = kwargs
+        self.key = tuple(sorted(kwargs.items()))
+        self.future: Future[str] = Future()
+
+class BatchScheduler:
+    """
+    Collects the prompts sent to a `PooledModel` from several threads and generates them in batches. A batch starts with the oldest waiting prompt and takes the other prompts with the same generation parameters that arrive within `max_wait_ms`, up to `max_batch_size`. Prompts are padded on the left, and each caller gets its own output back.
+    """
+    def __init__(self, model: 'PooledModel', max_batch_size: int = 8, max_wait_ms: float = 10.0) -> None:
+        """Initialize the scheduler and start its worker thread.
+
+        Args:
+            `model` (`PooledModel`): The model to generate with.
+            `max_batch_size` (`int`, optional): Maximum number of prompts per batch. Defaults to `8`.
+            `max_wait_ms` (`float`, optional): Maximum time to wait for more prompts after the first one, in milliseconds. Defaults to `10.0`.
+        """
+        assert max_batch_size > 0, 'max_batch_size must be positive.'
+        assert max_wait_ms >= 0, 'max_wait_ms must be non-negative.'
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        tokenizer = model.pipe.tokenizer
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        # Decoder-only models continue from the last token, so the padding goes first
+        tokenizer.padding_side = 'left'
+        self._pending: deque[_Request] = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='batch-scheduler', daemon=True)
+        self._thread.start()
+
+    def generate(self, prompt: str, **kwargs: Any) -> str:
+        """Generate the output of a prompt in the next batch with the same generation parameters. Blocks until it is done.
+
+        Args:
+            `prompt` (`str`): The prompt.
+        Returns:
+            `str`: The generated text, without the prompt.
+        """
+        request = _Request(prompt, kwargs)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Batch scheduler is closed.')
+            self._pending.append(request)
+            self._cond.notify_all()
+        return request.future.result()
+
+    def _next_batch(self) -> list[_Request]:
+        with self._cond:
+            while len(self._pending) == 0 and not self._closed:
+                self._cond.wait()
+            if len(self._pending) == 0:
+                return []
+            key = self._pending[0].key
+            deadline = time.monotonic() + self.max_wait
+            while True:
+                batch = [request for request in self._pending if request.key == key][:self.max_batch_size]
+                remaining = deadline - time.monotonic()
+                if len(batch) == self.max_batch_size or remaining <= 0 or self._closed:
+                    break
+                self._cond.wait(remaining)
+            for request in batch:
+                self._pending.remove(request)
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if len(batch) == 0:
+                return
+            try:
+                with self.model.lock:
+                    outputs = self.model.pipe([request.prompt for request in batch], return_full_text=False, batch_size=len(batch), **batch[0].kwargs)
+                logger.debug(f'Generated a batch of {len(batch)} prompts')
+                for request, output in zip(batch, outputs):
+                    request.future.set_result(output[0]['generated_text'])
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+    def close(self) -> None:
+        """Stop the worker thread once the waiting prompts are generated."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+class PrefixCache:
+    """
+    The key/value cache of the static prompt prefixes registered on a `PooledModel`, e.g. the few-shot block at the start of an agent prompt. A prompt starting with a registered prefix resumes from a copy of its cache instead of encoding it again, so only the rest of the prompt is prefilled. The cache of a prefix is computed on its first use.
+    """
+    def __init__(self, model: 'PooledModel', max_prefixes: int = 16) -> None:
+        """Initialize the cache.
+
+        Args:
+            `model` (`PooledModel`): The model of the cache.
+            `max_prefixes` (`int`, optional): Maximum number of prefixes. Prefixes registered beyond it are ignored. Defaults to `16`.
+        """
+        self.model = model
+        self.max_prefixes = max_prefixes
+        # Prefix -> (token ids, key/value cache), `None` until first used
+        self._prefixes: dict[str, Optional[tuple[Any, Any]]] = {}
+
+    def register(self, prefix: str) -> None:
+        """Register a static prompt prefix.
+
+        Args:
+            `prefix` (`str`): The prefix.
+        """
+        with self.model.lock:
+            if prefix == '' or prefix in self._prefixes:
+                return
+            if len(self._prefixes) >= self.max_prefixes:
+                logger.warning(f'Prefix cache is full with {self.max_prefixes} prefixes, ignoring the new one.')
+                return
+            self._prefixes[prefix] = None
+
+    def lookup(self, prompt: str, input_ids: Any) -> tuple[int, Any]:
+        """Get the cache of the longest registered prefix of a prompt. Must be called while holding the `lock` of the model.
+
+        Args:
+            `prompt` (`str`): The prompt.
+            `input_ids` (`torch.Tensor`): The token ids of the prompt, of shape `(1, length)`.
+        Returns:
+            `tuple[int, Any]`: The number of leading tokens covered by the cache, and a copy of the cache cropped to them. `0` and `None` if no prefix matches.
+        """
+        prefixes = [prefix for prefix in self._prefixes if prompt.startswith(prefix)]
+        if len(prefixes) == 0:
+            return 0, None
+        prefix = max(prefixes, key=len)
+        if self._prefixes[prefix] is None:
+            self._prefixes[prefix] = self._prefill(prefix)
+        prefix_ids, cache = self._prefixes[prefix]
+        # The last tokens of the prefix may merge with the text after it, only the tokens shared with the prompt are reused.
+        # At least one token is left to prefill, to get the logits of the next token
+        n = min(prefix_ids.shape[1], input_ids.shape[1] - 1)
+        mismatch = (prefix_ids[0, :n] != input_ids[0, :n]).nonzero()
+        n = int(mismatch[0, 0]) if len(mismatch) > 0 else n
+        if n <= 0:
+            return 0, None
+        # Generation extends the cache in place
+        cache = copy.deepcopy(cache)
+        cache.crop(n)
+        return n, cache
+
+    def _prefill(self, prefix: str) -> tuple[Any, Any]:
+        pipe = self.model.pipe
+        prefix_ids = pipe.tokenizer(prefix, return_tensors='pt').input_ids.to(pipe.model.device)
+        cache = DynamicCache()
+        with torch.no_grad():
+            pipe.model(input_ids=prefix_ids, past_key_values=cache, use_cache=True)
+        logger.debug(f'Cached {prefix_ids.shape[1]} prefix tokens')
+        return prefix_ids, cache
+
+def cpu_supports_bf16() -> bool:
+    """Check whether the CPU has native bfloat16 instructions (AVX512-BF16 or AMX). Without them, bfloat16 on CPU is emulated and slower than float32.
+
+    Returns:
+        `bool`: Whether bfloat16 is supported. `False` if the CPU flags cannot be read, e.g. outside Linux.
+    """
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+def _nbytes(value: Any) -> int:
+    # The packed weights of quantized layers are nested in tuples of the state dict
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(item) for item in value)
+    return 0
+
+class PooledModel:
+    """
+    A loaded `pipeline("text-generation")` shared by the LLMs of the same model. Generation parameters are passed with each call, so the model itself is never changed by its users. Use `lock` around generation, as the pipeline is not safe to call from several threads at once, or send the prompts through the `BatchScheduler` of `scheduler`.
+    """
+    def __init__(self, pipe: Pipeline) -> None:
+        self.pipe = pipe
+        self.lock = threading.Lock()
+        self._scheduler: Optional[BatchScheduler] = None
+        self._scheduler_lock = threading.Lock()
+        # Models with the legacy tuple cache cannot resume from a cached prefix
+        self.prefix_cache: Optional[PrefixCache] = PrefixCache(self) if getattr(pipe.model, '_supports_cache_class', False) else None
+        self._token_trie: Optional[TokenTrie] = None
+
+    def token_trie(self) -> TokenTrie:
+        """Get the `TokenTrie` of the tokenizer, building it on first use. Shared by the JSON decoders of all LLMs of the model.
+
+        Returns:
+            `TokenTrie`: The token trie.
+        """
+        with self.lock:
+            if self._token_trie is None:
+                self._token_trie = TokenTrie(self.pipe.tokenizer)
+            return self._token_trie
+
+    def memory_footprint(self) -> int:
+        """Get the size of the weights and buffers of the model, including quantized weights.
+
+        Returns:
+            `int`: The size in bytes.
+        """
+        return sum(_nbytes(value) for value in self.pipe.model.state_dict().values())
+
+    def benchmark(self, n_tokens: int = 16) -> float:
+        """Measure the generation speed of the model with a short greedy generation.
+
+        Args:
+            `n_tokens` (`int`, optional): The number of new tokens to generate. Defaults to `16`.
+        Returns:
+            `float`: The number of new tokens per second.
+        """
+        tokenizer = self.pipe.tokenizer
+        input_ids = tokenizer('Hello', return_tensors='pt').input_ids.to(self.pipe.model.device)
+        pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        with self.lock:
+            start = time.perf_counter()
+            output = self.pipe.model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), max_new_tokens=n_tokens, min_new_tokens=n_tokens, do_sample=False, pad_token_id=pad_token_id)
+            elapsed = time.perf_counter() - start
+        return (output.shape[1] - input_ids.shape[1]) / elapsed
+
+    def scheduler(self, max_batch_size: int = 8, max_wait_ms: float = 10.0) -> BatchScheduler:
+        """Get the batch scheduler of the model, starting it on first use. All LLMs of the model share it, with the settings of the first one.
+
+        Args:
+            `max_batch_size` (`int`, optional): Maximum number of prompts per batch. Defaults to `8`.
+            `max_wait_ms` (`float`, optional): Maximum time to wait for more prompts, in milliseconds. Defaults to `10.0`.
+        Returns:
+            `BatchScheduler`: The scheduler.
+        """
+        with self._scheduler_lock:
+            if self._scheduler is None:
+                self._scheduler = BatchScheduler(self, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+            elif (self._scheduler.max_batch_size, self._scheduler.max_wait) != (max_batch_size, max_wait_ms / 1000):
+                logger.warning(f'Batch scheduler already started with max_batch_size={self._scheduler.max_batch_size} and max_wait_ms={self._scheduler.max_wait * 1000}, ignoring the new settings.')
+            return self._scheduler
+
+    def close(self) -> None:
+        """Stop the batch scheduler, if any."""
+        with self._scheduler_lock:
+            if self._scheduler is not None:
+                self._scheduler.close()
+                self._scheduler = None
+
+class ModelPool:
+    """
+    A process-wide pool of local models. Models are keyed by their path, device, dtype and quantization, so LLMs (e.g. the thought and action LLMs of the manager and the other agents) pointing at the same model share one copy of the weights. Use `acquire` to get a model and `release` to give it back. A model is unloaded once no one holds it anymore.
+    """
+    def __init__(self) -> None:
+        self._models: dict[tuple[str, str, str, str], PooledModel] = {}
+        self._refcounts: dict[tuple[str, str, str, str], int] = {}
+        # Reentrant, as the garbage collector may run the `__del__` of an LLM, and so `release`, while the lock is held
+        self._lock = threading.RLock()
+        # The lock of each model being loaded
+        self._loading: dict[tuple[str, str, str, str], threading.Lock] = {}
+
+    @staticmethod
+    def _key(model_path: str, device: int | str, dtype: Optional[str], quantization: Optional[str]) -> tuple[str, str, str, str]:
+        return model_path, str(device), str(dtype), str(quantization)
+
+    def acquire(self, model_path: str, device: int | str = 0, dtype: Optional[str] = None, quantization: Optional[str] = None, num_threads: Optional[int] = None, benchmark_tokens: int = 16) -> PooledModel:
+        """Get the shared copy of a model, loading it on first use. The memory footprint and the generation speed of the model are logged when it is loaded.
+
+        Args:
+            `model_path` (`str`): The path or name of the model.
+            `device` (`int | str`, optional): The device to use. Set to `auto` to automatically select the device. Defaults to `0`.
+            `dtype` (`Optional[str]`, optional): The torch dtype of the weights, e.g. `float16` or `auto`. On CPU, `bfloat16` falls back to `float32` if the CPU has no bfloat16 instructions. Defaults to `None` (the default of `transformers`).
+            `quantization` (`Optional[str]`, optional): Set to `int8` to quantize the linear layers dynamically to int8, with int8 weights and activations quantized on the fly. CPU only. Defaults to `None`.
+            `num_threads` (`Optional[int]`, optional): The number of threads of torch on CPU, for the whole process. Set to `0` to use all cores. Defaults to `None` (the default of torch).
+            `benchmark_tokens` (`int`, optional): The number of tokens to generate to measure the speed of the model when loading it. Set to `0` to skip it. Defaults to `16`.
+        Returns:
+            `PooledModel`: The shared model.
+        """
+        assert quantization in [None, 'int8'], f'Unsupported quantization: {quantization}'
+        assert quantization is None or str(device) == 'cpu', 'int8 quantization is only supported on CPU.'
+        assert quantization is None or dtype in [None, 'float32'], 'int8 quantization needs float32 weights.'
+        if num_threads is not None:
+            num_threads = num_threads if num_threads > 0 else os.cpu_count() or 1
+            if torch.get_num_threads() != num_threads:
+                logger.info(f'Using {num_threads} torch threads')
+                torch.set_num_threads(num_threads)
+        key = self._key(model_path, device, dtype, quantization)
+        with self._lock:
+            if key in self._models:
+                self._refcounts[key] += 1
+                return self._models[key]
+            load_lock = self._loading.setdefault(key, threading.Lock())
+        # Loading and benchmarking take long, so only the acquirers of the same model wait for it
+        with load_lock:
+            with self._lock:
+                if key in self._models:
+                    self._refcounts[key] += 1
+                    return self._models[key]
+            model = self._load(model_path, device, load_dtype=dtype, quantization=quantization, benchmark_tokens=benchmark_tokens)
+            with self._lock:
+                self._models[key] = model
+                self._refcounts[key] = 1
+                self._loading.pop(key, None)
+            return model
+
+    @staticmethod
+    def _load(model_path: str, device: int | str, load_dtype: Optional[str], quantization: Optional[str], benchmark_tokens: int) -> PooledModel:
+        logger.info(f'Loading model {model_path} on device {device} with dtype {load_dtype}' + (f' and {quantization} quantization' if quantization is not None else ''))
+        if str(device) == 'cpu' and load_dtype == 'bfloat16' and not cpu_supports_bf16():
+            logger.warning('The CPU has no bfloat16 instructions, loading the model in float32.')
+            load_dtype = 'float32'
+        kwargs = {'torch_dtype': load_dtype} if load_dtype is not None else {}
+        if device == 'auto':
+            pipe = pipeline("text-generation", model=model_path, device_map='auto', **kwargs)
+        else:
+            pipe = pipeline("text-generation", model=model_path, device=device, **kwargs)
+        if quantization == 'int8':
+            pipe.model = torch.ao.quantization.quantize_dynamic(pipe.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        model = PooledModel(pipe)
+        report = f'Loaded model {model_path}: {model.memory_footprint() / 2 ** 20:.1f} MB'
+        if benchmark_tokens > 0:
+            report += f', {model.benchmark(benchmark_tokens):.1f} tokens/s'
+        logger.info(report)
+        return model
+
+    def release(self, model: PooledModel) -> None:
+        """Give back a model obtained from `acquire`. The model is dropped from the pool when its reference count reaches zero.
+
+        Args:
+            `model` (`PooledModel`): The model to release.
+        """
+        unloaded: Optional[tuple[tuple[str, str, str, str], PooledModel]] = None
+        with self._lock:
+            # A snapshot, as the `__del__` of another LLM may release its model on this thread
+            for key, shared in list(self._models.items()):
+                if shared is model:
+                    self._refcounts[key] -= 1
+                    if self._refcounts[key] == 0:
+                        unloaded = key, self._models.pop(key)
+                        del self._refcounts[key]
+                    break
+        # Closing joins the batch scheduler thread, which must not block the other users of the pool
+        if unloaded is not None:
+            logger.info(f'Unloading model {unloaded[0][0]}')
+            unloaded[1].close()
+
+    def refcount(self, model_path: str, device: int | str = 0, dtype: Optional[str] = None, quantization: Optional[str] = None) -> int:
+        """Get the number of holders of a model.
+
+        Args:
+            `model_path` (`str`): The path or name of the model.
+            `device` (`int | str`, optional): The device of the model. Defaults to `0`.
+            `dtype` (`Optional[str]`, optional): The torch dtype of the model. Defaults to `None`.
+            `quantization` (`Optional[str]`, optional): The quantization of the model. Defaults to `None`.
+        Returns:
+            `int`: The number of holders. `0` if the model is not loaded.
+        """
+        with self._lock:
+            return self._refcounts.get(self._key(model_path, device, dtype, quantization), 0)
+
+MODEL_POOL = ModelPool()
@@ -12,5 +12,8 @@ def demo():
         page_icon="📄",
         layout="wide",
     )
-    config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'config', 'systems', 'collaboration', 'all_agents.json')
+    config_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'config', 'systems', 'collaboration')
+    config_names = sorted(name for name in os.listdir(config_dir) if name.endswith('.json'))
+    config_name = st.sidebar.selectbox('System config', config_names, index=config_names.index('all_agents.json'))
+    config_path = os.path.join(config_dir, config_name)
     task_config(task='pr', system_type=CollaborationSystem, config_path=config_path)
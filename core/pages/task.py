@@ -39,6 +39,9 @@ def check_json(config_path: str) -> bool:
     config = read_json(config_path)
     if 'model_type' in config and config['model_type'] == 'opensource':
         assert 'model_path' in config, 'model_path is required for OpenSource models'
+        if str(config.get('device', 0)) == 'cpu':
+            # CPU models, e.g. with int8 quantization, run without cuda
+            return scan_dict(config)
         st.markdown(f'`{config_path}` requires `{config["model_path"]}` models.')
         return False
     if 'model_path' in config:
@@ -69,7 +72,7 @@ def task_config(task: str, system_type: type[System], config_path: str) -> None:
     st.markdown(f'## {task2name(task)}')
     checking = check_config(config_path)
     if not checking:
-        st.error(f'This config file requires OpenSource models, which are not supported in this machine (without cuda toolkit).')
+        st.error(f'This config file requires OpenSource models on GPU, which are not supported in this machine (without cuda toolkit). Use OpenSource models with `"device": "cpu"` instead, as in `config/systems/collaboration/cpu_agents.json`.')
         return
     dataset = 'revfinder'
     renew = False
@@ -113,6 +116,9 @@ def task_config(task: str, system_type: type[System], config_path: str) -> None:
         st.session_state.dataset = dataset
         renew = True
     if renew:
+        if 'system' in st.session_state:
+            # Give the tools of the replaced system back to the registry
+            st.session_state.system.close()
         system = get_system(system_type, config_path, task, dataset)
         st.session_state.system_type = system_type.__name__
         st.session_state.task = task
@@ -1,3 +1,4 @@
+import asyncio
 import pandas as pd
 import streamlit as st
 from abc import ABC, abstractmethod
@@ -6,7 +7,7 @@ from loguru import logger
 from langchain.prompts import PromptTemplate
 
 from core.agents import Agent
-from core.utils import is_correct, init_answer, read_json, read_prompts, get_avatar, get_color, get_role
+from core.utils import is_correct, init_answer, read_json, read_prompts, get_avatar, get_color, get_role, Scratchpad
 
 class System(ABC):
     """
@@ -125,6 +126,10 @@ class System(ABC):
         self.clear_web_log()
         return self.forward(*args, **kwargs)
     
+    async def acall(self, *args: Any, **kwargs: Any) -> Any:
+        self.clear_web_log()
+        return await self.aforward(*args, **kwargs)
+    
     def set_data(self, input: str, context: str, gt_answer: Any, data_sample: Optional[pd.Series] = None) -> None:
         self.input: str = input
         self.context: str = context
@@ -141,6 +146,14 @@ class System(ABC):
             `Any`: The system output.
         """
         raise NotImplementedError("System.forward() not implemented")
+    
+    async def aforward(self, *args, **kwargs) -> Any:
+        """Asynchronous forward pass of the system. Runs `forward` in a worker thread by default. Subclasses should override it to await their agents natively.
+        
+        Returns:
+            `Any`: The system output.
+        """
+        return await asyncio.to_thread(self.forward, *args, **kwargs)
         
     def is_finished(self) -> bool:
         return self.finished
@@ -159,11 +172,20 @@ class System(ABC):
         self.finished = True
         return observation
     
+    def close(self) -> None:
+        """Give the shared resources of the system back, i.e. the tools its agents hold in the `TOOL_REGISTRY` and the models of their LLMs in the `MODEL_POOL`. Call it once the system is no longer used. Closing twice is a no-op."""
+        for agent in getattr(self, 'agents', {}).values():
+            agent.close()
+
+    def __del__(self) -> None:
+        # Fallback for systems that are not closed
+        self.close()
+
     def clear_web_log(self) -> None:
         self.web_log = []
 
     def reset(self, clear: bool = False, *args, **kwargs) -> None:
-        self.scratchpad: str = ''
+        self.scratchpad = Scratchpad()
         self.finished: bool = False
         self.answer = init_answer(type=self.task)
         if self.web_demo and clear:
@@ -1,11 +1,19 @@
 import json
+import asyncio
+import pandas as pd
 import streamlit as st
 from typing import Any, Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
 
 from core.systems.base import System
 from core.agents import Agent, Manager, Analyst, Evaluator, Supervisor, Retriever, Hallucination, Explainer
-from core.utils import parse_answer, parse_action, format_chat_history, parse_json
+from core.tools import TOOL_REGISTRY, PreRanker
+from core.utils import Scratchpad, parse_answer, parse_action, format_chat_history, parse_json, is_hallucination_flagged
+
+# The verdict recorded for a clean hallucination check when speculating on the next thought
+NO_HALLUCINATION = 'No hallucination'
 
 class CollaborationSystem(System):
     @staticmethod
@@ -19,11 +27,53 @@ class CollaborationSystem(System):
         self.max_step: int = self.config.get('max_step', 10)
         assert 'agents' in self.config, 'Agents are required.'
         self.init_agents(self.config['agents'])
+        # Run the hallucination check and the next thought at the same time. Not used in the web demo, which renders the steps in order
+        self.speculative_hallucination: bool = self.config.get('speculative_hallucination', False) and not self.web_demo and self.hallucination is not None
         self.manager_kwargs = {
             'max_step': self.max_step,
         }
         if self.supervisor is not None:
             self.manager_kwargs['supervisions'] = ''
+        self.init_preranker(self.config.get('preranker', None))
+        self.init_compaction(self.config.get('compaction', None))
+
+    def init_preranker(self, preranker_config: Optional[dict]) -> None:
+        """Set up the optional first stage, which ranks the candidates with the non-LLM `PreRanker` and passes only the top `top_m` of them to the agents.
+
+        Args:
+            `preranker_config` (`Optional[dict]`): The config of the stage, with the `config_path` of the pre-ranker tool and `top_m`. No pre-ranking if `None`.
+        """
+        self.preranker: Optional[PreRanker] = None
+        self.preranked: Optional[list[int]] = None
+        if preranker_config is None:
+            return
+        assert 'config_path' in preranker_config, 'Pre-ranker config path not found.'
+        config_path = preranker_config['config_path']
+        if 'dataset' in self.agent_kwargs:
+            config_path = config_path.format(dataset=self.agent_kwargs['dataset'])
+        self.preranker = TOOL_REGISTRY.acquire('preranker', config_path)
+        self.top_m: int = preranker_config.get('top_m', 5)
+
+    def init_compaction(self, compaction_config: Optional[dict]) -> None:
+        """Set up the compaction of the scratchpad. Once the manager prompt uses more than `threshold` of the token limit, the Observation and Hallucination segments of older steps are replaced with digests of their first `digest_chars` characters, oldest first, until the prompt is back under `threshold`. The last `keep_last` steps are kept in full. The system only halts if the prompt is still over the limit.
+
+        Args:
+            `compaction_config` (`Optional[dict]`): The config of the compaction, with `threshold`, `keep_last` and `digest_chars`. No compaction if `None`.
+        """
+        self.compaction: bool = compaction_config is not None
+        if compaction_config is None:
+            return
+        self.compaction_threshold: float = compaction_config.get('threshold', 0.8)
+        self.keep_last: int = compaction_config.get('keep_last', 1)
+        self.digest_chars: int = compaction_config.get('digest_chars', 200)
+        assert 0 < self.compaction_threshold <= 1, 'Compaction threshold must be in (0, 1].'
+        assert self.keep_last >= 0, 'keep_last must be non-negative.'
+
+    def close(self) -> None:
+        if getattr(self, 'preranker', None) is not None:
+            preranker, self.preranker = self.preranker, None
+            TOOL_REGISTRY.release(preranker)
+        super().close()
 
     def init_agents(self, agents: dict[str, dict]) -> None:
         self.agents: dict[str, Agent] = dict()
@@ -63,24 +113,27 @@ class CollaborationSystem(System):
     @property
     def retriever(self) -> Optional[Retriever]:
         if 'Retriever' not in self.agents:
-            raise None
+            return None
         return self.agents['Retriever']
     
     @property
     def hallucination(self) -> Optional[Hallucination]:
         if 'Hallucination' not in self.agents:
-            raise None
+            return None
         return self.agents['Hallucination']
 
     @property
     def explainer(self) -> Optional[Explainer]:
         if 'Explainer' not in self.agents:
-            raise None
+            return None
         return self.agents['Explainer']
 
     def reset(self, clear: bool = False, *args, **kwargs) -> None:
         super().reset(*args, **kwargs)
         self.step_n: int = 1
+        self._speculative_thought: Optional[str] = None
+        # (step, segment index) of the Observation and Hallucination segments not compacted yet
+        self._compactable: deque[tuple[int, int]] = deque()
         if clear:
             if self.supervisor is not None:
                 self.supervisor.supervisions = []
@@ -97,91 +150,239 @@ class CollaborationSystem(System):
         assert self.task == 'chat', 'Chat history is only available for chat task.'
         return format_chat_history(self._chat_history)
     
+    def set_data(self, input: str, context: str, gt_answer: Any, data_sample: Optional[pd.Series] = None) -> None:
+        super().set_data(input, context, gt_answer, data_sample)
+        self.preranked = None
+        if self.preranker is None or data_sample is None or 'candidate_reviewer_id' not in data_sample:
+            return
+        candidates = [int(candidate) for candidate in json.loads(data_sample['candidate_reviewer_id'])]
+        self.preranked = self.preranker.rank(candidates, files=data_sample['files'], project=data_sample['project'], submit_time=int(data_sample['submit_time']))
+        assert data_sample['candidate_reviewer_id'] in input, 'Candidate list not found in the input.'
+        self.input = input.replace(data_sample['candidate_reviewer_id'], str(self.preranked[:self.top_m]))
+        logger.debug(f'Pre-ranked candidates: {self.preranked}, passing the top {self.top_m} to the agents.')
+
     def is_halted(self) -> bool:
         return ((self.step_n > self.max_step) or self.manager.over_limit(scratchpad=self.scratchpad, **self.manager_kwargs)) and not self.finished
         
     def _parse_answer(self, answer: Any = None) -> dict[str, Any]:
         if answer is None:
             answer = self.answer
-        return parse_answer(type=self.task, answer=answer, gt_answer=self.gt_answer if self.task != 'chat' else '', json_mode=self.manager.json_mode, mode_input=self.mode_input, **self.kwargs)
+        kwargs = self.kwargs
+        if self.preranked is not None:
+            kwargs = {**self.kwargs, 'n_candidate': min(self.top_m, len(self.preranked)), 'candidate_ids': self.preranked[:self.top_m]}
+        return parse_answer(type=self.task, answer=answer, gt_answer=self.gt_answer if self.task != 'chat' else '', json_mode=self.manager.json_mode, mode_input=self.mode_input, **kwargs)
 
-    def think(self):
-        # Think
+    def finish(self, answer: Any) -> str:
+        if self.preranked is not None:
+            # The agents ranked the top candidates, the others follow in pre-ranked order
+            answer = list(answer) + self.preranked[self.top_m:]
+        return super().finish(answer)
+
+    def _begin_thought(self) -> None:
         logger.debug(f'Step {self.step_n}:')
         self.scratchpad += f'\nThought {self.step_n}:'
-        thought = self.manager(scratchpad=self.scratchpad, stage='thought', **self.manager_kwargs)
+
+    def _end_thought(self, thought: str) -> None:
         self.scratchpad += ' ' + thought
         self.log(f'**Thought {self.step_n}**: {thought}', agent=self.manager)
 
-    def act(self) -> tuple[str, Any]:
-        # Act
+    def _take_speculative_thought(self) -> Optional[str]:
+        thought, self._speculative_thought = self._speculative_thought, None
+        return thought
+
+    def think(self):
+        # Think
+        self._begin_thought()
+        thought = self._take_speculative_thought()
+        if thought is None:
+            thought = self.manager(scratchpad=self.scratchpad, stage='thought', **self.manager_kwargs)
+        self._end_thought(thought)
+
+    async def athink(self):
+        self._begin_thought()
+        thought = self._take_speculative_thought()
+        if thought is None:
+            thought = await self.manager.acall(scratchpad=self.scratchpad, stage='thought', **self.manager_kwargs)
+        self._end_thought(thought)
+
+    def _begin_action(self) -> None:
         if self.max_step <= self.step_n:
             self.scratchpad += f'\nHint: {self.manager.hint}'
         # self.scratchpad += f'\nValid action example: {self.manager.valid_action_example}:'
         self.scratchpad += f'\nAction {self.step_n}:'
-        action = self.manager(scratchpad=self.scratchpad, stage='action', **self.manager_kwargs)
+
+    def _end_action(self, action: str) -> tuple[str, Any]:
         action_type, argument = parse_action(action, json_mode=self.manager.json_mode)
         self.scratchpad += f" {action_type} {str(argument)}"
         logger.debug(f'Action {self.step_n}: {action_type} {str(argument)}')
         return action_type, argument
-    
-    def execute(self, action_type: str, argument: Any):
-        # Execute
-        log_head = ''
-        omit = False
-        hallucination = 'No hallucination'
+
+    def act(self) -> tuple[str, Any]:
+        # Act
+        self._begin_action()
+        action = self.manager(scratchpad=self.scratchpad, stage='action', **self.manager_kwargs)
+        return self._end_action(action)
+
+    async def aact(self) -> tuple[str, Any]:
+        self._begin_action()
+        action = await self.manager.acall(scratchpad=self.scratchpad, stage='action', **self.manager_kwargs)
+        return self._end_action(action)
+
+    def _prepare_execution(self, action_type: str, argument: Any) -> tuple[Optional[Agent], str, str, bool]:
+        """Prepare the execution of an action.
+
+        Args:
+            `action_type` (`str`): The type of the action.
+            `argument` (`Any`): The argument of the action.
+        Returns:
+            `tuple[Optional[Agent], str, str, bool]`: The agent to invoke (`None` if the action is handled here), the observation if no agent is invoked, the log head and whether to omit the log.
+        """
         if action_type.lower() == 'finish':
             parse_result = self._parse_answer(argument)
             if parse_result['valid']:
                 observation = self.finish(parse_result['answer'])
-                log_head = 'Finish with answer:\n- '
+                return None, observation, 'Finish with answer:\n- ', False
             else:
                 assert "message" in parse_result, "Invalid parse result."
                 observation = f'Generated answer is invalid. {parse_result["message"]}\nValid Action examples are as following:\n{self.manager.valid_action_example}.'
+                return None, observation, '', False
         elif action_type.lower() == 'analyse':
             if self.analyst is None:
-                observation = 'Analyst is not configured. Cannot execute the action "Analyse".'
-            else:
-                self.log(f'Calling Analyst with {argument} ...', agent=self.manager, logging=False)
-                observation = self.analyst.invoke(argument=argument, json_mode=self.manager.json_mode)
-                log_head = f'Response from Analyst with {argument}:\n- '
-                omit = True
-
-                hallucination = self.hallucination_correct("analyse", history=self.analyst.history)
+                return None, 'Analyst is not configured. Cannot execute the action "Analyse".', '', False
+            self.log(f'Calling Analyst with {argument} ...', agent=self.manager, logging=False)
+            return self.analyst, '', f'Response from Analyst with {argument}:\n- ', True
         elif action_type.lower() == 'evaluate':
             if self.evaluator is None:
-                observation = 'Evaluator is not configured. Cannot execute the action "Evaluate".'
-            else:
-                self.log(f'Calling Evaluator with {argument} ...', agent=self.manager, logging=False)
-                observation = self.evaluator.invoke(argument=argument, json_mode=self.manager.json_mode)
-                log_head = f'Response from Evaluator with {argument}:\n- '
-                omit = True
-
-                hallucination = self.hallucination_correct("evaluate", history=self.evaluator.history)
+                return None, 'Evaluator is not configured. Cannot execute the action "Evaluate".', '', False
+            self.log(f'Calling Evaluator with {argument} ...', agent=self.manager, logging=False)
+            return self.evaluator, '', f'Response from Evaluator with {argument}:\n- ', True
         elif action_type.lower() == 'retrieve':
             if self.retriever is None:
-                observation = 'Retriever is not configured. Cannot execute the action "Retrieve".'
-            else:
-                self.log(f'Calling Retriever with [{argument}] ...', agent=self.manager, logging=False)
-                observation = self.retriever.invoke(argument=argument, json_mode=self.manager.json_mode)
-                log_head = f'Response from Retriever with [{argument}]:\n- '
-                omit = True
+                return None, 'Retriever is not configured. Cannot execute the action "Retrieve".', '', False
+            self.log(f'Calling Retriever with [{argument}] ...', agent=self.manager, logging=False)
+            return self.retriever, '', f'Response from Retriever with [{argument}]:\n- ', True
+        else:
+            return None, 'Invalid Action type or format. Valid Action examples are {self.manager.valid_action_example}.', '', False
 
-                hallucination = self.hallucination_correct("retrieve", response=observation)
+    def _hallucination_kwargs(self, action_type: str, observation: str) -> dict[str, Any]:
+        if action_type.lower() == 'analyse':
+            return {'prompt': 'analyse', 'history': self.analyst.history}
+        elif action_type.lower() == 'evaluate':
+            return {'prompt': 'evaluate', 'history': self.evaluator.history}
         else:
-            observation = 'Invalid Action type or format. Valid Action examples are {self.manager.valid_action_example}.'
+            return {'prompt': 'retrieve', 'response': observation}
 
+    def _digest(self, segment: str) -> Optional[str]:
+        head, body = segment.split(': ', 1)
+        if len(body) <= self.digest_chars:
+            return None
+        return f'{head}: {body[:self.digest_chars].rstrip()} ... ({len(body) - self.digest_chars} characters omitted)'
+
+    def compact_scratchpad(self) -> None:
+        """Compact the scratchpad if the manager prompt is over the compaction threshold. See `init_compaction`."""
+        if not self.compaction or self.manager.token_usage(scratchpad=self.scratchpad, **self.manager_kwargs) <= self.compaction_threshold:
+            return
+        n_compacted = 0
+        while len(self._compactable) > 0 and self._compactable[0][0] <= self.step_n - self.keep_last:
+            _, i = self._compactable.popleft()
+            digest = self._digest(self.scratchpad[i])
+            if digest is None:
+                continue
+            self.scratchpad[i] = digest
+            n_compacted += 1
+            if self.manager.token_usage(scratchpad=self.scratchpad, **self.manager_kwargs) <= self.compaction_threshold:
+                break
+        logger.debug(f'Compacted {n_compacted} segments of the scratchpad.')
+
+    def _over_budget(self, scratchpad: Scratchpad) -> bool:
+        # With compaction, the scratchpad changes once it is over the threshold
+        if self.compaction:
+            return self.manager.token_usage(scratchpad=scratchpad, **self.manager_kwargs) > self.compaction_threshold
+        return self.manager.over_limit(scratchpad=scratchpad, **self.manager_kwargs)
+
+    def _record_execution(self, action_type: str, observation: str, log_head: str, omit: bool, hallucination: str, speculated: bool = False) -> None:
         self.scratchpad += f'\nObservation: {observation}'
+        self._compactable.append((self.step_n, len(self.scratchpad.segments) - 1))
 
         logger.debug(f'Observation: {observation}')
         self.log(f'{log_head}{observation}', agent=self.manager, logging=False, omit=omit)
         if action_type.lower() != 'finish':
-            self.scratchpad += f'\nHallucination: {hallucination}'
+            # The kept speculative thought was generated after the clean verdict `NO_HALLUCINATION`, so the scratchpad must match it
+            self.scratchpad += f'\nHallucination: {NO_HALLUCINATION if speculated else hallucination}'
+            self._compactable.append((self.step_n, len(self.scratchpad.segments) - 1))
             logger.debug(f'Hallucination: {hallucination}')
-            if self.hallucination.json_mode:
+            if self.hallucination is not None and self.hallucination.json_mode:
                 self.log(f"{parse_json(hallucination, 'type')}\n- {parse_json(hallucination, 'content')}", agent=self.hallucination, logging=False)
             else:
                 self.log(f"{hallucination}", agent=self.hallucination, logging=False)
+        self.compact_scratchpad()
+
+    def _speculative_scratchpad(self, observation: str) -> Optional[Scratchpad]:
+        """Get the scratchpad the next thought would see if the hallucination check is clean.
+
+        Args:
+            `observation` (`str`): The observation of the current step.
+        Returns:
+            `Optional[Scratchpad]`: The scratchpad of the next thought, or `None` if no next step will run and there is nothing to speculate on.
+        """
+        if not self.speculative_hallucination or self.step_n + 1 > self.max_step:
+            return None
+        scratchpad = self.scratchpad + f'\nObservation: {observation}\nHallucination: {NO_HALLUCINATION}'
+        if self._over_budget(scratchpad):
+            return None
+        return scratchpad + f'\nThought {self.step_n + 1}:'
+
+    def _keep_speculative_thought(self, hallucination: str, thought: str) -> bool:
+        """Keep the speculative thought for the next step if the hallucination check is clean.
+
+        Args:
+            `hallucination` (`str`): The response of the hallucination check.
+            `thought` (`str`): The speculative thought.
+        Returns:
+            `bool`: Whether the thought was kept.
+        """
+        if is_hallucination_flagged(hallucination, json_mode=self.hallucination.json_mode):
+            logger.debug('Hallucination flagged, discarding the speculative thought.')
+            return False
+        self._speculative_thought = thought
+        return True
+
+    def execute(self, action_type: str, argument: Any):
+        # Execute
+        agent, observation, log_head, omit = self._prepare_execution(action_type, argument)
+        hallucination = NO_HALLUCINATION
+        speculated = False
+        if agent is not None:
+            observation = agent.invoke(argument=argument, json_mode=self.manager.json_mode)
+            hallucination_kwargs = self._hallucination_kwargs(action_type, observation)
+            scratchpad = self._speculative_scratchpad(observation)
+            if scratchpad is None:
+                hallucination = self.hallucination_correct(**hallucination_kwargs)
+            else:
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    hallucination_future = executor.submit(self.hallucination_correct, **hallucination_kwargs)
+                    thought_future = executor.submit(self.manager, scratchpad=scratchpad, stage='thought', **self.manager_kwargs)
+                    hallucination = hallucination_future.result()
+                    speculated = self._keep_speculative_thought(hallucination, thought_future.result())
+        self._record_execution(action_type, observation, log_head, omit, hallucination, speculated)
+
+    async def aexecute(self, action_type: str, argument: Any):
+        agent, observation, log_head, omit = self._prepare_execution(action_type, argument)
+        hallucination = NO_HALLUCINATION
+        speculated = False
+        if agent is not None:
+            observation = await agent.ainvoke(argument=argument, json_mode=self.manager.json_mode)
+            hallucination_kwargs = self._hallucination_kwargs(action_type, observation)
+            scratchpad = self._speculative_scratchpad(observation)
+            if scratchpad is None:
+                hallucination = await self.ahallucination_correct(**hallucination_kwargs)
+            else:
+                hallucination, thought = await asyncio.gather(
+                    self.ahallucination_correct(**hallucination_kwargs),
+                    self.manager.acall(scratchpad=scratchpad, stage='thought', **self.manager_kwargs),
+                )
+                speculated = self._keep_speculative_thought(hallucination, thought)
+        self._record_execution(action_type, observation, log_head, omit, hallucination, speculated)
 
     def step(self):
         self.think()
@@ -189,14 +390,22 @@ class CollaborationSystem(System):
         self.execute(action_type, argument)
         self.step_n += 1
 
-    def supervise(self, round_max, round) -> bool:
-        correctness = False
+    async def astep(self):
+        await self.athink()
+        action_type, argument = await self.aact()
+        await self.aexecute(action_type, argument)
+        self.step_n += 1
+
+    def _begin_supervision(self) -> bool:
         if (not self.is_finished() and not self.is_halted()) or self.supervisor is None:
             self.supervised = False
             if self.supervisor is not None:
                 self.manager_kwargs['supervisions'] = ''
             return False
-        self.supervisor(self.input, self.scratchpad)
+        return True
+
+    def _end_supervision(self) -> bool:
+        correctness = False
         self.supervised = True
         self.manager_kwargs['supervisions'] = self.supervisor.supervisions_str
         if self.supervisor.json_mode:
@@ -206,14 +415,34 @@ class CollaborationSystem(System):
                 logger.debug(f"Last supervision is correct, don't forward.")
                 self.log(f"**Last recommendation is correct, don't forward**", agent=self.supervisor, logging=False)
                 correctness = True
+        return correctness
+
+    def _record_explanation(self, explanation: str) -> None:
+        self.scratchpad += f'\nExplanation: {explanation}'
+        logger.debug(f'Explanation: {explanation}')
+        self.log(f"Explanation for the answer: " + explanation, agent=self.explainer, logging=False)
+
+    def supervise(self, round_max, round) -> bool:
+        if not self._begin_supervision():
+            return False
+        self.supervisor(self.input, str(self.scratchpad))
+        correctness = self._end_supervision()
 
         if correctness is True or round + 1 >= round_max:
-            explanation = self.explainer(self.input, self.scratchpad)
-            self.scratchpad += f'\nExplanation: {explanation}'
-            logger.debug(f'Explanation: {explanation}')
-            self.log(f"Explanation for the answer: " + explanation, agent=self.explainer, logging=False)
+            explanation = self.explainer(self.input, str(self.scratchpad))
+            self._record_explanation(explanation)
         return correctness
 
+    async def asupervise(self, round_max, round) -> bool:
+        if not self._begin_supervision():
+            return False
+        await self.supervisor.acall(self.input, str(self.scratchpad))
+        correctness = self._end_supervision()
+
+        if correctness is True or round + 1 >= round_max:
+            explanation = await self.explainer.acall(self.input, str(self.scratchpad))
+            self._record_explanation(explanation)
+        return correctness
 
     def hallucination_correct(self, prompt: str, **kwargs) -> str:
         if self.hallucination is None:
@@ -223,11 +452,19 @@ class CollaborationSystem(System):
 
         return hallucination
 
-    def forward(self, round_max: int, round: int, user_input: Optional[str] = None, reset: bool = True, mode_input: bool = False) -> Any:
+    async def ahallucination_correct(self, prompt: str, **kwargs) -> str:
+        if self.hallucination is None:
+            return 'Hallucination is not configured. Cannot execute "Hallucination".'
+        return await self.hallucination.acall(prompt=prompt, **kwargs)
+
+    def _begin_forward(self, reset: bool, mode_input: bool) -> None:
         self.manager_kwargs['input'] = self.input
         self.mode_input = mode_input
         if reset:
             self.reset()
+
+    def forward(self, round_max: int, round: int, user_input: Optional[str] = None, reset: bool = True, mode_input: bool = False) -> Any:
+        self._begin_forward(reset, mode_input)
         while not self.is_finished() and not self.is_halted():
             self.step()
             if self.web_demo and not self.is_finished() and not self.is_halted():
@@ -235,4 +472,11 @@ class CollaborationSystem(System):
         self.supervise(round_max, round)
         return self.answer
 
-
+    async def aforward(self, round_max: int, round: int, user_input: Optional[str] = None, reset: bool = True, mode_input: bool = False) -> Any:
+        self._begin_forward(reset, mode_input)
+        while not self.is_finished() and not self.is_halted():
+            await self.astep()
+            if self.web_demo and not self.is_finished() and not self.is_halted():
+                st.markdown("---")
+        await self.asupervise(round_max, round)
+        return self.answer
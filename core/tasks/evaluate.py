@@ -1,12 +1,15 @@
 import os
 import jsonlines
+import pandas as pd
 from tqdm import tqdm
 from typing import Any
 from loguru import logger
 from argparse import ArgumentParser
 
 from core.tasks.generation import GenerationTask
-from core.utils import str2list, NumpyEncoder
+from core.utils import str2list, NumpyEncoder, LRUMemo
+from core.llms import LLMCache, RateLimiter
+from core.systems import System
 from core.evaluation import MetricDict, HitRatioAt, NDCGAt
 
 class EvaluateTask(GenerationTask):
@@ -25,11 +28,18 @@ class EvaluateTask(GenerationTask):
                 'valid_hit_rate': HitRatioAt(topks=topks),
                 'valid_ndcg': NDCGAt(topks=topks),
             })
+            # Ranking of the pre-ranker alone, to check how often the ground truth survives the cut to the top `top_m`
+            self.prerank_metrics = MetricDict({
+                'prerank_hit_rate': HitRatioAt(topks=topks),
+                'prerank_ndcg': NDCGAt(topks=topks),
+            })
+            top_m = getattr(self.system, 'top_m', None)
+            if getattr(self.system, 'preranker', None) is not None and top_m not in topks:
+                self.prerank_metrics.add('prerank_recall', HitRatioAt(topks=[top_m]))
         else:
             raise NotImplementedError
     
-    def update_evaluation(self, answer: float | int | str, gt_answer: float | int | str) -> str:
-        valid = self.system.finished
+    def update_evaluation(self, answer: float | int | str, gt_answer: float | int | str, valid: bool) -> str:
         logger.debug(f'Answer: {answer}, Ground Truth: {gt_answer}')
         if valid:
             return self.metrics.update(output={
@@ -63,22 +73,34 @@ class EvaluateTask(GenerationTask):
         output_file_name = '_'.join([f'{k}={v}' for k, v in output_args.items()]) + '.jsonl'
         self.output_file = jsonlines.open(os.path.join(run_dir, output_file_name), mode="w", dumps=NumpyEncoder(ensure_ascii=False).encode, flush=True)
         
-    def after_round(self, answer: Any, gt_answer: int | float | str, round: int, record: dict) -> None:
+    def after_round(self, answer: Any, gt_answer: int | float | str, round: int, record: dict, system: System) -> None:
         record[f'Answer_{round}'] = answer
-        if hasattr(self.system, 'supervised') and self.system.supervised and self.system.supervisor.keep_supervise:
-            logger.trace(f"Supervisor input: {self.system.supervisor.supervisor_input}")
-            logger.trace(f"Supervisor output: {self.system.supervisor.supervisor_output}")
+        if getattr(system, 'preranked', None) is not None:
+            record['Prerank'] = system.preranked
+        if hasattr(system, 'supervised') and system.supervised and system.supervisor.keep_supervise:
+            logger.trace(f"Supervisor input: {system.supervisor.supervisor_input}")
+            logger.trace(f"Supervisor output: {system.supervisor.supervisor_output}")
     
-    def after_iteration(self, answer: Any, gt_answer: int | float | str, record: dict, pbar: tqdm) -> None:
+    def after_iteration(self, answer: Any, gt_answer: int | float | str, record: dict, pbar: tqdm, data_sample: pd.Series, finished: bool) -> None:
         record['Answer_GT'] = gt_answer
-        record['type'] = self.system.data_sample['project_parent']
+        record['type'] = data_sample['project_parent']
         self.output_file.write(record)
-        pbar.set_description(self.update_evaluation(answer, gt_answer))
+        if 'Prerank' in record:
+            self.prerank_metrics.update(output={
+                'answer': record['Prerank'],
+                'label': gt_answer,
+            })
+        pbar.set_description(self.update_evaluation(answer, gt_answer, finished))
     
     def after_generate(self) -> None:
         self.output_file.close()
         logger.success("===================================Evaluation Report===================================")
         self.metrics.report()
+        if getattr(self.system, 'preranker', None) is not None:
+            self.prerank_metrics.report()
+        LLMCache.report_all()
+        RateLimiter.report_all()
+        LRUMemo.report_all()
     
     def run(self, rounds: int, topks: list[int], *args, **kwargs):
         assert kwargs['task'] == 'pr', "Only support reviewer recommendation task."
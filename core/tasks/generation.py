@@ -1,14 +1,17 @@
 import os
+import queue
+import asyncio
 import pandas as pd
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
-from typing import Any
+from typing import Any, Optional
 from loguru import logger
 from argparse import ArgumentParser
 
 from core.tasks.base import Task
 from core.utils import init_openai_api, read_json
-from core.systems import CollaborationSystem
+from core.systems import System, CollaborationSystem
 
 class GenerationTask(Task):
     @staticmethod
@@ -20,6 +23,10 @@ class GenerationTask(Task):
         parser.add_argument('--system_config', type=str, required=True, help='System configuration file')
         parser.add_argument('--task', type=str, default='pr', choices=['pr'], help='Task name')
         parser.add_argument('--max_his', type=int, default=10, help='Max history length')
+        parser.add_argument('--offset', type=int, default=0, help='Index of the first sample to run')
+        parser.add_argument('--limit', type=int, default=None, help='Max number of samples to run. Run all samples after the offset if not set')
+        parser.add_argument('--workers', type=int, default=1, help='Number of samples to run concurrently. Each worker uses its own system')
+        parser.add_argument('--use_async', action='store_true', help='Run the concurrent samples as coroutines on one event loop instead of one thread per worker')
         return parser
     
     def get_data(self, data_file: str, max_his: int) -> pd.DataFrame:
@@ -46,11 +53,14 @@ class GenerationTask(Task):
         else:
             raise NotImplementedError
         
-    def get_system(self, system: str, system_config: str):
+    def build_system(self, system: str, system_config: str) -> System:
         if system == 'collaboration':
-            self.system = CollaborationSystem(config_path=system_config, **self.system_kwargs)
+            return CollaborationSystem(config_path=system_config, **self.system_kwargs)
         else:
             raise NotImplementedError
+
+    def get_system(self, system: str, system_config: str):
+        self.system = self.build_system(system, system_config)
         
     @property
     @abstractmethod
@@ -74,28 +84,31 @@ class GenerationTask(Task):
         raise NotImplementedError
     
     @abstractmethod
-    def after_round(self, answer: Any, gt_answer: int | float | str, round: int, record: dict) -> None:
-        """The process to run after each system round during one trial.
+    def after_round(self, answer: Any, gt_answer: int | float | str, round: int, record: dict, system: System) -> None:
+        """The process to run after each system round during one trial. May run in a worker thread when `workers > 1`.
         
         Args:
             `answer` (`Any`): The answer given by the system.
             `gt_answer` (`int | float | str`): The ground truth answer.
             `round` (`int`): The current round. Starts from 0.
             `record` (`dict`): The record of the current trial. Can be used to store intermediate results.
+            `system` (`System`): The system running the trial.
         Raises:
             `NotImplementedError`: Subclasses should implement this method.
         """
         raise NotImplementedError
     
     @abstractmethod
-    def after_iteration(self, answer: Any, gt_answer: int | float | str, record: dict, pbar: tqdm) -> None:
-        """The process to run after each trial.
+    def after_iteration(self, answer: Any, gt_answer: int | float | str, record: dict, pbar: tqdm, data_sample: pd.Series, finished: bool) -> None:
+        """The process to run after each trial. Always runs in the main thread, in the order of the data.
         
         Args:
             `answer` (`Any`): The final answer given by the system.
             `gt_answer` (`int | float | str`): The ground truth answer.
             `record` (`dict`): The record of the current trial. Can be used to store intermediate results.
             `pbar` (`tqdm`): The progress bar. Can be used to update the information of the progress bar.
+            `data_sample` (`pd.Series`): The data sample of the trial.
+            `finished` (`bool`): Whether the system finished the trial with a valid answer.
         Raises:
             `NotImplementedError`: Subclasses should implement this method.
         """
@@ -110,28 +123,121 @@ class GenerationTask(Task):
         """
         raise NotImplementedError
     
+    def generate_sample(self, system: System, test_data: str, gt_answer: int | float | str, data_sample: pd.Series, rounds: int) -> tuple[Any, dict, bool]:
+        """Run all rounds of one trial on `system`.
+        
+        Args:
+            `system` (`System`): The system to run. Must not be used by other trials at the same time.
+            `test_data` (`str`): The input prompt of the trial.
+            `gt_answer` (`int | float | str`): The ground truth answer.
+            `data_sample` (`pd.Series`): The data sample of the trial.
+            `rounds` (`int`): The rounds to run.
+        Returns:
+            `tuple[Any, dict, bool]`: The final answer, the record of the trial and whether the system finished.
+        """
+        record = dict()
+        system.set_data(input=test_data, context="", gt_answer=gt_answer, data_sample=data_sample)
+        system.reset(clear=True)
+        for i in range(rounds):
+            logger.debug(f'===================================Running round {i}...===================================')
+            self.after_round(answer=system(rounds, i), gt_answer=gt_answer, round=i, record=record, system=system)
+        return system.answer, record, system.finished
+    
+    async def agenerate_sample(self, system: System, test_data: str, gt_answer: int | float | str, data_sample: pd.Series, rounds: int) -> tuple[Any, dict, bool]:
+        """Asynchronous version of `generate_sample`."""
+        record = dict()
+        system.set_data(input=test_data, context="", gt_answer=gt_answer, data_sample=data_sample)
+        system.reset(clear=True)
+        for i in range(rounds):
+            logger.debug(f'===================================Running round {i}...===================================')
+            self.after_round(answer=await system.acall(rounds, i), gt_answer=gt_answer, round=i, record=record, system=system)
+        return system.answer, record, system.finished
+    
     def generate(self, data: list[tuple[str, int | float | str, pd.Series]], rounds: int = 2):
         self.before_generate()
         with tqdm(total=len(data)) as pbar:
-            for num, (test_data, gt_answer, data_sample) in enumerate(data):
-                if num > 40:
-                    break
-                record = dict()
-                self.system.set_data(input=test_data, context="", gt_answer=gt_answer, data_sample=data_sample)
-                self.system.reset(clear=True)
-                for i in range(rounds):
-                    logger.debug(f'===================================Running round {i}...===================================')
-                    self.after_round(answer=self.system(rounds, i), gt_answer=gt_answer, round=i, record=record)
-                self.after_iteration(answer=self.system.answer, gt_answer=gt_answer, record=record, pbar=pbar)
-                pbar.update(1)
+            if self.workers <= 1:
+                for test_data, gt_answer, data_sample in data:
+                    answer, record, finished = self.generate_sample(self.system, test_data, gt_answer, data_sample, rounds)
+                    self.after_iteration(answer=answer, gt_answer=gt_answer, record=record, pbar=pbar, data_sample=data_sample, finished=finished)
+                    pbar.update(1)
+            elif self.use_async:
+                asyncio.run(self.generate_asynchronously(data, rounds, pbar))
+            else:
+                self.generate_concurrently(data, rounds, pbar)
         self.after_generate()
     
-    def run(self, api_config: str, dataset: str, data_file: str, system: str, system_config: str, task: str, max_his: int):
+    def generate_concurrently(self, data: list[tuple[str, int | float | str, pd.Series]], rounds: int, pbar: tqdm):
+        """Run the trials on `workers` threads. Each thread checks out an idle system from a pool, so systems never share state. Results are handed to `after_iteration` in the order of the data, so the output file and the metrics are the same as in a serial run.
+        
+        Args:
+            `data` (`list[tuple[str, int | float | str, pd.Series]]`): The trials to run.
+            `rounds` (`int`): The rounds to run for each trial.
+            `pbar` (`tqdm`): The progress bar.
+        """
+        systems: queue.Queue[System] = queue.Queue()
+        systems.put(self.system)
+        extra_systems = [self.build_system(self.args.system, self.args.system_config) for _ in range(min(self.workers, len(data)) - 1)]
+        for system in extra_systems:
+            systems.put(system)
+        
+        def run_sample(test_data: str, gt_answer: int | float | str, data_sample: pd.Series) -> tuple[Any, dict, bool]:
+            system = systems.get()
+            try:
+                return self.generate_sample(system, test_data, gt_answer, data_sample, rounds)
+            finally:
+                systems.put(system)
+        
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(run_sample, *sample) for sample in data]
+                for (_, gt_answer, data_sample), future in zip(data, futures):
+                    answer, record, finished = future.result()
+                    self.after_iteration(answer=answer, gt_answer=gt_answer, record=record, pbar=pbar, data_sample=data_sample, finished=finished)
+                    pbar.update(1)
+        finally:
+            for system in extra_systems:
+                system.close()
+    
+    async def generate_asynchronously(self, data: list[tuple[str, int | float | str, pd.Series]], rounds: int, pbar: tqdm):
+        """Run up to `workers` trials as coroutines on one event loop. Works like `generate_concurrently`, but the trials overlap on LLM I/O without a thread per trial.
+        
+        Args:
+            `data` (`list[tuple[str, int | float | str, pd.Series]]`): The trials to run.
+            `rounds` (`int`): The rounds to run for each trial.
+            `pbar` (`tqdm`): The progress bar.
+        """
+        systems: asyncio.Queue[System] = asyncio.Queue()
+        systems.put_nowait(self.system)
+        extra_systems = [self.build_system(self.args.system, self.args.system_config) for _ in range(min(self.workers, len(data)) - 1)]
+        for system in extra_systems:
+            systems.put_nowait(system)
+        
+        async def run_sample(test_data: str, gt_answer: int | float | str, data_sample: pd.Series) -> tuple[Any, dict, bool]:
+            system = await systems.get()
+            try:
+                return await self.agenerate_sample(system, test_data, gt_answer, data_sample, rounds)
+            finally:
+                systems.put_nowait(system)
+        
+        try:
+            tasks = [asyncio.create_task(run_sample(*sample)) for sample in data]
+            for (_, gt_answer, data_sample), task in zip(data, tasks):
+                answer, record, finished = await task
+                self.after_iteration(answer=answer, gt_answer=gt_answer, record=record, pbar=pbar, data_sample=data_sample, finished=finished)
+                pbar.update(1)
+        finally:
+            for system in extra_systems:
+                system.close()
+    
+    def run(self, api_config: str, dataset: str, data_file: str, system: str, system_config: str, task: str, max_his: int, offset: int = 0, limit: Optional[int] = None, workers: int = 1, use_async: bool = False):
         if dataset == 'None':
             dataset = os.path.basename(os.path.dirname(data_file))
         self.dataset = dataset
         self.task = task
         self.max_his = max_his
+        self.workers = workers
+        self.use_async = use_async
         self.system_kwargs = {
             'task': self.task,
             'leak': False,
@@ -139,6 +245,10 @@ class GenerationTask(Task):
         }
         init_openai_api(read_json(api_config))
         data_df = self.get_data(data_file, max_his)
+        data_df = data_df.iloc[offset:None if limit is None else offset + limit].reset_index(drop=True)
         self.get_system(system, system_config)
-        data = self.prompt_data(data_df)
-        self.generate(data, rounds=self.running_rounds)
+        try:
+            data = self.prompt_data(data_df)
+            self.generate(data, rounds=self.running_rounds)
+        finally:
+            self.system.close()
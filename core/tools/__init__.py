@@ -1,8 +1,17 @@
 from core.tools.base import Tool
 from core.tools.info_database import InfoDatabase
 from core.tools.interaction import InteractionRetriever
+from core.tools.preranker import PreRanker
+from core.tools.expertise import ExpertiseIndex, expertise_path
+from core.tools.search import BM25Index, SearchEngine
+from core.tools.registry import ToolRegistry
 
 TOOL_MAP: dict[str, type] = {
     'info': InfoDatabase,
     'interaction': InteractionRetriever,
-}
\ No newline at end of file
+    'preranker': PreRanker,
+    'expertise': ExpertiseIndex,
+    'search': SearchEngine,
+}
+
+TOOL_REGISTRY = ToolRegistry(TOOL_MAP)
\ No newline at end of file
@@ -0,0 +1,171 @@
+import time
+import numpy as np
+import pandas as pd
+from typing import Any, Optional
+from loguru import logger
+
+from core.tools.base import Tool
+from core.tools.interaction import InteractionRetriever
+from core.tools.preranker import split_files
+
+def expertise_path(data_sample: Optional[pd.Series]) -> Optional[str]:
+    """Get the deepest directory shared by all files of a PR, to look up in the `ExpertiseIndex`.
+
+    Args:
+        `data_sample` (`Optional[pd.Series]`): The data sample of the PR, with `files`.
+    Returns:
+        `Optional[str]`: The directory, or `None` if the files share no directory.
+    """
+    if data_sample is None or 'files' not in data_sample:
+        return None
+    directories = [path[:-1] for path in split_files(data_sample['files'])]
+    if len(directories) == 0:
+        return None
+    common = directories[0]
+    for directory in directories[1:]:
+        n = 0
+        while n < min(len(common), len(directory)) and common[n] == directory[n]:
+            n += 1
+        common = common[:n]
+    return '/'.join(common) if len(common) > 0 else None
+
+class _TrieNode:
+    __slots__ = ['children', 'keys', 'starts', 'times']
+
+    def __init__(self) -> None:
+        self.children: dict[str, _TrieNode] = {}
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.starts = np.zeros(0, dtype=np.int64)
+        self.times = np.zeros(0, dtype=np.int64)
+
+class ExpertiseIndex(Tool):
+    """
+    A trie over the path components of the files in the interaction data. Each node holds the interactions that touched a file under its path, grouped by reviewer and sorted by `grant_time` like the `HistoryIndex`. A lookup walks the trie to the prefix and counts the interactions before the cutoff of each reviewer, so its cost depends on the number of interactions under the prefix, not on the size of the data.
+
+    The interactions come from the interaction tool configured by `interaction_config`, shared through the `TOOL_REGISTRY`. Use `extend` to add the interactions of `core.dataset.recommend_rev.update_data` without rebuilding the trie.
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        from core.tools import TOOL_REGISTRY
+        assert 'interaction_config' in self.config, 'Interaction config not found in config.'
+        interaction: InteractionRetriever = TOOL_REGISTRY.acquire('interaction', self.config['interaction_config'])
+        try:
+            positions = np.arange(len(interaction.columns['reviewer_id']))
+            files = interaction.column_values('files', positions)
+            reviewer_ids = np.asarray(interaction.column_values('reviewer_id', positions), dtype=np.int64)
+            grant_time = np.asarray(interaction.column_values('grant_time', positions), dtype=np.int64)
+        finally:
+            # Only needed to build the trie
+            TOOL_REGISTRY.release(interaction)
+        self.root = _TrieNode()
+        n_nodes = self._insert(files, reviewer_ids, grant_time)
+        logger.debug(f'Built the expertise trie with {n_nodes} nodes from {len(files)} interactions')
+
+    def _insert(self, files: list, reviewer_ids: np.ndarray, grant_time: np.ndarray) -> int:
+        # Positions of the interactions under each node touched by `files`, creating the missing nodes
+        touched: dict[int, tuple[_TrieNode, list[int]]] = {}
+        for position, paths in enumerate(files):
+            for path in split_files(paths):
+                node = self.root
+                for component in path:
+                    if component not in node.children:
+                        node.children[component] = _TrieNode()
+                    node = node.children[component]
+                    positions = touched.setdefault(id(node), (node, []))[1]
+                    # An interaction counts once per node, even if it touched several files under it
+                    if len(positions) == 0 or positions[-1] != position:
+                        positions.append(position)
+        for node, positions in touched.values():
+            positions = np.array(positions, dtype=np.int64)
+            # The interactions already in the node come first, so ties keep the order of the data
+            ids = np.concatenate([np.repeat(node.keys, np.diff(np.append(node.starts, len(node.times)))), reviewer_ids[positions]])
+            times = np.concatenate([node.times, grant_time[positions]])
+            order = np.lexsort((times, ids))
+            ids, node.times = ids[order], times[order]
+            node.starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]]) if len(ids) > 0 else np.zeros(0, dtype=np.int64)
+            node.keys = ids[node.starts]
+        return len(touched)
+
+    def extend(self, data: pd.DataFrame) -> None:
+        """Add new interactions, e.g. from `core.dataset.recommend_rev.update_data`. Only the nodes under their files are updated.
+
+        Args:
+            `data` (`pd.DataFrame`): The new interactions, with `files`, `reviewer_id` and `grant_time`.
+        """
+        n_nodes = self._insert(data['files'].tolist(), data['reviewer_id'].to_numpy(dtype=np.int64), data['grant_time'].to_numpy(dtype=np.int64))
+        logger.debug(f'Added {len(data)} interactions to {n_nodes} nodes of the expertise trie')
+
+    def reset(self, *args, **kwargs) -> None:
+        # The index is shared between agents, so the time cutoff is passed with each query instead of stored here.
+        pass
+
+    def _find(self, path: str) -> Optional[_TrieNode]:
+        node = self.root
+        for component in path.strip('/').split('/'):
+            if component == '':
+                continue
+            if component not in node.children:
+                return None
+            node = node.children[component]
+        return node
+
+    def lookup(self, path: str, submit_time: int, k: Optional[int] = None) -> list[tuple[int, int, int]]:
+        """Get the reviewers who reviewed files under a path before the cutoff.
+
+        Args:
+            `path` (`str`): The path prefix, matched by whole components, e.g. `src/corelib`.
+            `submit_time` (`int`): The time cutoff. Only interactions with `grant_time < submit_time` count.
+            `k` (`Optional[int]`, optional): Only return the top `k` reviewers. Defaults to `None` (all).
+        Returns:
+            `list[tuple[int, int, int]]`: The reviewer id, the number of reviews under the path and the last review time, by decreasing number of reviews and then recency.
+        """
+        node = self._find(path)
+        if node is None or len(node.keys) == 0:
+            return []
+        counts = np.add.reduceat((node.times < submit_time).astype(np.int64), node.starts)
+        valid = np.flatnonzero(counts > 0)
+        last = node.times[node.starts[valid] + counts[valid] - 1]
+        order = valid[np.lexsort((-last, -counts[valid]))][:k]
+        last_by_group = dict(zip(valid.tolist(), last.tolist()))
+        return [(int(node.keys[i]), int(counts[i]), last_by_group[i]) for i in order.tolist()]
+
+    def reviewer_lookup(self, reviewer_id: int, path: str, submit_time: int) -> tuple[int, Optional[int]]:
+        """Get the expertise of one reviewer under a path before the cutoff.
+
+        Args:
+            `reviewer_id` (`int`): The reviewer id.
+            `path` (`str`): The path prefix, matched by whole components.
+            `submit_time` (`int`): The time cutoff.
+        Returns:
+            `tuple[int, Optional[int]]`: The number of reviews under the path and the last review time, or `None` if there is none.
+        """
+        node = self._find(path)
+        if node is None:
+            return 0, None
+        i = int(np.searchsorted(node.keys, reviewer_id))
+        if i == len(node.keys) or node.keys[i] != reviewer_id:
+            return 0, None
+        start = int(node.starts[i])
+        end = int(node.starts[i + 1]) if i + 1 < len(node.starts) else len(node.times)
+        count = int(np.searchsorted(node.times[start:end], submit_time, side='left'))
+        return count, (int(node.times[start + count - 1]) if count > 0 else None)
+
+    @staticmethod
+    def _format_time(timestamp: int) -> str:
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+    def expertise(self, path: str, k: int, submit_time: Optional[int] = None, *args: Any, **kwargs: Any) -> str:
+        if submit_time is None:
+            raise ValueError('Expertise not found. Please provide the submit time of the current PR.')
+        reviewers = self.lookup(path, submit_time, k)
+        if len(reviewers) == 0:
+            return f'No reviewer found for path {path}.'
+        return f'Retrieved {len(reviewers)} reviewers who reviewed files under {path} before: ' + ', '.join(f'{reviewer_id} ({count} reviews, last on {self._format_time(last)})' for reviewer_id, count, last in reviewers)
+
+    def reviewer_expertise(self, reviewer_id: int, path: str, submit_time: Optional[int] = None, *args: Any, **kwargs: Any) -> str:
+        if submit_time is None:
+            raise ValueError('Expertise not found. Please provide the submit time of the current PR.')
+        count, last = self.reviewer_lookup(reviewer_id, path, submit_time)
+        if count == 0:
+            return f'Reviewer {reviewer_id} has not reviewed files under {path} before.'
+        return f'Reviewer {reviewer_id} reviewed {count} PRs with files under {path} before, last on {self._format_time(last)}.'
@@ -1,48 +1,117 @@
+import os
+import sys
+import numpy as np
 import pandas as pd
+from typing import Optional
 
 from core.tools.base import Tool
+from core.utils import ColumnarTable, StringColumn
+
+def render_profiles(data: pd.DataFrame, id_column: str, text_column: str, header: str) -> tuple[dict[int, str], set[int]]:
+    """Render the profile string of every row at once.
+
+    Args:
+        `data` (`pd.DataFrame`): The info table.
+        `id_column` (`str`): The id column.
+        `text_column` (`str`): The column holding a ready-made profile. If present, it is used instead of the other columns.
+        `header` (`str`): The header of the rendered profile, formatted with `id`.
+    Returns:
+        `tuple[dict[int, str], set[int]]`: The interned profile of each id, and the ids with more than one row.
+    """
+    if text_column in data.columns:
+        rendered = data[text_column].str.replace('\n', '; ', regex=False)
+    else:
+        columns = data.columns.drop(id_column)
+        parts = [column + ': ' + data[column].map(str) for column in columns]
+        profile = parts[0].str.cat(parts[1:], sep='; ') if len(parts) > 0 else pd.Series('', index=data.index)
+        prefix, suffix = header.split('{id}')
+        rendered = prefix + data[id_column].map(str) + suffix + profile
+    ids = data[id_column]
+    duplicates = set(ids[ids.duplicated(keep=False)].tolist())
+    profiles: dict[int, str] = {}
+    for id, text in zip(ids.tolist(), rendered.tolist()):
+        if id not in profiles:
+            profiles[id] = sys.intern(text) if isinstance(text, str) else text
+    return profiles, duplicates
+
+class ProfileIndex:
+    """
+    Ready-made profiles of a memory-mapped columnar table sorted by id, stored already rendered by `core.dataset.columnar`. Supports `in` and `[]` like the dict returned by `render_profiles`, with a binary search over the ids.
+    """
+    def __init__(self, ids: np.ndarray, texts: StringColumn) -> None:
+        self.ids = ids
+        self.texts = texts
+
+    def _find(self, id: int) -> Optional[int]:
+        i = int(np.searchsorted(self.ids, id))
+        if i == len(self.ids) or self.ids[i] != id:
+            return None
+        return i
+
+    def __contains__(self, id: int) -> bool:
+        return self._find(id) is not None
+
+    def __getitem__(self, id: int) -> str:
+        i = self._find(id)
+        if i is None:
+            raise KeyError(id)
+        return self.texts[i]
+
+def load_profiles(path: str, id_column: str, text_column: str, header: str) -> tuple[dict[int, str] | ProfileIndex, set[int]]:
+    """Load the profiles of a columnar table written by `core.dataset.columnar`. The ready-made profiles are memory-mapped. Tables without them are loaded and rendered with `render_profiles`.
+
+    Args:
+        `path` (`str`): The directory of the table.
+        `id_column` (`str`): The id column.
+        `text_column` (`str`): The column holding a ready-made profile.
+        `header` (`str`): The header of the rendered profile, formatted with `id`.
+    Returns:
+        `tuple[dict[int, str] | ProfileIndex, set[int]]`: The profile of each id, and the ids with more than one row.
+    """
+    table = ColumnarTable(path)
+    assert id_column in table, f'{id_column} column not found in {path}.'
+    if text_column not in table:
+        return render_profiles(table.to_frame(), id_column, text_column, header)
+    ids = table[id_column]
+    duplicates = set(ids[1:][ids[1:] == ids[:-1]].tolist())
+    return ProfileIndex(ids, table[text_column]), duplicates
 
 class InfoDatabase(Tool):
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         pr_info_path = self.config.get('pr_info', None)
         reviewer_info_path = self.config.get('reviewer_info', None)
-        if pr_info_path is not None:
-            self._pr_info = pd.read_csv(pr_info_path, sep=',')
-            assert 'PR_id' in self._pr_info.columns, 'PR_id column not found in PR_info.'
-        if reviewer_info_path is not None:
-            self._reviewer_info = pd.read_csv(reviewer_info_path, sep=',')
-            assert 'reviewer_id' in self._reviewer_info.columns, 'reviewer_id column not found in reviewer_info.'
-        
+        pr_info_columnar = self.config.get('pr_info_columnar', None)
+        reviewer_info_columnar = self.config.get('reviewer_info_columnar', None)
+        if pr_info_columnar is not None and os.path.exists(pr_info_columnar):
+            self._pr_info, self._pr_duplicates = load_profiles(pr_info_columnar, 'PR_id', 'PR_info', 'PR {id} Info:\n')
+        elif pr_info_path is not None:
+            # Only the rendered profiles are kept, the tables are dropped after loading
+            pr_info = pd.read_csv(pr_info_path, sep=',')
+            assert 'PR_id' in pr_info.columns, 'PR_id column not found in PR_info.'
+            self._pr_info, self._pr_duplicates = render_profiles(pr_info, 'PR_id', 'PR_info', 'PR {id} Info:\n')
+        if reviewer_info_columnar is not None and os.path.exists(reviewer_info_columnar):
+            self._reviewer_info, self._reviewer_duplicates = load_profiles(reviewer_info_columnar, 'reviewer_id', 'reviewer_profile', 'Reviewer {id} Profile:\n')
+        elif reviewer_info_path is not None:
+            reviewer_info = pd.read_csv(reviewer_info_path, sep=',')
+            assert 'reviewer_id' in reviewer_info.columns, 'reviewer_id column not found in reviewer_info.'
+            self._reviewer_info, self._reviewer_duplicates = render_profiles(reviewer_info, 'reviewer_id', 'reviewer_profile', 'Reviewer {id} Profile:\n')
+
     def reset(self, *args, **kwargs) -> None:
         pass
-    
+
     def pr_info(self, PR_id: int) -> str:
         if not hasattr(self, '_pr_info'):
             return 'PR info database not available.'
-        info = self._pr_info[self._pr_info['PR_id'] == PR_id]
-        if info.empty:
+        if PR_id not in self._pr_info:
             return f'PR {PR_id} not found in PR info database.'
-        assert len(info) == 1, f'Multiple entries found for PR {PR_id}.'
-        if 'PR_info' in self._pr_info.columns:
-            return info['PR_info'].values[0].replace('\n', '; ')
-        else:
-            columns = self._pr_info.columns
-            columns = columns.drop('PR_id')
-            profile = '; '.join([f'{column}: {info[column].values[0]}' for column in columns])
-            return f'PR {PR_id} Info:\n{profile}'
-    
+        assert PR_id not in self._pr_duplicates, f'Multiple entries found for PR {PR_id}.'
+        return self._pr_info[PR_id]
+
     def reviewer_info(self, reviewer_id: int) -> str:
         if not hasattr(self, '_reviewer_info'):
             return 'Reviewer info database not available.'
-        info = self._reviewer_info[self._reviewer_info['reviewer_id'] == reviewer_id]
-        if info.empty:
+        if reviewer_id not in self._reviewer_info:
             return f'Reviewer {reviewer_id} not found in reviewer info database.'
-        assert len(info) == 1, f'Multiple entries found for reviewer {reviewer_id}.'
-        if 'reviewer_profile' in self._reviewer_info.columns:
-            return info['reviewer_profile'].values[0].replace('\n', '; ')
-        else:
-            columns = self._reviewer_info.columns
-            columns = columns.drop('reviewer_id')
-            profile = '; '.join([f'{column}: {info[column].values[0]}' for column in columns])
-            return f'Reviewer {reviewer_id} Profile:\n{profile}'
+        assert reviewer_id not in self._reviewer_duplicates, f'Multiple entries found for reviewer {reviewer_id}.'
+        return self._reviewer_info[reviewer_id]
@@ -1,60 +1,197 @@
+import os
+import numpy as np
 import pandas as pd
 from typing import Optional
 
 from core.tools.base import Tool
+from core.utils import ColumnarTable, StringColumn, ListColumn
+
+class HistoryIndex:
+    """
+    A time-indexed view of the interactions grouped by one key column. Interactions are kept sorted by `grant_time`, so the rows of each group form a sorted run and "the last k interactions before t" is answered with a binary search. The index is made of flat arrays, so it can be saved next to a columnar table and memory-mapped back.
+    """
+    ARRAYS = ['order', 'times', 'keys', 'starts', 'ends']
+
+    def __init__(self, keys: Optional[np.ndarray] = None, grant_time: Optional[np.ndarray] = None) -> None:
+        """Build the index. Leave the arguments empty to fill the arrays from `load`.
+
+        Args:
+            `keys` (`Optional[np.ndarray]`): The group key of each interaction, e.g. `PR_id` or `reviewer_id`.
+            `grant_time` (`Optional[np.ndarray]`): The grant time of each interaction. Must be sorted in ascending order.
+        """
+        if keys is None:
+            return
+        self.order = np.argsort(keys, kind='stable')
+        self.times = grant_time[self.order]
+        self.keys, self.starts, counts = np.unique(keys[self.order], return_index=True, return_counts=True)
+        self.ends = self.starts + counts
+
+    def save(self, path: str, name: str) -> None:
+        """Save the index arrays as `{name}.index.<array>.npy` files in `path`.
+
+        Args:
+            `path` (`str`): The directory to save to.
+            `name` (`str`): The name of the index, usually the key column.
+        """
+        for array in self.ARRAYS:
+            # The arrays may be memory-mapped from the files being replaced, so they are written aside and moved over them
+            file = os.path.join(path, f'{name}.index.{array}.npy')
+            np.save(file + '.tmp.npy', getattr(self, array))
+            os.replace(file + '.tmp.npy', file)
+
+    @classmethod
+    def load(cls, path: str, name: str) -> 'HistoryIndex':
+        """Memory-map an index saved by `save`.
+
+        Args:
+            `path` (`str`): The directory of the index.
+            `name` (`str`): The name of the index.
+        Returns:
+            `HistoryIndex`: The index.
+        """
+        index = cls()
+        for array in cls.ARRAYS:
+            setattr(index, array, np.load(os.path.join(path, f'{name}.index.{array}.npy'), mmap_mode='r'))
+        return index
+
+    def extend(self, keys: np.ndarray, grant_time: np.ndarray, positions: np.ndarray) -> None:
+        """Add new interactions to the index without rebuilding it. Each one is inserted into the run of its key after the interactions with the same or an earlier `grant_time`, so the new interactions may be appended to the data in any order.
+
+        Args:
+            `keys` (`np.ndarray`): The group key of each new interaction.
+            `grant_time` (`np.ndarray`): The grant time of each new interaction.
+            `positions` (`np.ndarray`): The positions of the new interactions in the data.
+        """
+        if len(keys) == 0:
+            return
+        new = np.lexsort((positions, grant_time, keys))
+        keys, grant_time, positions = keys[new], grant_time[new], positions[new]
+        groups = np.searchsorted(self.keys, keys)
+        insert = np.empty(len(keys), dtype=np.int64)
+        for i, (group, key, time) in enumerate(zip(groups.tolist(), keys.tolist(), grant_time.tolist())):
+            if group < len(self.keys) and self.keys[group] == key:
+                start, end = int(self.starts[group]), int(self.ends[group])
+                insert[i] = start + int(np.searchsorted(self.times[start:end], time, side='right'))
+            else:
+                # A new key starts its run where the next larger key begins
+                insert[i] = int(self.starts[group]) if group < len(self.keys) else len(self.order)
+        sorted_keys = np.insert(np.repeat(np.asarray(self.keys), self.ends - self.starts), insert, keys)
+        self.order = np.insert(self.order, insert, positions)
+        self.times = np.insert(self.times, insert, grant_time)
+        self.starts = np.concatenate([[0], np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1])
+        self.keys = sorted_keys[self.starts]
+        self.ends = np.append(self.starts[1:], len(sorted_keys))
+
+    def last_before(self, key: int, submit_time: int, k: int) -> np.ndarray:
+        """Get the positions of the last `k` interactions of `key` with `grant_time < submit_time`.
+
+        Args:
+            `key` (`int`): The group key.
+            `submit_time` (`int`): The time cutoff.
+            `k` (`int`): The number of interactions to retrieve.
+        Returns:
+            `np.ndarray`: The positions of the retrieved interactions in time order. Empty if there is no history.
+        """
+        i = int(np.searchsorted(self.keys, key))
+        if i == len(self.keys) or self.keys[i] != key:
+            return self.order[:0]
+        start, end = int(self.starts[i]), int(self.ends[i])
+        cut = start + int(np.searchsorted(self.times[start:end], submit_time, side='left'))
+        return self.order[start:cut][-k:]
 
 class InteractionRetriever(Tool):
+    COLUMNS = ['PR_id', 'reviewer_id', 'files', 'project', 'subject', 'duration', 'grant_date', 'grant_time']
+
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
+        columnar_path = self.config.get('columnar_path', None)
+        if columnar_path is not None and os.path.exists(columnar_path):
+            # Written by `core.dataset.columnar`, already indexed by grant_time
+            table = ColumnarTable(columnar_path)
+            self.PR_index = HistoryIndex.load(columnar_path, 'PR_id')
+            self.reviewer_index = HistoryIndex.load(columnar_path, 'reviewer_id')
+            self.columns: dict[str, np.ndarray | StringColumn | ListColumn] = {column: table[column] for column in self.COLUMNS}
+            return
         data_path = self.config['data_path']
         assert data_path is not None, 'Data path not found in config.'
         self.data = pd.read_csv(data_path, sep=',')
-        self.data = self.data.sort_values(by=['grant_time'], kind='mergesort')
+        self.data = self.data.sort_values(by=['grant_time'], kind='mergesort').reset_index(drop=True)
         assert 'PR_id' in self.data.columns, 'PR_id not found in data.'
         assert 'reviewer_id' in self.data.columns, 'reviewer_id not found in data.'
-        self.PR_history = None
-        self.reviewer_history = None
-    
-    def reset(self, submit_time: Optional[int] = None, *args, **kwargs) -> None:
-        if submit_time is not None:
-            partial_data = self.data[self.data['grant_time'] < submit_time]
-            self.PR_history = partial_data.groupby('PR_id')['reviewer_id'].apply(list).to_dict()
-            self.PR_files = partial_data.groupby('PR_id')['files'].apply(list).to_dict()
-            self.reviewer_history = partial_data.groupby('reviewer_id')['PR_id'].apply(list).to_dict()
-            self.reviewer_files = partial_data.groupby('reviewer_id')['files'].apply(list).to_dict()
-            self.reviewer_project = partial_data.groupby('reviewer_id')['project'].apply(list).to_dict()
-            self.reviewer_subject = partial_data.groupby('reviewer_id')['subject'].apply(list).to_dict()
-            self.reviewer_duration = partial_data.groupby('reviewer_id')['duration'].apply(list).to_dict()
-            self.reviewer_date = partial_data.groupby('reviewer_id')['grant_date'].apply(list).to_dict()
-        else:
-            self.partial_data = None
-            self.PR_history = None
-            self.PR_files = None
-            self.reviewer_history = None
-            self.reviewer_files = None
-            self.reviewer_project = None
-            self.reviewer_subject = None
-            self.reviewer_duration = None
-            self.reviewer_date = None
-
-    def pr_retrieve(self, PR_id: int, k: int, *args, **kwargs) -> str:
-        if self.PR_history is None:
-            raise ValueError('PR history not found. Please reset the PR_id and reviewer_id.')
-        if PR_id not in self.PR_history:
+        grant_time = self.data['grant_time'].to_numpy()
+        self.PR_index = HistoryIndex(self.data['PR_id'].to_numpy(), grant_time)
+        self.reviewer_index = HistoryIndex(self.data['reviewer_id'].to_numpy(), grant_time)
+        self.columns = {column: self.data[column].to_numpy() for column in self.COLUMNS}
+
+    def reset(self, *args, **kwargs) -> None:
+        # The retriever is shared between agents, so the time cutoff is passed with each query instead of stored here.
+        pass
+
+    def extend(self, data: pd.DataFrame) -> None:
+        """Append new interactions, e.g. from `core.dataset.recommend_rev.update_data`, and add them to the history indexes. Only for data loaded from `data_path`; the columnar tables are extended on disk by `core.dataset.columnar.append_to_columnar`.
+
+        Args:
+            `data` (`pd.DataFrame`): The new interactions, with the columns of the loaded data.
+        """
+        assert hasattr(self, 'data'), 'Only data loaded from data_path can be extended, reload the columnar tables instead.'
+        start = len(self.data)
+        self.data = pd.concat([self.data, data[self.data.columns]], ignore_index=True)
+        positions = np.arange(start, len(self.data))
+        grant_time = data['grant_time'].to_numpy()
+        self.PR_index.extend(data['PR_id'].to_numpy(), grant_time, positions)
+        self.reviewer_index.extend(data['reviewer_id'].to_numpy(), grant_time, positions)
+        self.columns = {column: self.data[column].to_numpy() for column in self.COLUMNS}
+
+    def column_values(self, column: str, positions: np.ndarray) -> list:
+        values = self.columns[column]
+        if isinstance(values, np.ndarray):
+            return values[positions].tolist()
+        return values.take(positions.tolist())
+
+    def last_reviewer_interaction(self, reviewer_id: int, submit_time: int) -> int:
+        """Get the position of the last interaction of a reviewer before the cutoff. The reviewer history seen by an agent only changes when this position does.
+
+        Args:
+            `reviewer_id` (`int`): The reviewer id.
+            `submit_time` (`int`): The time cutoff.
+        Returns:
+            `int`: The position of the interaction in the data, or `-1` if the reviewer has no history before the cutoff.
+        """
+        positions = self.reviewer_index.last_before(reviewer_id, submit_time, 1)
+        return int(positions[0]) if len(positions) > 0 else -1
+
+    def reviewer_positions(self, reviewer_id: int, submit_time: int, k: int) -> np.ndarray:
+        """Get the positions of the last `k` interactions of a reviewer before the cutoff, to read with `column_values`.
+
+        Args:
+            `reviewer_id` (`int`): The reviewer id.
+            `submit_time` (`int`): The time cutoff.
+            `k` (`int`): The number of interactions to retrieve.
+        Returns:
+            `np.ndarray`: The positions of the interactions in time order.
+        """
+        return self.reviewer_index.last_before(reviewer_id, submit_time, k)
+
+    def pr_retrieve(self, PR_id: int, k: int, submit_time: Optional[int] = None, *args, **kwargs) -> str:
+        if submit_time is None:
+            raise ValueError('PR history not found. Please provide the submit time of the current PR.')
+        positions = self.PR_index.last_before(PR_id, submit_time, k)
+        if len(positions) == 0:
             return f'No history found for PR {PR_id}.'
-        retrieved_id = self.PR_history[PR_id][-k:]
-        retrieved_files = self.PR_files[PR_id][-k:]
+        retrieved_id = self.column_values('reviewer_id', positions)
+        retrieved_files = self.column_values('files', positions)
         return f'Retrieved {len(retrieved_id)} reviewers that PR {PR_id} interacted with before: {", ".join(map(str, retrieved_id))} with files: {", ".join(map(str, retrieved_files))}'
 
-    def reviewer_retrieve(self, reviewer_id: int, k: int, *args, **kwargs) -> str:
-        if self.reviewer_history is None:
-            raise ValueError('Reviewer history not found. Please reset the PR_id and reviewer_id.')
-        if reviewer_id not in self.reviewer_history:
+    def reviewer_retrieve(self, reviewer_id: int, k: int, submit_time: Optional[int] = None, *args, **kwargs) -> str:
+        if submit_time is None:
+            raise ValueError('Reviewer history not found. Please provide the submit time of the current PR.')
+        positions = self.reviewer_index.last_before(reviewer_id, submit_time, k)
+        if len(positions) == 0:
             return f'No history found for reviewer {reviewer_id}.'
-        retrieved_id = self.reviewer_history[reviewer_id][-k:]
-        retrieved_files = self.reviewer_files[reviewer_id][-k:]
-        retrieved_project = self.reviewer_project[reviewer_id][-k:]
-        retrieved_subject = self.reviewer_subject[reviewer_id][-k:]
-        retrieved_duration = self.reviewer_duration[reviewer_id][-k:]
-        retrieved_date = self.reviewer_date[reviewer_id][-k:]
+        retrieved_id = self.column_values('PR_id', positions)
+        retrieved_files = self.column_values('files', positions)
+        retrieved_project = self.column_values('project', positions)
+        retrieved_subject = self.column_values('subject', positions)
+        retrieved_duration = self.column_values('duration', positions)
+        retrieved_date = self.column_values('grant_date', positions)
         return f'Retrieved {len(retrieved_id)} PRs that interacted with reviewer {reviewer_id} before: {", ".join(map(str, retrieved_id))}. **Projects**: {", ".join(map(str, retrieved_project))}. **Subjects**: {", ".join(map(str, retrieved_subject))}. **Files**: {", ".join(map(str, retrieved_files))}. **Duration**: {", ".join(map(str, retrieved_duration))} seconds. **Review date**: {", ".join(map(str, retrieved_date))}'
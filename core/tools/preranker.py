@@ -0,0 +1,146 @@
+import ast
+import math
+import numpy as np
+from functools import lru_cache
+from typing import Any, Optional
+
+from core.tools.base import Tool
+from core.tools.interaction import InteractionRetriever
+
+@lru_cache(maxsize=100000)
+def _split_files(files: str) -> tuple[tuple[str, ...], ...]:
+    return tuple(tuple(path.split('/')) for path in ast.literal_eval(files))
+
+def split_files(files: Any) -> tuple[tuple[str, ...], ...]:
+    """Split the file paths of a PR into their components.
+
+    Args:
+        `files` (`Any`): The file list, or its string form as stored in the CSV files.
+    Returns:
+        `tuple[tuple[str, ...], ...]`: The components of each path.
+    """
+    if isinstance(files, str):
+        return _split_files(files)
+    return tuple(tuple(str(path).split('/')) for path in files)
+
+def path_similarity(a: tuple[str, ...], b: tuple[str, ...]) -> float:
+    """The longest common prefix similarity of RevFinder: the number of leading path components two files share, divided by the length of the longer path."""
+    common = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        common += 1
+    return common / max(len(a), len(b), 1)
+
+def tie_break_keys(candidates: list[int], salt: int) -> np.ndarray:
+    """Pseudo-random keys of the candidates that only depend on their ids and the salt, used to order candidates with the same score. Unlike their order in the list, they do not favor the ground truth, which `add_candidates` puts at the same position for every PR.
+
+    Args:
+        `candidates` (`list[int]`): The candidate reviewers.
+        `salt` (`int`): Changes the keys, e.g. per PR.
+    Returns:
+        `np.ndarray`: The `uint64` key of each candidate.
+    """
+    # The splitmix64 finalizer, with wrapping arithmetic on uint64
+    x = np.array(candidates, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15) + np.uint64(int(salt) & 0xFFFFFFFFFFFFFFFF)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+def files_similarity(files: tuple[tuple[str, ...], ...], past_files: tuple[tuple[str, ...], ...]) -> float:
+    """The mean path similarity over all pairs of files of two PRs, as in RevFinder."""
+    if len(files) == 0 or len(past_files) == 0:
+        return 0.0
+    return sum(path_similarity(a, b) for a in files for b in past_files) / (len(files) * len(past_files))
+
+class PreRanker(Tool):
+    """
+    A non-LLM scorer that ranks candidate reviewers by their last `history` reviews before the PR. It combines three signals, each normalized over the candidates:
+
+    - `files`: the file path similarity of RevFinder, summed over the past reviews.
+    - `project`: the number of past reviews in the project of the PR.
+    - `recency`: exponential decay with the time since the last review, with a half life of `half_life_days`.
+
+    The history comes from the interaction tool configured by `interaction_config`, shared through the `TOOL_REGISTRY`.
+    """
+    SIGNALS = ['files', 'project', 'recency']
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        from core.tools import TOOL_REGISTRY
+        assert 'interaction_config' in self.config, 'Interaction config not found in config.'
+        self.interaction: InteractionRetriever = TOOL_REGISTRY.acquire('interaction', self.config['interaction_config'])
+        self.history: int = self.config.get('history', 50)
+        self.half_life: float = self.config.get('half_life_days', 90) * 86400
+        weights: dict[str, float] = self.config.get('weights', {})
+        assert set(weights.keys()) <= set(self.SIGNALS), f'Unknown signals in weights: {set(weights.keys()) - set(self.SIGNALS)}.'
+        self.weights = np.array([weights.get(signal, 1.0) for signal in self.SIGNALS])
+        self.seed: int = self.config.get('seed', 0)
+        # Decoding the history dominates the cost, and the same interactions come up for many PRs
+        self._interaction = lru_cache(maxsize=self.config.get('cache_size', 100000))(self._read_interaction)
+
+    def reset(self, *args, **kwargs) -> None:
+        pass
+
+    def __del__(self) -> None:
+        if getattr(self, 'interaction', None) is not None:
+            from core.tools import TOOL_REGISTRY
+            TOOL_REGISTRY.release(self.interaction)
+
+    def _read_interaction(self, position: int) -> tuple[tuple[tuple[str, ...], ...], str, int]:
+        positions = np.array([position])
+        files, project, grant_time = (self.interaction.column_values(column, positions)[0] for column in ['files', 'project', 'grant_time'])
+        return split_files(files), project, int(grant_time)
+
+    def signals(self, reviewer_id: int, files: tuple[tuple[str, ...], ...], project: str, submit_time: int) -> list[float]:
+        """Compute the raw signals of one candidate.
+
+        Args:
+            `reviewer_id` (`int`): The candidate reviewer.
+            `files` (`tuple[tuple[str, ...], ...]`): The split file paths of the PR.
+            `project` (`str`): The project of the PR.
+            `submit_time` (`int`): The submit time of the PR. Only reviews granted before it are used.
+        Returns:
+            `list[float]`: The value of each signal in `SIGNALS`.
+        """
+        positions = self.interaction.reviewer_positions(reviewer_id, submit_time, self.history)
+        if len(positions) == 0:
+            return [0.0, 0.0, 0.0]
+        history = [self._interaction(position) for position in positions.tolist()]
+        file_score = sum(files_similarity(files, past_files) for past_files, _, _ in history)
+        project_score = float(sum(past_project == project for _, past_project, _ in history))
+        recency_score = math.exp(-math.log(2) * max(submit_time - history[-1][2], 0) / self.half_life)
+        return [file_score, project_score, recency_score]
+
+    def score(self, candidates: list[int], files: Any, project: str, submit_time: int) -> np.ndarray:
+        """Score the candidates of a PR.
+
+        Args:
+            `candidates` (`list[int]`): The candidate reviewers.
+            `files` (`Any`): The file list of the PR, or its string form.
+            `project` (`str`): The project of the PR.
+            `submit_time` (`int`): The submit time of the PR.
+        Returns:
+            `np.ndarray`: The score of each candidate.
+        """
+        files = split_files(files)
+        signals = np.array([self.signals(candidate, files, project, submit_time) for candidate in candidates], dtype=float).reshape(len(candidates), len(self.SIGNALS))
+        top = signals.max(axis=0)
+        signals = np.divide(signals, top, out=np.zeros_like(signals), where=top > 0)
+        return signals @ self.weights
+
+    def rank(self, candidates: list[int], files: Any, project: str, submit_time: int, top_m: Optional[int] = None) -> list[int]:
+        """Rank the candidates of a PR by score. Ties are broken by `tie_break_keys` of the candidate ids, salted with the seed and the submit time of the PR, so the result does not depend on the order of `candidates`.
+
+        Args:
+            `candidates` (`list[int]`): The candidate reviewers.
+            `files` (`Any`): The file list of the PR, or its string form.
+            `project` (`str`): The project of the PR.
+            `submit_time` (`int`): The submit time of the PR.
+            `top_m` (`Optional[int]`, optional): Only return the first `top_m` candidates. Defaults to `None` (all).
+        Returns:
+            `list[int]`: The ranked candidates.
+        """
+        keys = tie_break_keys(candidates, self.seed * 1000003 + int(submit_time))
+        order = np.lexsort((keys, -self.score(candidates, files, project, submit_time)))
+        return [candidates[i] for i in order[:top_m]]
@@ -0,0 +1,88 @@
+import os
+import threading
+from loguru import logger
+
+from core.tools.base import Tool
+
+class ToolRegistry:
+    """
+    A process-wide registry of tools. Tools are keyed by their type and the resolved path of their config file, so agents (and web demo sessions) declaring the same tool share one read-only instance. Use `acquire` to get a tool and `release` to give it back. A tool is dropped once no one holds it anymore.
+    """
+    def __init__(self, tool_map: dict[str, type]) -> None:
+        """Initialize the registry.
+
+        Args:
+            `tool_map` (`dict[str, type]`): A mapping from tool type names to tool classes.
+        """
+        self.tool_map = tool_map
+        self._tools: dict[tuple[str, str], Tool] = {}
+        self._refcounts: dict[tuple[str, str], int] = {}
+        # Reentrant, as a tool may acquire the tools it builds on while it is loading
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _key(tool_type: str, config_path: str) -> tuple[str, str]:
+        return tool_type, os.path.realpath(config_path)
+
+    def acquire(self, tool_type: str, config_path: str) -> Tool:
+        """Get the shared instance of a tool, loading it on first use.
+
+        Args:
+            `tool_type` (`str`): The type of the tool. Must be a key of the tool map.
+            `config_path` (`str`): The path to the config file of the tool.
+        Raises:
+            `NotImplementedError`: If the tool type is not supported.
+        Returns:
+            `Tool`: The shared tool instance.
+        """
+        if tool_type not in self.tool_map:
+            raise NotImplementedError(f'Docstore {tool_type} not implemented.')
+        key = self._key(tool_type, config_path)
+        with self._lock:
+            if key not in self._tools:
+                logger.debug(f'Loading tool {tool_type} from {key[1]}')
+                self._tools[key] = self.tool_map[tool_type](config_path=config_path)
+                self._refcounts[key] = 0
+            self._refcounts[key] += 1
+            return self._tools[key]
+
+    def retain(self, tool: Tool) -> None:
+        """Take one more reference to a tool obtained from `acquire`, e.g. for a copy of the agent holding it. Each `retain` must be paired with a `release`.
+
+        Args:
+            `tool` (`Tool`): The tool to retain.
+        """
+        with self._lock:
+            for key, shared in list(self._tools.items()):
+                if shared is tool:
+                    self._refcounts[key] += 1
+                    return
+
+    def release(self, tool: Tool) -> None:
+        """Give back a tool obtained from `acquire`. The tool is dropped from the registry when its reference count reaches zero.
+
+        Args:
+            `tool` (`Tool`): The tool to release.
+        """
+        with self._lock:
+            # A snapshot, as dropping a tool may run the `__del__` of objects releasing other tools on this thread
+            for key, shared in list(self._tools.items()):
+                if shared is tool:
+                    self._refcounts[key] -= 1
+                    if self._refcounts[key] == 0:
+                        logger.debug(f'Unloading tool {key[0]} from {key[1]}')
+                        del self._tools[key]
+                        del self._refcounts[key]
+                    return
+
+    def refcount(self, tool_type: str, config_path: str) -> int:
+        """Get the number of holders of a tool.
+
+        Args:
+            `tool_type` (`str`): The type of the tool.
+            `config_path` (`str`): The path to the config file of the tool.
+        Returns:
+            `int`: The number of holders. `0` if the tool is not loaded.
+        """
+        with self._lock:
+            return self._refcounts.get(self._key(tool_type, config_path), 0)
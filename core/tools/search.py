@@ -0,0 +1,170 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from typing import Optional
+from loguru import logger
+from sklearn.feature_extraction.text import CountVectorizer
+
+from core.tools.base import Tool
+from core.tools.info_database import render_profiles
+from core.tools.preranker import split_files
+
+class BM25Index:
+    """
+    An inverted index over a list of documents scored with Okapi BM25. The BM25 weight of every (document, term) pair is computed once when building, so a query only sums the columns of its terms in a sparse matrix. Words and path components are tokens, e.g. `src/corelib/qstring.cpp` gives `src`, `corelib`, `qstring` and `cpp`.
+    """
+    def __init__(self, documents: list[str], k1: float = 1.2, b: float = 0.75) -> None:
+        """Build the index.
+
+        Args:
+            `documents` (`list[str]`): The text of each document.
+            `k1` (`float`, optional): The term frequency saturation of BM25. Defaults to `1.2`.
+            `b` (`float`, optional): The document length normalization of BM25. Defaults to `0.75`.
+        """
+        self.vectorizer = CountVectorizer(token_pattern=r'(?u)\b\w+\b', dtype=np.float64)
+        if len(documents) == 0:
+            self.weights = sparse.csc_matrix((0, 0))
+            return
+        tf = self.vectorizer.fit_transform(documents).tocsr()
+        lengths = np.asarray(tf.sum(axis=1)).reshape(-1)
+        df = np.bincount(tf.indices, minlength=tf.shape[1])
+        idf = np.log(1 + (tf.shape[0] - df + 0.5) / (df + 0.5))
+        norm = k1 * (1 - b + b * lengths / max(lengths.mean(), 1))
+        # Row of each stored value, to normalize by the length of its document
+        rows = np.repeat(np.arange(tf.shape[0]), np.diff(tf.indptr))
+        tf.data = tf.data * (k1 + 1) / (tf.data + norm[rows]) * idf[tf.indices]
+        self.weights = tf.tocsc()
+
+    def __len__(self) -> int:
+        return self.weights.shape[0]
+
+    def scores(self, query: str) -> np.ndarray:
+        """Score every document for a query.
+
+        Args:
+            `query` (`str`): The query text.
+        Returns:
+            `np.ndarray`: The BM25 score of each document. All zeros if no term of the query is indexed.
+        """
+        if self.weights.shape[1] == 0:
+            return np.zeros(len(self))
+        terms = np.flatnonzero(self.vectorizer.transform([query]).toarray()[0])
+        return np.asarray(self.weights[:, terms].sum(axis=1)).reshape(-1)
+
+    def search(self, query: str, k: int, n: Optional[int] = None) -> list[tuple[int, float]]:
+        """Get the documents with the highest scores for a query.
+
+        Args:
+            `query` (`str`): The query text.
+            `k` (`int`): The number of documents to return.
+            `n` (`Optional[int]`, optional): Only search the first `n` documents. Defaults to `None` (all).
+        Returns:
+            `list[tuple[int, float]]`: The position and score of each matching document, by decreasing score. Documents without any term of the query are left out.
+        """
+        scores = self.scores(query)[:n]
+        matched = np.flatnonzero(scores > 0)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        matched = matched[np.argsort(-scores[matched], kind='stable')]
+        return [(i, float(scores[i])) for i in matched.tolist()]
+
+class SearchEngine(Tool):
+    """
+    A local search engine over PR subjects, projects and files, and over reviewer profiles, with one `BM25Index` each. PRs are sorted by `submit_time`, so a query only sees the PRs submitted before the current one.
+
+    The PRs are read from `pr_data`, e.g. the interaction data, with one or more rows per `PR_id`. The reviewers are read from `reviewer_info`. Both are optional. Use `extend` to add the PRs of `core.dataset.recommend_rev.update_data`.
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.k1: float = self.config.get('k1', 1.2)
+        self.b: float = self.config.get('b', 0.75)
+        self.max_files: int = self.config.get('max_files', 5)
+        pr_data_path = self.config.get('pr_data', None)
+        reviewer_info_path = self.config.get('reviewer_info', None)
+        if pr_data_path is not None:
+            self._index_prs(pd.read_csv(pr_data_path, sep=',', usecols=self.PR_COLUMNS))
+        if reviewer_info_path is not None:
+            reviewer_info = pd.read_csv(reviewer_info_path, sep=',')
+            assert 'reviewer_id' in reviewer_info.columns, 'reviewer_id column not found in reviewer_info.'
+            profiles, _ = render_profiles(reviewer_info, 'reviewer_id', 'reviewer_profile', 'Reviewer {id} Profile:\n')
+            self.reviewer_ids = list(profiles.keys())
+            self.reviewer_profiles = [str(profile) for profile in profiles.values()]
+            self.reviewer_index = BM25Index(self.reviewer_profiles, k1=self.k1, b=self.b)
+            logger.debug(f'Indexed {len(self.reviewer_ids)} reviewers for search')
+
+    PR_COLUMNS = ['PR_id', 'submit_time', 'project', 'subject', 'files']
+
+    def _index_prs(self, pr_data: pd.DataFrame) -> None:
+        pr_data = pr_data.drop_duplicates(subset=['PR_id']).sort_values(by=['submit_time'], kind='mergesort').reset_index(drop=True)
+        self.pr_data = pr_data
+        self.pr_ids = pr_data['PR_id'].to_numpy()
+        self.pr_times = pr_data['submit_time'].to_numpy()
+        self.pr_projects = pr_data['project'].map(str).tolist()
+        self.pr_subjects = pr_data['subject'].map(str).tolist()
+        self.pr_files = pr_data['files'].tolist()
+        documents = (pr_data['subject'].map(str) + ' ' + pr_data['project'].map(str) + ' ' + pr_data['files'].map(str)).tolist()
+        self.pr_index = BM25Index(documents, k1=self.k1, b=self.b)
+        logger.debug(f'Indexed {len(documents)} PRs for search')
+
+    def extend(self, data: pd.DataFrame) -> None:
+        """Add new PRs, e.g. the interactions from `core.dataset.recommend_rev.update_data`. PRs already indexed are skipped. The BM25 weights depend on the statistics of all documents, so the PR index is built again.
+
+        Args:
+            `data` (`pd.DataFrame`): The new PRs, with `PR_id`, `submit_time`, `project`, `subject` and `files`.
+        """
+        data = data[self.PR_COLUMNS]
+        if hasattr(self, 'pr_data'):
+            data = pd.concat([self.pr_data, data[~data['PR_id'].isin(self.pr_data['PR_id'])]], ignore_index=True)
+        self._index_prs(data)
+
+    def reset(self, *args, **kwargs) -> None:
+        # The engine is shared between agents, so the time cutoff is passed with each query instead of stored here.
+        pass
+
+    def _format_files(self, files: str) -> str:
+        if not isinstance(files, str) or not files.startswith('['):
+            return str(files)
+        paths = ['/'.join(path) for path in split_files(files)]
+        if len(paths) > self.max_files:
+            return ', '.join(paths[:self.max_files]) + f' and {len(paths) - self.max_files} more'
+        return ', '.join(paths)
+
+    def search_prs(self, query: str, k: int, submit_time: Optional[int] = None) -> list[tuple[str, float]]:
+        """Search the PRs submitted before the cutoff.
+
+        Args:
+            `query` (`str`): The query text.
+            `k` (`int`): The number of PRs to return.
+            `submit_time` (`Optional[int]`, optional): The time cutoff. Only PRs with `submit_time < submit_time` are searched. Defaults to `None` (all).
+        Returns:
+            `list[tuple[str, float]]`: The description and score of each PR, by decreasing score.
+        """
+        if not hasattr(self, 'pr_index'):
+            return []
+        n = int(np.searchsorted(self.pr_times, submit_time, side='left')) if submit_time is not None else None
+        return [(f'PR {self.pr_ids[i]} in project {self.pr_projects[i]}, subject: {self.pr_subjects[i]}, files: {self._format_files(self.pr_files[i])}', score) for i, score in self.pr_index.search(query, k, n)]
+
+    def search_reviewers(self, query: str, k: int) -> list[tuple[str, float]]:
+        """Search the reviewer profiles.
+
+        Args:
+            `query` (`str`): The query text.
+            `k` (`int`): The number of reviewers to return.
+        Returns:
+            `list[tuple[str, float]]`: The profile and score of each reviewer, by decreasing score.
+        """
+        if not hasattr(self, 'reviewer_index'):
+            return []
+        return [(f'Reviewer {self.reviewer_ids[i]}: {self.reviewer_profiles[i]}', score) for i, score in self.reviewer_index.search(query, k)]
+
+    def search(self, query: str, k: int, submit_time: Optional[int] = None) -> list[str]:
+        """Search the PRs and the reviewers. Scores of the two indexes are not comparable, so the PRs come first.
+
+        Args:
+            `query` (`str`): The query text.
+            `k` (`int`): The number of PRs and of reviewers to return.
+            `submit_time` (`Optional[int]`, optional): The time cutoff of the PRs. Defaults to `None` (all).
+        Returns:
+            `list[str]`: The descriptions of the results.
+        """
+        return [text for text, _ in self.search_prs(query, k, submit_time) + self.search_reviewers(query, k)]
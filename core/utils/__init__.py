@@ -1,10 +1,13 @@
 # Description: __init__ file for utils package
 from core.utils.check import EM, is_correct
+from core.utils.columnar import ColumnarTable, StringColumn, ListColumn, write_table, append_table
 from core.utils.data import collator, read_json, NumpyEncoder
 from core.utils.decorator import run_once
 from core.utils.init import init_openai_api, init_all_seeds
-from core.utils.parse import parse_action, parse_answer, init_answer, parse_json
-from core.utils.prompts import read_prompts
-from core.utils.string import format_step, format_last_attempt, format_supervisions, format_history, format_chat_history, str2list, get_avatar
+from core.utils.memo import LRUMemo
+from core.utils.parse import parse_action, parse_answer, init_answer, parse_json, is_hallucination_flagged
+from core.utils.prompts import read_prompts, static_prefix
+from core.utils.scratchpad import Scratchpad
+from core.utils.string import format_step, format_last_attempt, format_supervisions, format_history, format_chat_history, format_columns, str2list, get_avatar
 from core.utils.utils import get_rm, task2name, system2dir
 from core.utils.web import add_chat_message, get_color, get_role
\ No newline at end of file
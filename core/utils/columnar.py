@@ -0,0 +1,187 @@
+import os
+import ast
+import json
+import numpy as np
+import pandas as pd
+from typing import Iterable, Sequence
+
+def write_strings(path: str, name: str, values: Sequence[str]) -> None:
+    """Write a string table: the UTF-8 bytes of all values back to back in `{name}.values.bin`, and the `n + 1` byte offsets in `{name}.offsets.npy`.
+
+    Args:
+        `path` (`str`): The directory of the table.
+        `name` (`str`): The name of the string table.
+        `values` (`Sequence[str]`): The values to write.
+    """
+    encoded = [value.encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    np.save(os.path.join(path, f'{name}.offsets.npy'), offsets)
+    with open(os.path.join(path, f'{name}.values.bin'), 'wb') as f:
+        f.write(b''.join(encoded))
+
+class StringColumn:
+    """
+    A memory-mapped string table written by `write_strings`. Values are decoded on access.
+    """
+    def __init__(self, path: str, name: str) -> None:
+        self.offsets = np.load(os.path.join(path, f'{name}.offsets.npy'), mmap_mode='r')
+        values_path = os.path.join(path, f'{name}.values.bin')
+        # np.memmap cannot map an empty file
+        if os.path.getsize(values_path) > 0:
+            self.values = np.memmap(values_path, dtype=np.uint8, mode='r')
+        else:
+            self.values = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self.values[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    def take(self, positions: Iterable[int]) -> list[str]:
+        return [self[i] for i in positions]
+
+    def tolist(self) -> list[str]:
+        return self.take(range(len(self)))
+
+class ListColumn:
+    """
+    A memory-mapped column of string lists: the `n + 1` item offsets of each row in `{name}.list_offsets.npy`, and the items in the string table `{name}.items`.
+    """
+    def __init__(self, path: str, name: str) -> None:
+        self.offsets = np.load(os.path.join(path, f'{name}.list_offsets.npy'), mmap_mode='r')
+        self.items = StringColumn(path, f'{name}.items')
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> list[str]:
+        return self.items.take(range(self.offsets[i], self.offsets[i + 1]))
+
+    def take(self, positions: Iterable[int]) -> list[list[str]]:
+        return [self[i] for i in positions]
+
+    def tolist(self) -> list[list[str]]:
+        return self.take(range(len(self)))
+
+def _parse_list(value) -> list:
+    if isinstance(value, str):
+        value = ast.literal_eval(value)
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return list(value)
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return []
+    raise ValueError(f'Cannot read {value!r} as a list.')
+
+def write_table(data: pd.DataFrame, path: str, list_columns: Iterable[str] = ()) -> None:
+    """Write a table in the columnar layout read by `ColumnarTable`. Numeric and boolean columns are stored as `.npy` arrays, list columns as offsets and items, and all other columns as string tables. Missing values of string columns are stored as `'nan'`.
+
+    Args:
+        `data` (`pd.DataFrame`): The table to write.
+        `path` (`str`): The output directory.
+        `list_columns` (`Iterable[str]`, optional): The columns holding lists, or lists in their string form as read from a CSV file. Defaults to `()`.
+    """
+    os.makedirs(path, exist_ok=True)
+    list_columns = set(list_columns)
+    kinds: dict[str, str] = {}
+    for column in data.columns:
+        series = data[column]
+        if column in list_columns:
+            lists = [_parse_list(value) for value in series.tolist()]
+            offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+            np.cumsum([len(items) for items in lists], out=offsets[1:])
+            np.save(os.path.join(path, f'{column}.list_offsets.npy'), offsets)
+            write_strings(path, f'{column}.items', [str(item) for items in lists for item in items])
+            kinds[column] = 'list'
+        elif pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series):
+            np.save(os.path.join(path, f'{column}.npy'), series.to_numpy())
+            kinds[column] = 'array'
+        else:
+            write_strings(path, column, series.map(str).tolist())
+            kinds[column] = 'string'
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'num_rows': len(data), 'columns': kinds}, f, indent=4)
+
+def _append_strings(path: str, name: str, values: Sequence[str]) -> None:
+    encoded = [value.encode('utf-8') for value in values]
+    offsets = np.load(os.path.join(path, f'{name}.offsets.npy'))
+    new_offsets = np.empty(len(encoded), dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=new_offsets)
+    np.save(os.path.join(path, f'{name}.offsets.npy'), np.concatenate([offsets, offsets[-1] + new_offsets]))
+    with open(os.path.join(path, f'{name}.values.bin'), 'ab') as f:
+        f.write(b''.join(encoded))
+
+def append_table(data: pd.DataFrame, path: str) -> int:
+    """Append rows to a table written by `write_table`. String bytes are appended to the value files, and only the offset and numeric arrays are rewritten. Tables of the path must not be read while it runs.
+
+    Args:
+        `data` (`pd.DataFrame`): The rows to append, with the columns of the table.
+        `path` (`str`): The directory of the table.
+    Returns:
+        `int`: The position of the first appended row.
+    """
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    kinds: dict[str, str] = meta['columns']
+    assert set(data.columns) == set(kinds), f'Columns {sorted(data.columns)} do not match the table columns {sorted(kinds)}.'
+    for column, kind in kinds.items():
+        series = data[column]
+        if kind == 'list':
+            lists = [_parse_list(value) for value in series.tolist()]
+            offsets = np.load(os.path.join(path, f'{column}.list_offsets.npy'))
+            new_offsets = np.empty(len(lists), dtype=np.int64)
+            np.cumsum([len(items) for items in lists], out=new_offsets)
+            np.save(os.path.join(path, f'{column}.list_offsets.npy'), np.concatenate([offsets, offsets[-1] + new_offsets]))
+            _append_strings(path, f'{column}.items', [str(item) for items in lists for item in items])
+        elif kind == 'array':
+            array = np.load(os.path.join(path, f'{column}.npy'))
+            np.save(os.path.join(path, f'{column}.npy'), np.concatenate([array, series.to_numpy()]))
+        else:
+            _append_strings(path, column, series.map(str).tolist())
+    start = meta['num_rows']
+    meta['num_rows'] += len(data)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=4)
+    return start
+
+class ColumnarTable:
+    """
+    A table written by `write_table`. Columns are memory-mapped on first access, so opening a table costs almost nothing and processes reading the same table share its pages.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.num_rows: int = meta['num_rows']
+        self.kinds: dict[str, str] = meta['columns']
+        self._columns: dict[str, np.ndarray | StringColumn | ListColumn] = {}
+
+    @property
+    def columns(self) -> list[str]:
+        return list(self.kinds.keys())
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def __contains__(self, column: str) -> bool:
+        return column in self.kinds
+
+    def __getitem__(self, column: str) -> np.ndarray | StringColumn | ListColumn:
+        if column not in self._columns:
+            kind = self.kinds[column]
+            if kind == 'array':
+                self._columns[column] = np.load(os.path.join(self.path, f'{column}.npy'), mmap_mode='r')
+            elif kind == 'string':
+                self._columns[column] = StringColumn(self.path, column)
+            else:
+                self._columns[column] = ListColumn(self.path, column)
+        return self._columns[column]
+
+    def to_frame(self) -> pd.DataFrame:
+        """Load the whole table into memory.
+
+        Returns:
+            `pd.DataFrame`: The table. List columns hold Python lists.
+        """
+        return pd.DataFrame({column: np.asarray(self[column]) if self.kinds[column] == 'array' else self[column].tolist() for column in self.columns})
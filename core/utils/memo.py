@@ -0,0 +1,89 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+from loguru import logger
+
+class LRUMemo:
+    """
+    A thread-safe, in-memory memo with least recently used eviction. Memos are shared by name in the process, use `LRUMemo.get` to obtain one. Use `lookup` and `store` to access the memo, and `report` to log the hit/miss counters.
+    """
+    _instances: dict[str, 'LRUMemo'] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, name: str, max_size: int = 10000) -> None:
+        """Initialize the memo.
+
+        Args:
+            `name` (`str`): The name of the memo, used in reports.
+            `max_size` (`int`, optional): Maximum number of entries. Defaults to `10000`.
+        """
+        assert max_size > 0, 'max_size must be positive.'
+        self.name = name
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls, name: str, **kwargs) -> 'LRUMemo':
+        """Get the shared memo of a name, creating it on first use.
+
+        Args:
+            `name` (`str`): The name of the memo.
+        Returns:
+            `LRUMemo`: The shared memo.
+        """
+        with cls._instances_lock:
+            if name not in cls._instances:
+                cls._instances[name] = cls(name, **kwargs)
+            return cls._instances[name]
+
+    def lookup(self, key: Hashable) -> Optional[Any]:
+        """Look up a stored value and mark it as recently used.
+
+        Args:
+            `key` (`Hashable`): The key.
+        Returns:
+            `Optional[Any]`: The stored value, or `None` on a miss.
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def store(self, key: Hashable, value: Any) -> None:
+        """Store a value, evicting the least recently used entry if the memo is full.
+
+        Args:
+            `key` (`Hashable`): The key.
+            `value` (`Any`): The value to store.
+        """
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def report(self) -> None:
+        """Log the hit/miss counters of the memo."""
+        logger.success(f'Memo {self.name}: {self.hits} hits, {self.misses} misses, hit rate {self.hit_rate:.4f}, {len(self)} entries')
+
+    @classmethod
+    def report_all(cls) -> None:
+        """Log the hit/miss counters of all shared memos."""
+        with cls._instances_lock:
+            memos = list(cls._instances.values())
+        for memo in memos:
+            memo.report()
@@ -2,7 +2,7 @@
 
 import re
 import json
-from typing import Any
+from typing import Any, Optional
 from loguru import logger
 
 def parse_action(action: str, json_mode: bool = False) -> tuple[str, Any]:
@@ -32,7 +32,7 @@ def parse_action(action: str, json_mode: bool = False) -> tuple[str, Any]:
             return 'Invalid', None
 
 
-def parse_ranking_answer(answer: str | Any, gt_answer: int, n_candidate: int, json_mode: bool = False, mode_input: bool = False, *args, **kwargs) -> dict[str, bool | list[int]]:
+def parse_ranking_answer(answer: str | Any, gt_answer: int, n_candidate: int, json_mode: bool = False, mode_input: bool = False, candidate_ids: Optional[list[int]] = None, *args, **kwargs) -> dict[str, bool | list[int]]:
     if not json_mode:
         candidates = answer.split(',')
     else:
@@ -70,7 +70,8 @@ def parse_ranking_answer(answer: str | Any, gt_answer: int, n_candidate: int, js
         if not mode_input:
             try:
                 answer = [int(c) for c in candidates]
-                if gt_answer not in answer:
+                # Without the candidate list, the ground truth stands in for it
+                if (candidate_ids is None and gt_answer not in answer) or (candidate_ids is not None and set(answer) != set(candidate_ids)):
                     return {
                         'valid': False,
                         'answer': [],
@@ -122,4 +123,17 @@ def parse_json(json_data: str, key: str) -> str:
         return str(json.loads(json_data)[key])
     except:
         logger.warning("JSON parse error")
-        return str(json_data)
\ No newline at end of file
+        return str(json_data)
+
+def is_hallucination_flagged(hallucination: str, json_mode: bool = False) -> bool:
+    """Check whether the response of the Hallucination agent flags a hallucination.
+    
+    Args:
+        `hallucination` (`str`): The response of the Hallucination agent.
+        `json_mode` (`bool`, optional): Whether the response is in JSON format. Defaults to `False`.
+    Returns:
+        `bool`: `False` if the response starts with "No hallucination" or is just "None", `True` otherwise. Answers like "None of the claims are supported" flag a hallucination.
+    """
+    verdict = parse_json(hallucination, 'type') if json_mode else hallucination
+    verdict = verdict.strip().strip('"\'').lower()
+    return not (verdict.startswith('no hallucination') or re.fullmatch(r'none[.!]?', verdict) is not None)
@@ -2,6 +2,7 @@
 
 import os
 import json
+from typing import Any
 from langchain.prompts import PromptTemplate
 
 def read_prompts(config_file: str) -> dict[str, PromptTemplate | str]:
@@ -28,3 +29,18 @@ def read_prompts(config_file: str) -> dict[str, PromptTemplate | str]:
             template = PromptTemplate.from_template(template=prompt_config['content'])
         ret[prompt_name] = template
     return ret
+
+def static_prefix(template: PromptTemplate | str, **static: Any) -> str:
+    """Get the part of a prompt that is the same in every call: the template filled with the `static` variables, up to the first other variable. Templates should put their static parts, e.g. instructions and few-shot examples, before the variables that change with each call to make the most of it.
+
+    Args:
+        `template` (`PromptTemplate | str`): The prompt template, or a raw string prompt.
+        `static` (`Any`): The values of the variables that are the same in every call.
+    Returns:
+        `str`: The static prefix of the prompt.
+    """
+    if isinstance(template, str):
+        return template
+    marker = '\x00'
+    variables = {name: static[name] if name in static else marker for name in template.input_variables}
+    return template.format(**variables).split(marker)[0]
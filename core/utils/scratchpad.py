@@ -0,0 +1,99 @@
+from typing import Callable, Optional
+
+class Scratchpad:
+    """
+    The scratchpad of a trial as a list of segments, one per `+=`. Appending does not copy the text, and the token count of each segment is computed once per tokenizer, so the length of the scratchpad in tokens is kept up to date at the cost of the new segments only. Use `str` to get the text, or pass it to a prompt template directly.
+
+    The count of the whole text is the sum of the counts of the segments. Tokens may merge across segment boundaries, so it can be slightly above the count of the joined text, never far from it as segments start with a space or a newline.
+    """
+    def __init__(self, text: str = '') -> None:
+        """Initialize the scratchpad.
+
+        Args:
+            `text` (`str`, optional): The initial text. Defaults to `''`.
+        """
+        self.segments: list[str] = []
+        self._length = 0
+        self._text: Optional[str] = ''
+        # Name of the tokenizer -> count of each segment counted so far, their total, and the segments replaced since
+        self._counts: dict[str, list[int]] = {}
+        self._totals: dict[str, int] = {}
+        self._stale: dict[str, list[int]] = {}
+        if text != '':
+            self.append(text)
+
+    def append(self, text: str) -> 'Scratchpad':
+        """Append a segment in place.
+
+        Args:
+            `text` (`str`): The segment.
+        Returns:
+            `Scratchpad`: The scratchpad itself.
+        """
+        self.segments.append(text)
+        self._length += len(text)
+        self._text = None
+        return self
+
+    def __iadd__(self, text: str) -> 'Scratchpad':
+        return self.append(text)
+
+    def __add__(self, text: str) -> 'Scratchpad':
+        # A copy that shares the counts of the segments seen so far, e.g. for a speculative step
+        scratchpad = Scratchpad()
+        scratchpad.segments = list(self.segments)
+        scratchpad._length = self._length
+        scratchpad._text = self._text
+        scratchpad._counts = {name: list(counts) for name, counts in self._counts.items()}
+        scratchpad._totals = dict(self._totals)
+        scratchpad._stale = {name: list(stale) for name, stale in self._stale.items()}
+        return scratchpad.append(text)
+
+    def __getitem__(self, i: int) -> str:
+        return self.segments[i]
+
+    def __setitem__(self, i: int, text: str) -> None:
+        # Replace a segment, e.g. to compact it. Only this segment is counted again
+        self._length += len(text) - len(self.segments[i])
+        self.segments[i] = text
+        self._text = None
+        i = i % len(self.segments)
+        for name, counts in self._counts.items():
+            if i < len(counts):
+                self._stale[name].append(i)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __str__(self) -> str:
+        if self._text is None:
+            self._text = ''.join(self.segments)
+        return self._text
+
+    def __format__(self, format_spec: str) -> str:
+        return format(str(self), format_spec)
+
+    def __repr__(self) -> str:
+        return f'Scratchpad({str(self)!r})'
+
+    def tokens(self, name: str, count: Callable[[str], int]) -> int:
+        """Get the length of the scratchpad in tokens. Only the segments appended or replaced since the last call with the same `name` are counted.
+
+        Args:
+            `name` (`str`): The name of the tokenizer, to keep the counts of several tokenizers apart.
+            `count` (`Callable[[str], int]`): Counts the tokens of a text, without special tokens.
+        Returns:
+            `int`: The number of tokens.
+        """
+        counts = self._counts.setdefault(name, [])
+        total = self._totals.get(name, 0)
+        for i in self._stale.setdefault(name, []):
+            n = count(self.segments[i])
+            total += n - counts[i]
+            counts[i] = n
+        self._stale[name] = []
+        for segment in self.segments[len(counts):]:
+            counts.append(count(segment))
+            total += counts[-1]
+        self._totals[name] = total
+        return total
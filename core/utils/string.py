@@ -1,4 +1,6 @@
 # Description: Functions for string processing.
+import string
+import pandas as pd
 
 def format_step(step: str) -> str:
     """Format a step prompt. Remove leading and trailing whitespaces and newlines, and replace newlines with spaces.
@@ -72,6 +74,23 @@ def str2list(s: str) -> list[int]:
     """
     return [int(i) for i in s.split(',')]
 
+def format_columns(template: str, df: pd.DataFrame) -> pd.Series:
+    """Format `template` with the columns of each row of `df` at once. Equivalent to `df.apply(lambda x: template.format(**x), axis=1)` for templates with plain `{column}` fields.
+    
+    Args:
+        `template` (`str`): A template such as `'Subject: {subject}, Project: {project}'`.
+        `df` (`pd.DataFrame`): The table holding the columns of the template.
+    Returns:
+        `pd.Series`: The formatted string of each row.
+    """
+    result = pd.Series('', index=df.index, dtype=object)
+    for literal, field, format_spec, conversion in string.Formatter().parse(template):
+        assert not format_spec and not conversion, 'Only plain fields are supported.'
+        result = result + literal
+        if field is not None:
+            result = result + df[field].map(str)
+    return result
+
 def get_avatar(agent_type: str) -> str:
     """Get the avatar of the agent.
     